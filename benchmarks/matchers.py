@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Compares the per call matching of the contacts with the matchers compiled at load time,
+# on contacts precomputed by the records.
+#
+#   python3 benchmarks/matchers.py [number of contacts]
+
+import random
+import sys
+import timeit
+
+from wazo_microsoft.dird.index import compile_texts, compile_values, normalize_text
+from wazo_microsoft.dird.records import record_class
+
+SEARCHED_COLUMNS = ['givenName', 'surname', 'email']
+FIRST_MATCHED_COLUMNS = ['mobilePhone', 'businessPhones']
+NAMES = ['Mario', 'Luigi', 'Peach', 'Toad', 'Yoshi', 'Daisy', 'Wario', 'Élodie', 'Zoé', 'Björn']
+
+
+def make_contacts(count):
+    random.seed(42)
+    for i in range(count):
+        given_name = random.choice(NAMES)
+        surname = '{}{}'.format(random.choice(NAMES), i)
+        yield {
+            'id': 'contact-{}'.format(i),
+            'givenName': given_name,
+            'surname': surname,
+            'email': '{}.{}@bros.com'.format(given_name, surname).lower(),
+            'mobilePhone': '555{:07d}'.format(i),
+            'businessPhones': ['418{:07d}'.format(i), '514{:07d}'.format(i)],
+        }
+
+
+def search_per_call(contacts, term):
+    term = normalize_text(term)
+
+    def match_fn(contact):
+        for column in SEARCHED_COLUMNS:
+            values = contact.get(column)
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if value and term in normalize_text(value):
+                    return True
+        return False
+
+    return [contact for contact in contacts if match_fn(contact)]
+
+
+def search_compiled(records, term):
+    term = normalize_text(term)
+    return [record for record in records if any(term in text for text in record.search_texts)]
+
+
+def first_match_per_call(contacts, term):
+    term = term.lower()
+    for contact in contacts:
+        for column in FIRST_MATCHED_COLUMNS:
+            column_value = contact.get(column) or ''
+            if not isinstance(column_value, list):
+                if term == str(column_value).lower():
+                    return contact
+            else:
+                for item in column_value:
+                    if term == item.lower():
+                        return contact
+
+
+def first_match_compiled(records, term):
+    term = term.casefold()
+    for record in records:
+        if term in record.match_values:
+            return record
+
+
+def main(count):
+    contacts = list(make_contacts(count))
+    Record = record_class(
+        ['id', 'givenName', 'surname', 'email', 'mobilePhone', 'businessPhones'],
+        computed={
+            'search_texts': compile_texts(SEARCHED_COLUMNS),
+            'match_values': compile_values(FIRST_MATCHED_COLUMNS),
+        },
+    )
+    records = [Record(contact) for contact in contacts]
+    # The last contact, the worst case of a scan
+    number = '514{:07d}'.format(count - 1)
+
+    assert len(search_per_call(contacts, 'zoe')) == len(search_compiled(records, 'zoe'))
+    assert first_match_per_call(contacts, number)['id'] == first_match_compiled(records, number)['id']
+
+    benchmarks = [
+        ('search', lambda: search_per_call(contacts, 'zoe'), lambda: search_compiled(records, 'zoe')),
+        ('first_match', lambda: first_match_per_call(contacts, number), lambda: first_match_compiled(records, number)),
+    ]
+    print('{} contacts'.format(count))
+    for name, per_call, compiled in benchmarks:
+        per_call_time = min(timeit.repeat(per_call, number=1, repeat=5))
+        compiled_time = min(timeit.repeat(compiled, number=1, repeat=5))
+        print('{:<12} per call: {:8.2f} ms  compiled: {:8.2f} ms  x{:.1f}'.format(
+            name, per_call_time * 1000, compiled_time * 1000, per_call_time / compiled_time,
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
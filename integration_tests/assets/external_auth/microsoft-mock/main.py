@@ -10,17 +10,58 @@ from flask_restful import Resource, Api
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+throttling = {'remaining': 0, 'retry_after': 1}
+
+
+def throttled():
+    if throttling['remaining'] <= 0:
+        return None
+
+    throttling['remaining'] -= 1
+    print('Microsoft is throttling the request.', file=sys.stderr)
+    error = {'error': {'code': 'TooManyRequests'}}
+    return error, 429, {'Retry-After': str(throttling['retry_after'])}
+
+
+class ThrottlingMock(Resource):
+
+    def get(self):
+        return throttling, 200
+
+    def put(self):
+        body = request.get_json(force=True)
+        throttling['remaining'] = body.get('count', 0)
+        throttling['retry_after'] = body.get('retry_after', 1)
+        return throttling, 200
+
 
 class MicrosoftMock(Resource):
 
+    ETAG = '"a-contacts-etag"'
+
     def get(self):
+        response = throttled()
+        if response:
+            return response
+
         term = request.args.get('search')
         print('Looking for term: {}.'.format(term), file=sys.stderr)
-        data = {
+        if request.headers.get('If-None-Match') == self.ETAG:
+            print('Contacts are unchanged.', file=sys.stderr)
+            return '', 304, {'ETag': self.ETAG}
+
+        data = self.contacts()
+        print('Response with term {} is : {}'.format(term, data), file=sys.stderr)
+        return data, 200, {'ETag': self.ETAG}
+
+    @staticmethod
+    def contacts():
+        return {
             "value": [
                 {
                     "@odata.etag": "W/\"an-odata-etag\"",
                     "id": "an-id",
+                    "parentFolderId": "a-folder-id",
                     "displayName": "Wario Bros",
                     "givenName": "Wario",
                     "surname": "Bros",
@@ -36,7 +77,30 @@ class MicrosoftMock(Resource):
                 }
             ]
         }
-        print('Response with term {} is : {}'.format(term, data), file=sys.stderr)
+
+
+class MicrosoftDeltaMock(Resource):
+
+    DELTA_TOKEN = 'a-delta-token'
+
+    def get(self, folder_id):
+        response = throttled()
+        if response:
+            return response
+
+        if folder_id != 'a-folder-id':
+            return {'error': {'code': 'ErrorItemNotFound'}}, 404
+
+        delta_token = request.args.get('$deltatoken')
+        print('Delta requested with token: {}.'.format(delta_token), file=sys.stderr)
+        if delta_token is None:
+            data = MicrosoftMock.contacts()
+        elif delta_token == self.DELTA_TOKEN:
+            data = {'value': []}
+        else:
+            return {'error': {'code': 'syncStateNotFound'}}, 410
+
+        data['@odata.deltaLink'] = '{}?$deltatoken={}'.format(request.base_url, self.DELTA_TOKEN)
         return data, 200
 
 
@@ -51,5 +115,7 @@ if __name__ == '__main__':
     app = Flask('microsoft')
     api = Api(app)
     api.add_resource(MicrosoftMock, '/me/contacts')
+    api.add_resource(MicrosoftDeltaMock, '/me/contactFolders/<folder_id>/contacts/delta')
     api.add_resource(MicrosoftErrorMock, '/me/contacts/error')
+    api.add_resource(ThrottlingMock, '/_throttling')
     app.run(debug=True, host='0.0.0.0', port=80)
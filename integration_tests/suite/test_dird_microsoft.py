@@ -325,6 +325,25 @@ class TestDirdOffice365Plugin(BaseOffice365TestCase):
             )),
         ))
 
+    def test_given_microsoft_source_when_search_contacts_then_contacts_filtered(self):
+        self.auth_client_mock.set_external_auth(self.MICROSOFT_EXTERNAL_AUTH)
+
+        result = self.client.backends.list_contacts_from_source(
+            backend=self.BACKEND,
+            source_uuid=self.source['uuid'],
+            search='luigi',
+        )
+        assert_that(result, has_entries(total=1, filtered=0, items=empty()))
+
+        result = self.client.backends.list_contacts_from_source(
+            backend=self.BACKEND,
+            source_uuid=self.source['uuid'],
+            search='WARIO',
+            limit=1,
+            offset=0,
+        )
+        assert_that(result, has_entries(total=1, filtered=1, items=contains(has_entries(givenName='Wario'))))
+
     def test_given_non_existing_microsoft_source_when_get_all_contacts_then_not_found(self):
         self.auth_client_mock.set_external_auth(self.MICROSOFT_EXTERNAL_AUTH)
 
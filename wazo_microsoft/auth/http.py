@@ -7,12 +7,13 @@ import time
 from datetime import datetime
 from threading import Thread
 
-from flask import request
+from flask import Response, request
 from requests_oauthlib import OAuth2Session
 from wazo_auth import http
 from wazo_auth.exceptions import UserParamException
 from wazo_auth.flask_helpers import Tenant
 
+from .. import metrics
 from .helpers import get_timestamp_expiration
 from .schemas import MicrosoftSchema
 from .websocket_oauth2 import WebSocketOAuth2
@@ -23,6 +24,17 @@ logger = logging.getLogger(__name__)
 os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 os.environ['OAUTHLIB_IGNORE_SCOPE_CHANGE'] = '1'
 
+TOKEN_REFRESH_DURATION = metrics.histogram(
+    'microsoft_token_refresh_duration_seconds',
+    'Duration of the microsoft token refreshes',
+    ['result'],
+)
+TOKEN_READS = metrics.counter(
+    'microsoft_token_reads_total',
+    'Microsoft tokens read by the users, valid or expired',
+    ['state'],
+)
+
 
 class MicrosoftAuth(http.AuthResource):
 
@@ -76,8 +88,10 @@ class MicrosoftAuth(http.AuthResource):
         expiration = data.get('token_expiration')
 
         if self._is_token_expired(expiration):
+            TOKEN_READS.inc('expired')
             return self._refresh_token(user_uuid, data)
 
+        TOKEN_READS.inc('valid')
         return self._create_get_response(data)
 
     @http.required_acl('auth.users.{user_uuid}.external.microsoft.delete')
@@ -93,7 +107,13 @@ class MicrosoftAuth(http.AuthResource):
     def _refresh_token(self, user_uuid, data):
         client_id, client_secret = self._get_external_config()
         oauth2 = OAuth2Session(client_id, token=data)
-        token_data = oauth2.refresh_token(self.token_url, client_id=client_id, client_secret=client_secret)
+        start = time.monotonic()
+        result = 'error'
+        try:
+            token_data = oauth2.refresh_token(self.token_url, client_id=client_id, client_secret=client_secret)
+            result = 'success'
+        finally:
+            TOKEN_REFRESH_DURATION.observe(time.monotonic() - start, result)
 
         logger.critical('refresh token info: %s', token_data)
         data['refresh_token'] = token_data['refresh_token']
@@ -114,3 +134,10 @@ class MicrosoftAuth(http.AuthResource):
     @staticmethod
     def _create_get_response(data):
         return MicrosoftSchema().dump(data)
+
+
+class MicrosoftMetrics(http.AuthResource):
+
+    @http.required_acl('auth.external.microsoft.metrics.read')
+    def get(self):
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -3,7 +3,7 @@
 
 import logging
 
-from .http import MicrosoftAuth
+from .http import MicrosoftAuth, MicrosoftMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -20,3 +20,4 @@ class MicrosoftPlugin:
             '/users/<uuid:user_uuid>/external/microsoft',
             resource_class_args=args
         )
+        api.add_resource(MicrosoftMetrics, '/external/microsoft/metrics')
@@ -0,0 +1,77 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import asyncio
+import functools
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOffice365Service:
+
+    # The requests are made by the synchronous service, sharing its connection pool, on a
+    # bounded executor so that many graph requests can be awaited concurrently from one loop
+
+    def __init__(self, office365, max_concurrency=4):
+        self._office365 = office365
+        self._max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def get_contacts_by_ids(self, microsoft_token, url, contact_ids, select=None):
+        return await self._run(
+            self._office365.get_contacts_by_ids, microsoft_token, url, contact_ids, select=select,
+        )
+
+    async def sync(self, synchronizer, replica, microsoft_token, endpoint):
+        # The synchronizers make their requests with the same synchronous service
+        return await self._run(synchronizer.sync, replica, microsoft_token, endpoint)
+
+    async def gather(self, *coroutines, return_exceptions=False):
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+
+class AsyncBridge:
+
+    def __init__(self, name='office365-asyncio'):
+        self._name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def run(self, coroutine, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
+        return future.result(timeout)
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run_loop, name=self._name)
+                self._thread.daemon = True
+                self._thread.start()
+            return self._loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        logger.debug('%s event loop started', self._name)
+        self._loop.run_forever()
@@ -0,0 +1,206 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+MISS = 'miss'
+
+_Entry = namedtuple('_Entry', ['token', 'value', 'size', 'expiration'])
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def estimate_size(obj):
+    seen = set()
+    to_visit = [obj]
+    size = 0
+    while to_visit:
+        item = to_visit.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, Mapping):
+            to_visit.extend(item.keys())
+            to_visit.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            to_visit.extend(item)
+    return size
+
+
+class ContactCache:
+
+    def __init__(self, ttl, max_entries, max_bytes, stale_ttl=0):
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, user_uuid, endpoint, microsoft_token):
+        value, state = self.lookup(user_uuid, endpoint, microsoft_token)
+        return value if state == FRESH else None
+
+    def lookup(self, user_uuid, endpoint, microsoft_token, count=True):
+        # Values past their ttl are returned as stale, then as expired, until they get evicted.
+        # The lookups checking an entry again, e.g. after waiting for its key lock, are not counted
+        key = (user_uuid, endpoint)
+        with self._lock:
+            entry = self._entries.get(key)
+            # Entries set with a token, e.g. the responses of a microsoft token, are only returned
+            # for that token. Entries without a token, like the replicas, are returned for any token.
+            if entry is not None and entry.token is not None and entry.token != microsoft_token:
+                logger.debug('microsoft token changed for user %s, invalidating cache', user_uuid)
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.stats[MISS] += 1
+                return None, MISS
+
+            self._entries.move_to_end(key)
+            now = time.monotonic()
+            if entry.expiration > now:
+                state = FRESH
+            elif entry.expiration + self._stale_ttl > now:
+                state = STALE
+            else:
+                state = EXPIRED
+            if count:
+                self.stats[state] += 1
+            return entry.value, state
+
+    def set(self, user_uuid, endpoint, microsoft_token, value, size=None):
+        key = (user_uuid, endpoint)
+        if size is None:
+            size = estimate_size(value)
+        with self._lock:
+            self._remove(key)
+            if size > self._max_bytes:
+                logger.info('%s contacts for user %s exceed the cache size limit', endpoint, user_uuid)
+                return
+
+            expiration = time.monotonic() + self._ttl
+            self._entries[key] = _Entry(microsoft_token, value, size, expiration)
+            self._size += size
+            self._evict()
+
+    def key_lock(self, user_uuid, endpoint):
+        # Held by the users of a shared entry while one of them computes it
+        with self._lock:
+            return self._key_locks.setdefault((user_uuid, endpoint), threading.Lock())
+
+    def restore(self, user_uuid, endpoint, value, size=None):
+        # Restored values are stale right away, until a value is set for their key
+        key = (user_uuid, endpoint)
+        if size is None:
+            size = estimate_size(value)
+        with self._lock:
+            if key in self._entries or size > self._max_bytes:
+                return False
+
+            self._entries[key] = _Entry(None, value, size, time.monotonic())
+            self._size += size
+            self._evict()
+            return True
+
+    def entries(self):
+        with self._lock:
+            return [(user_uuid, endpoint, entry.value) for (user_uuid, endpoint), entry in self._entries.items()]
+
+    def invalidate(self, user_uuid, endpoint=None):
+        with self._lock:
+            if endpoint is not None:
+                self._remove((user_uuid, endpoint))
+                return
+
+            for key in [key for key in self._entries if key[0] == user_uuid]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self._max_entries or self._size > self._max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+
+def get_shared_cache(**config):
+    # The caches of the tenant directories are shared by the sources of the process
+    with _shared_caches_lock:
+        key = tuple(sorted(config.items()))
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = _shared_caches[key] = ContactCache(**config)
+        return cache
+
+
+class ExpiringSet:
+
+    def __init__(self, ttl, max_entries):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._expirations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expirations)
+
+    def __contains__(self, item):
+        with self._lock:
+            expiration = self._expirations.get(item)
+            if expiration is None:
+                return False
+
+            if expiration <= time.monotonic():
+                del self._expirations[item]
+                return False
+
+            return True
+
+    def add(self, item):
+        if self._ttl <= 0:
+            return
+
+        with self._lock:
+            self._expirations.pop(item, None)
+            self._expirations[item] = time.monotonic() + self._ttl
+            while len(self._expirations) > self._max_entries:
+                self._expirations.popitem(last=False)
+
+    def discard(self, item):
+        with self._lock:
+            self._expirations.pop(item, None)
@@ -24,3 +24,21 @@ class MicrosoftTokenNotFoundException(APIException):
             'user_uuid': user_uuid,
         }
         super().__init__(self.code, message, 'no-token-found', details)
+
+
+class SyncStateNotFoundException(Exception):
+
+    def __init__(self, url):
+        super().__init__('The delta link {} is no longer valid'.format(url))
+        self.url = url
+
+
+class DeltaNotSupportedException(Exception):
+
+    def __init__(self, url):
+        super().__init__('The endpoint {} does not support delta queries'.format(url))
+        self.url = url
+
+
+class MicrosoftAccountNotLinkedException(MicrosoftTokenNotFoundException):
+    pass
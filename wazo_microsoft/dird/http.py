@@ -1,32 +1,59 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import hashlib
+import json
 import logging
 
-from flask import request
+from flask import Response, request
+from werkzeug.http import quote_etag
 from wazo_dird.auth import required_acl
 from wazo_dird.helpers import SourceItem, SourceList
 from wazo_dird.rest_api import AuthResource
 from xivo.tenant_flask_helpers import Tenant, token
 
-from .schemas import list_schema, source_list_schema, source_schema
-from .services import Office365Service, get_microsoft_access_token
+from .. import metrics
+from .cache import estimate_size
+from .index import paginate_contacts
+from .schemas import contact_list_schema, list_schema, source_list_schema, source_schema
+from .exceptions import UnexpectedEndpointException
+from .services import get_microsoft_access_token, invalidate_microsoft_access_token
+from .throttling import get_tenant_throttler
 
 logger = logging.getLogger(__name__)
 
 
+def contacts_etag(contacts):
+    # The ETags of the contacts change with the contacts, the whole list is only
+    # serialized when some of them have no ETag
+    digest = hashlib.sha1()
+    for contact in contacts:
+        version = contact.get('@odata.etag')
+        if version is None:
+            version = json.dumps(contact, sort_keys=True)
+        digest.update('{}\0{}\0'.format(contact.get('id'), version).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def page_etag(contacts_etag, args):
+    query = '&'.join('{}={}'.format(key, value) for key, value in sorted(args.items(multi=True)))
+    return hashlib.sha1('{}?{}'.format(contacts_etag, query).encode('utf-8')).hexdigest()
+
+
 class MicrosoftContactList(AuthResource):
 
     BACKEND = 'office365'
 
-    def __init__(self, auth_config, config, source_service):
+    def __init__(self, auth_config, config, source_service, office365_services, contact_cache):
         self.auth_config = auth_config
         self.config = config
         self.source_service = source_service
-        self.office365 = Office365Service()
+        self.office365_services = office365_services
+        self.contact_cache = contact_cache
 
     @required_acl('dird.backends.office365.sources.{source_uuid}.contacts.read')
     def get(self, source_uuid):
+        list_params = contact_list_schema.load(request.args).data
         user_uuid = token.user_uuid
         token_from_request = request.headers.get('X-Auth-Token')
         tenant = Tenant.autodetect()
@@ -34,13 +61,55 @@ class MicrosoftContactList(AuthResource):
         source = self.source_service.get(self.BACKEND, source_uuid, [tenant.uuid])
         microsoft_token = get_microsoft_access_token(user_uuid, token_from_request, **source['auth'])
 
-        contacts = self.office365.get_contacts(microsoft_token, source['endpoint'])
+        # The pages of an address book are served from the same download
+        cached = self.contact_cache.get(user_uuid, source_uuid, microsoft_token)
+        if cached is None:
+            contacts = self._fetch_contacts(source_uuid, source, tenant, user_uuid, microsoft_token)
+            cached = contacts, contacts_etag(contacts)
+            self.contact_cache.set(user_uuid, source_uuid, microsoft_token, cached, size=estimate_size(contacts))
+        contacts, etag = cached
+
+        # Each page of the contacts has its own ETag
+        etag = page_etag(etag, request.args)
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': quote_etag(etag)}
+
+        filtered, items = paginate_contacts(
+            contacts,
+            contact_list_schema.searchable_columns,
+            search=list_params.get('search'),
+            order=list_params.get('order'),
+            direction=list_params.get('direction', 'asc'),
+            limit=list_params.get('limit'),
+            offset=list_params.get('offset', 0),
+        )
 
         return {
-            'filtered': len(contacts),
-            'items': contacts,
+            'filtered': filtered,
+            'items': items,
             'total': len(contacts),
-        }, 200
+        }, 200, {'ETag': quote_etag(etag)}
+
+    def _fetch_contacts(self, source_uuid, source, tenant, user_uuid, microsoft_token):
+        office365 = self.office365_services.get(
+            source_uuid,
+            throttler=get_tenant_throttler(tenant.uuid, **source.get('throttling', {})),
+            **source.get('paging', {}),
+            **source.get('http', {})
+        )
+        try:
+            return tuple(office365.get_contacts(microsoft_token, source['endpoint']))
+        except UnexpectedEndpointException as e:
+            if e.details.get('error_code') == 401:
+                invalidate_microsoft_access_token(user_uuid, **source['auth'])
+            raise
+
+
+class MicrosoftMetrics(AuthResource):
+
+    @required_acl('dird.backends.office365.metrics.read')
+    def get(self):
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 class MicrosoftList(SourceList):
@@ -0,0 +1,213 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import heapq
+import logging
+import re
+import unicodedata
+
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+PHONE_NUMBER_RE = re.compile(r'^\+?[\d\s().\-/]+$')
+NON_DIGIT_RE = re.compile(r'\D')
+
+EXACT = 0
+PREFIX = 1
+SUBSTRING = 2
+
+
+class PhoneNumberNormalizer:
+
+    def __init__(self, country_code=None, national_prefix=''):
+        self._country_code = country_code
+        self._national_prefix = national_prefix or ''
+
+    def __call__(self, value):
+        if not isinstance(value, str) or not PHONE_NUMBER_RE.match(value):
+            return None
+
+        value = value.strip()
+        digits = NON_DIGIT_RE.sub('', value)
+        international = value.startswith('+')
+        if digits.startswith('00'):
+            digits = digits[2:]
+            international = True
+
+        if international and self._country_code and digits.startswith(self._country_code):
+            digits = self._national_prefix + digits[len(self._country_code):]
+
+        return digits or None
+
+
+def build_phone_index(contacts, columns, normalize):
+    index = {}
+    for contact in contacts:
+        for column in columns:
+            for value in as_values(contact.get(column)):
+                number = normalize(value)
+                if number:
+                    # The first contact wins, as it did when scanning the contacts
+                    index.setdefault(number, contact)
+    logger.debug('phone index built with %s numbers', len(index))
+    return index
+
+
+def normalize_text(value):
+    decomposed = unicodedata.normalize('NFKD', str(value))
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def as_values(value):
+    return value if isinstance(value, (list, tuple)) else (value,)
+
+
+def compile_texts(columns):
+    # Normalized texts of the searched columns of a contact
+    columns = tuple(columns)
+
+    def texts(contact):
+        return tuple(
+            normalize_text(value)
+            for column in columns
+            for value in as_values(contact.get(column))
+            if value
+        )
+
+    return texts
+
+
+def compile_values(columns):
+    # Casefolded values of the first matched columns of a contact, matched exactly
+    columns = tuple(columns)
+
+    def values(contact):
+        return frozenset(
+            str(value).casefold()
+            for column in columns
+            for value in as_values(contact.get(column))
+            if value
+        )
+
+    return values
+
+
+def match_rank(term, texts):
+    if not term:
+        return PREFIX
+
+    rank = None
+    for text in texts:
+        if text == term:
+            return EXACT
+        if text.startswith(term):
+            rank = PREFIX
+        elif rank is None and term in text:
+            rank = SUBSTRING
+    return rank
+
+
+def select_matches(ranked, limit=None, key=None):
+    # Best ranks first, then by key, then in their original order
+    entries = (
+        (rank, key(contact) if key else '', position, contact)
+        for position, (rank, contact) in enumerate(ranked)
+    )
+    selected = heapq.nsmallest(limit, entries) if limit else sorted(entries)
+    return [entry[-1] for entry in selected]
+
+
+def search_contacts(contacts, columns, term, texts=None, limit=None, key=None):
+    # Same matching as SearchIndex.search, one contact at a time, for contacts that are not indexed
+    if not columns:
+        return []
+    texts = texts or compile_texts(columns)
+    term = normalize_text(term)
+
+    def ranked():
+        exact_matches = 0
+        for contact in contacts:
+            rank = match_rank(term, texts(contact))
+            if rank is None:
+                continue
+            yield rank, contact
+
+            # The remaining contacts cannot rank better once enough exact matches are found,
+            # only the order of the exact matches can differ from SearchIndex.search
+            if rank == EXACT:
+                exact_matches += 1
+                if limit and exact_matches >= limit:
+                    return
+
+    return select_matches(ranked(), limit, key)
+
+
+def paginate_contacts(contacts, columns, search=None, order=None, direction='asc', limit=None, offset=0):
+    # Returns the number of contacts matching the search and the requested page of them
+    if search:
+        texts = compile_texts(columns)
+        term = normalize_text(search)
+        contacts = [contact for contact in contacts if any(term in text for text in texts(contact))]
+    filtered = len(contacts)
+
+    end = offset + limit if limit is not None else None
+    if order:
+        key = sort_key(order)
+        if end is None:
+            contacts = sorted(contacts, key=key, reverse=direction == 'desc')
+        elif direction == 'desc':
+            contacts = heapq.nlargest(end, contacts, key=key)
+        else:
+            contacts = heapq.nsmallest(end, contacts, key=key)
+
+    return filtered, list(contacts[offset:end])
+
+
+def sort_key(column):
+    def key(contact):
+        values = [value for value in as_values(contact.get(column)) if value]
+        return normalize_text(values[0]) if values else ''
+    return key
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+
+    def __init__(self, contacts, columns, texts=None):
+        self._contacts = contacts
+        self._has_columns = bool(columns)
+        self._texts = []
+        self._trigrams = defaultdict(set)
+        texts_of = texts or compile_texts(columns)
+
+        for position, contact in enumerate(contacts):
+            texts = texts_of(contact)
+            self._texts.append(texts)
+            for text in texts:
+                for trigram in trigrams(text):
+                    self._trigrams[trigram].add(position)
+
+        logger.debug('search index built with %s trigrams', len(self._trigrams))
+
+    def search(self, term, limit=None, key=None):
+        if not self._has_columns:
+            return []
+
+        term = normalize_text(term)
+        if len(term) < 3:
+            candidates = range(len(self._contacts))
+        else:
+            postings = sorted((self._trigrams.get(trigram, set()) for trigram in trigrams(term)), key=len)
+            candidates = sorted(set.intersection(*postings))
+
+        return select_matches(self._ranked(term, candidates), limit, key)
+
+    def _ranked(self, term, candidates):
+        for position in candidates:
+            rank = match_rank(term, self._texts[position])
+            if rank is not None:
+                yield rank, self._contacts[position]
@@ -0,0 +1,135 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import codecs
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',:]}'
+
+
+class GraphPage:
+
+    # Reads a microsoft graph collection page from a stream of bytes, yielding the items of its
+    # "value" array one at a time. The other properties of the page, like "@odata.nextLink",
+    # are available in `properties` once the page has been read.
+
+    def __init__(self, chunks, collection='value'):
+        self.properties = {}
+        self.size = 0
+        self._chunks = iter(chunks)
+        self._collection = collection
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._position = 0
+        self._exhausted = False
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._position += 1
+            self._finish()
+            return
+
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key == self._collection and self._peek() == '[':
+                yield from self._items()
+            else:
+                self.properties[key] = self._decode()
+
+            if self._peek() == '}':
+                self._position += 1
+                self._finish()
+                return
+            self._expect(',')
+
+    def _finish(self):
+        # The stream is read to its end, for the readers of the chunks that wait for it
+        while self._fill():
+            pass
+
+    def read(self):
+        items = list(self)
+        return dict(self.properties, **{self._collection: items})
+
+    def _items(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._position += 1
+            return
+
+        while True:
+            yield self._decode()
+            if self._peek() == ']':
+                self._position += 1
+                return
+            self._expect(',')
+
+    def _decode(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A number may continue in the next chunk, it must be followed by a delimiter
+            if not self._delimited(end) and self._fill():
+                continue
+
+            self._position = end
+            return value
+
+    def _delimited(self, end):
+        return end < len(self._buffer) and self._buffer[end] in DELIMITERS
+
+    def _expect(self, char):
+        found = self._next()
+        if found != char:
+            raise ValueError('Expected {!r} at position {}, found {!r}'.format(char, self._position, found))
+
+    def _next(self):
+        char = self._peek()
+        self._position += 1
+        return char
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self._position >= len(self._buffer):
+            raise ValueError('Unexpected end of microsoft graph response')
+        return self._buffer[self._position]
+
+    def _skip_whitespace(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer) or not self._fill():
+                return
+
+    def _fill(self):
+        if self._exhausted:
+            return False
+
+        # Drop what has already been parsed to keep the buffer around the size of a chunk
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            self.size += len(chunk)
+            text = self._text_decoder.decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+
+        self._exhausted = True
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        return False
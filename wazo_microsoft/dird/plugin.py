@@ -1,25 +1,240 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import functools
 import logging
-from operator import itemgetter
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from string import Formatter
 
 from wazo_dird import BaseSourcePlugin, make_result_class
 
-from .exceptions import MicrosoftTokenNotFoundException
+from .. import metrics
+from .exceptions import (
+    MicrosoftAccountNotLinkedException,
+    MicrosoftTokenNotFoundException,
+    UnexpectedEndpointException,
+)
 from . import services
+from .aio import AsyncBridge, AsyncOffice365Service
+from .cache import FRESH, STALE, ContactCache, ExpiringSet, estimate_size, get_shared_cache
+from .index import (
+    PhoneNumberNormalizer,
+    SearchIndex,
+    build_phone_index,
+    compile_texts,
+    compile_values,
+    search_contacts,
+)
+from .records import record_class
+from .store import ContactStore, dump_replica, freeze, load_snapshot, restore_replica, save_snapshot
+from .sync import ContactReplica, DeltaSynchronizer, FolderReplica, FolderSynchronizer
+from .throttling import get_tenant_throttler
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CACHE_CONFIG = {
+    'ttl': 60,
+    'max_entries': 1000,
+    'max_bytes': 64 * 1024 * 1024,
+    'stale_ttl': 300,
+    'refresh_workers': 2,
+}
+
+DEFAULT_CONTACT_FOLDERS_CONFIG = {
+    'enabled': False,
+    'recursive': False,
+}
+
+DEFAULT_DIRECTORY_CONFIG = {
+    'enabled': False,
+    'endpoint': 'https://graph.microsoft.com/v1.0/users',
+}
+
+DEFAULT_SNAPSHOT_CONFIG = {
+    'enabled': False,
+    'interval': 300,
+}
+# The workers of a host share the snapshot, the replicas that no worker saved during this many
+# intervals are removed from it
+SNAPSHOT_MAX_AGE_INTERVALS = 3
+
+# Files of the host, configured in the office365 section of the wazo-dird configuration and
+# never by the sources
+DEFAULT_SERVICE_CONFIG = {
+    'snapshot_directory': '/var/lib/wazo-dird/office365',
+    'store_path': '/var/lib/wazo-dird/office365/contacts.sqlite',
+}
+
+DEFAULT_STORE_CONFIG = {
+    'enabled': False,
+    'max_bytes': 256 * 1024 * 1024,
+}
+
+DEFAULT_MISSING_TOKEN_CACHE_CONFIG = {
+    'ttl': 60,
+    'max_entries': 10000,
+}
+
+# Fields of the results that are computed from other microsoft graph fields
+COMPUTED_FIELDS = {
+    'email': 'emailAddresses',
+}
+DIRECTORY_COMPUTED_FIELDS = {
+    'email': 'mail',
+}
+FIELD_NAME_RE = re.compile(r'^[^.\[]+')
+
+# Properties of the microsoft graph contacts and users that can be selected. The other names of
+# the format columns are dird fields, selecting them would be refused by microsoft graph.
+CONTACT_PROPERTIES = frozenset([
+    'assistantName', 'birthday', 'businessAddress', 'businessHomePage', 'businessPhones',
+    'categories', 'changeKey', 'children', 'companyName', 'createdDateTime', 'department',
+    'displayName', 'emailAddresses', 'fileAs', 'generation', 'givenName', 'homeAddress',
+    'homePhones', 'id', 'imAddresses', 'initials', 'jobTitle', 'lastModifiedDateTime', 'manager',
+    'middleName', 'mobilePhone', 'nickName', 'officeLocation', 'otherAddress', 'parentFolderId',
+    'personalNotes', 'profession', 'spouseName', 'surname', 'title', 'yomiCompanyName',
+    'yomiGivenName', 'yomiSurname',
+])
+USER_PROPERTIES = frozenset([
+    'aboutMe', 'accountEnabled', 'businessPhones', 'city', 'companyName', 'country', 'department',
+    'displayName', 'employeeId', 'faxNumber', 'givenName', 'id', 'jobTitle', 'mail',
+    'mailNickname', 'mobilePhone', 'officeLocation', 'otherMails', 'postalCode',
+    'preferredLanguage', 'proxyAddresses', 'state', 'streetAddress', 'surname',
+    'userPrincipalName',
+])
+
+SEARCH_TEXTS = attrgetter('search_texts')
+
+CONTACT_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+LOOKUP_DURATION = metrics.histogram(
+    'office365_lookup_duration_seconds',
+    'Duration of the lookups of the office365 sources',
+    ['source', 'lookup'],
+)
+REPLICA_CONTACTS = metrics.histogram(
+    'office365_replica_contacts',
+    'Contacts of each user, or of the directory, when they are synchronized',
+    ['source'],
+    buckets=CONTACT_BUCKETS,
+)
+CACHE_LOOKUPS = metrics.counter(
+    'office365_cache_lookups_total',
+    'Lookups of the contacts in memory by state: fresh, stale, expired or miss',
+    ['source', 'state'],
+)
+CACHE_BYTES = metrics.gauge('office365_cache_bytes', 'Estimated size of the contacts in memory', ['source'])
+CACHE_ENTRIES = metrics.gauge('office365_cache_entries', 'Users, or directories, with contacts in memory', ['source'])
+POOL_CONNECTIONS = metrics.counter(
+    'office365_http_pool_connections_total',
+    'Connections opened to microsoft graph by host',
+    ['source', 'host'],
+)
+POOL_REQUESTS = metrics.counter(
+    'office365_http_pool_requests_total',
+    'Requests sent on the connections to microsoft graph by host',
+    ['source', 'host'],
+)
+POOL_IDLE = metrics.gauge(
+    'office365_http_pool_idle_connections',
+    'Connections to microsoft graph kept open for the next requests by host',
+    ['source', 'host'],
+)
+POOL_MAXSIZE = metrics.gauge(
+    'office365_http_pool_maxsize',
+    'Maximum number of connections kept open to microsoft graph by host',
+    ['source', 'host'],
+)
+
+
+def timed(lookup):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                LOOKUP_DURATION.observe(time.monotonic() - start, self.name, lookup)
+        return wrapper
+    return decorator
+
+
+def given_name(contact):
+    return contact.get('givenName') or ''
+
+
+def graph_fields(format_columns, *column_lists, computed=COMPUTED_FIELDS, properties=CONTACT_PROPERTIES):
+    fields = {'id', 'givenName'}
+    for format_string in format_columns.values():
+        for _, field_name, _, _ in Formatter().parse(format_string):
+            match = FIELD_NAME_RE.match(field_name or '')
+            if not match:
+                continue
+            if match.group() in properties or match.group() in computed:
+                fields.add(match.group())
+            else:
+                logger.debug('%s is not a microsoft graph property, it is not selected', match.group())
+
+    # Selecting a name that is not a property would make microsoft graph refuse every request,
+    # such columns never match instead
+    for columns in column_lists:
+        for column in columns:
+            match = FIELD_NAME_RE.match(column)
+            if match and (match.group() in properties or match.group() in computed):
+                fields.add(match.group())
+            else:
+                logger.info('column %s is not a microsoft graph property, it will never match', column)
+
+    return sorted(computed.get(field, field) for field in fields)
+
 
 class Office365Plugin(BaseSourcePlugin):
 
     def load(self, dependencies):
         config = dependencies['config']
+        service_config = dict(DEFAULT_SERVICE_CONFIG, **dependencies.get('main_config', {}).get('office365', {}))
         self.auth = config['auth']
         self.name = config['name']
         self.endpoint = config['endpoint']
-        self.office365 = services.Office365Service()
+        self.office365 = services.Office365Service(
+            throttler=get_tenant_throttler(config.get('tenant_uuid'), **config.get('throttling', {})),
+            **config.get('paging', {}),
+            **config.get('http', {})
+        )
+        self._async_office365 = AsyncOffice365Service(self.office365, config.get('max_concurrency', 4))
+        self._bridge = AsyncBridge()
+
+        cache_config = dict(DEFAULT_CACHE_CONFIG, **config.get('cache', {}))
+        self._cache_ttl = cache_config['ttl']
+        self._executor = ThreadPoolExecutor(max_workers=cache_config.pop('refresh_workers'))
+        self._syncing = set()
+        self._syncing_lock = threading.Lock()
+
+        directory_config = dict(DEFAULT_DIRECTORY_CONFIG, **config.get('directory', {}))
+        self._directory_enabled = directory_config['enabled']
+        if self._directory_enabled:
+            # The users of the tenant are the same for every user, they are synchronized once
+            self.endpoint = directory_config['endpoint']
+            self._cache = get_shared_cache(**cache_config)
+        else:
+            self._cache = ContactCache(**cache_config)
+
+        store_config = dict(DEFAULT_STORE_CONFIG, **config.get('store', {}))
+        self._store = None
+        if store_config.pop('enabled'):
+            self._store = ContactStore(service_config['store_path'], **store_config)
+
+        missing_token_cache_config = dict(
+            DEFAULT_MISSING_TOKEN_CACHE_CONFIG,
+            **config.get('missing_token_cache', {})
+        )
+        self._missing_tokens = ExpiringSet(**missing_token_cache_config)
 
         self.unique_column = 'id'
         format_columns = dependencies['config'].get(self.FORMAT_COLUMNS, {})
@@ -51,6 +266,79 @@ class Office365Plugin(BaseSourcePlugin):
                 self.name,
             )
 
+        self._max_results = config.get('max_results')
+        self._normalize_phone_number = PhoneNumberNormalizer(**config.get('phone_index', {}))
+
+        self._select = config.get('select') or graph_fields(
+            format_columns,
+            self._searched_columns,
+            self._first_matched_columns,
+            computed=DIRECTORY_COMPUTED_FIELDS if self._directory_enabled else COMPUTED_FIELDS,
+            properties=USER_PROPERTIES if self._directory_enabled else CONTACT_PROPERTIES,
+        )
+        logger.debug('%s will only fetch the fields: %s', self.name, self._select)
+        # Only the fields used by the source are kept in memory, with the values matched by the
+        # lookups already normalized
+        self._search_texts = compile_texts(self._searched_columns)
+        self._match_values = compile_values(self._first_matched_columns)
+        self._ContactRecord = record_class(
+            ['id', 'givenName', 'email'] + list(self._select),
+            computed={'search_texts': self._search_texts, 'match_values': self._match_values},
+        )
+        self._synchronizer = DeltaSynchronizer(self.office365, self._make_contact, self._select)
+
+        folders_config = dict(DEFAULT_CONTACT_FOLDERS_CONFIG, **config.get('contact_folders', {}))
+        self._folders_enabled = folders_config['enabled']
+        if self._folders_enabled:
+            self._synchronizer = FolderSynchronizer(
+                self.office365,
+                self._synchronizer,
+                self._async_office365,
+                self._bridge,
+                recursive=folders_config['recursive'],
+            )
+        self._batch_enabled = services.batch_endpoint(self.endpoint)[0] is not None
+        # Sources of a tenant configured alike share the same directory and indexes
+        self._directory_key = (
+            'directory',
+            config.get('tenant_uuid'),
+            tuple(self._select),
+            tuple(self._searched_columns),
+            tuple(self._first_matched_columns),
+            tuple(sorted(config.get('phone_index', {}).items())),
+        )
+
+        snapshot_config = dict(DEFAULT_SNAPSHOT_CONFIG, **config.get('snapshot', {}))
+        self._snapshot_path = None
+        self._snapshot_max_age = SNAPSHOT_MAX_AGE_INTERVALS * snapshot_config['interval']
+        self._snapshot_stop = threading.Event()
+        if snapshot_config['enabled']:
+            self._snapshot_path = self._get_snapshot_path(service_config['snapshot_directory'], config.get('uuid'))
+        if self._snapshot_path:
+            # The lookups do not wait for the snapshot, they are cold until it is loaded
+            self._executor.submit(self._load_snapshot)
+            threading.Thread(
+                target=self._save_snapshots,
+                args=(snapshot_config['interval'],),
+                name='office365-snapshot-{}'.format(self.name),
+                daemon=True,
+            ).start()
+
+        metrics.registry.add_collector(self._collect_metrics)
+
+    def unload(self):
+        metrics.registry.remove_collector(self._collect_metrics)
+        self._executor.shutdown(wait=False)
+        if self._snapshot_path:
+            self._snapshot_stop.set()
+            self._save_snapshot()
+        self._bridge.stop()
+        self._async_office365.close()
+        self.office365.close()
+        if self._store is not None:
+            self._store.close()
+
+    @timed('search')
     def search(self, term, args=None):
         logger.debug('Searching term=%s', term)
         try:
@@ -58,35 +346,55 @@ class Office365Plugin(BaseSourcePlugin):
         except MicrosoftTokenNotFoundException:
             return []
 
-        contacts = self.office365.get_contacts_with_term(microsoft_token, term, self.endpoint)
-        updated_contacts = self._update_contact_fields(contacts)
-
-        lowered_term = term.lower()
-
-        def match_fn(contact):
-            for column in self._searched_columns:
-                column_value = contact.get(column) or ''
-                if lowered_term in str(column_value).lower():
-                    return True
-            return False
-
-        filtered_contacts = [c for c in updated_contacts if match_fn(c)]
-        sorted_contacts = sorted(filtered_contacts, key=itemgetter('givenName'))
+        user_uuid = args['xivo_user_uuid']
+        # Exact and prefix matches come first, only the first results are displayed
+        limit = args.get('limit') or self._max_results
+        replica, state = self._cache.lookup(*self._cache_key(user_uuid, microsoft_token))
+        try:
+            if replica is None and not (self._folders_enabled or self._directory_enabled):
+                # The index is cold, microsoft graph answers while the replica is synchronized.
+                # Its contacts are filtered as they are received, only the matches are kept. The
+                # identical searches of other phones share them.
+                self._schedule_sync(user_uuid, microsoft_token)
+                matches = self.office365.find_contacts_with_term(
+                    microsoft_token,
+                    term,
+                    self.endpoint,
+                    functools.partial(self._search_contacts, term=term, limit=limit),
+                    select=self._select,
+                    find_key=limit,
+                )
+            else:
+                replica = self._get_replica(user_uuid, microsoft_token, replica, state)
+                search_index = replica.get_index('search', self._build_search_index)
+                matches = search_index.search(term, limit=limit, key=given_name)
+        except UnexpectedEndpointException as e:
+            logger.error('Unable to get contacts from this endpoint: %s, error : %s', self.endpoint, e.details)
+            return []
 
-        return [self._SourceResult(c) for c in sorted_contacts]
+        return [self._SourceResult(c) for c in matches]
 
+    @timed('list')
     def list(self, unique_ids, args=None):
         try:
             microsoft_token = self._get_microsoft_token(**args)
         except MicrosoftTokenNotFoundException:
             return []
 
-        contacts = self.office365.get_contacts(microsoft_token, self.endpoint)
-        updated_contacts = self._update_contact_fields(contacts)
-        filtered_contacts = [c for c in updated_contacts if c[self.unique_column] in unique_ids]
+        user_uuid = args['xivo_user_uuid']
+        replica, state = self._cache.lookup(*self._cache_key(user_uuid, microsoft_token))
+        if replica is None and self._batch_enabled:
+            # Fetching a few favorites is cheaper than waiting for every contact, the next
+            # lookups use the replica synchronized in the background
+            self._schedule_sync(user_uuid, microsoft_token)
+            contacts = self._get_contacts_by_ids(user_uuid, microsoft_token, list(unique_ids))
+        else:
+            replica = self._get_replica(user_uuid, microsoft_token, replica, state)
+            contacts = (replica.get(unique_id) for unique_id in unique_ids)
 
-        return [self._SourceResult(contact) for contact in filtered_contacts]
+        return [self._SourceResult(contact) for contact in contacts if contact]
 
+    @timed('first_match')
     def first_match(self, term, args=None):
         if not self._first_matched_columns:
             logger.debug(
@@ -101,37 +409,235 @@ class Office365Plugin(BaseSourcePlugin):
             logger.debug('could not find a matching microsoft token, aborting first_match')
             return None
 
-        contacts = self.office365.get_contacts(microsoft_token, self.endpoint)
-        updated_contacts = self._update_contact_fields(contacts)
-        lowered_term = term.lower()
+        user_uuid = args['xivo_user_uuid']
+        replica, state = self._cache.lookup(*self._cache_key(user_uuid, microsoft_token))
+        replica = self._get_replica(user_uuid, microsoft_token, replica, state)
+
+        number = self._normalize_phone_number(term)
+        if number:
+            phone_index = replica.get_index('phone', self._build_phone_index)
+            contact = phone_index.get(number)
+            return self._SourceResult(contact) if contact else None
 
-        for contact in updated_contacts:
-            if self._first_match_predicate(lowered_term, contact):
+        term = term.casefold()
+        for contact in replica.contacts:
+            if term in contact.match_values:
                 return self._SourceResult(contact)
 
-    def _first_match_predicate(self, term, contact):
-        for column in self._first_matched_columns:
-            column_value = contact.get(column) or ''
+    def _search_contacts(self, contacts, term, limit):
+        return search_contacts(
+            (self._make_contact(c) for c in contacts),
+            self._searched_columns,
+            term,
+            texts=SEARCH_TEXTS,
+            limit=limit,
+            key=given_name,
+        )
+
+    def _build_phone_index(self, contacts):
+        return build_phone_index(contacts, self._first_matched_columns, self._normalize_phone_number)
 
-            if not isinstance(column_value, list):
-                if term == str(column_value).lower():
-                    return True
-            else:
-                for item in column_value:
-                    if term == item.lower():
-                        return True
-        return False
+    def _build_search_index(self, contacts):
+        return SearchIndex(contacts, self._searched_columns, SEARCH_TEXTS)
+
+    def _cache_key(self, user_uuid, microsoft_token):
+        # Replicas are not tied to a token, their delta links are kept when the token is refreshed.
+        # Any token of the tenant can synchronize the directory.
+        if self._directory_enabled:
+            return self._directory_key, self.endpoint, None
+        return user_uuid, self.endpoint, None
+
+    def _store_key(self, cache_key):
+        # The delta links keep the fields selected by the source
+        owner, endpoint, _ = cache_key
+        return [owner, endpoint, self._select]
+
+    def _get_replica(self, user_uuid, microsoft_token, replica, state):
+        # replica and state are the result of the cache lookup of the caller
+        if state == FRESH:
+            return replica
+
+        if state == STALE:
+            # Stale contacts are served right away while they are synchronized in the background
+            self._schedule_sync(user_uuid, microsoft_token, replica)
+            return replica
+
+        if not self._directory_enabled:
+            return self._refresh_replica(user_uuid, microsoft_token, replica)
+
+        # The users of the tenant looking up a cold directory wait for the same synchronization,
+        # whichever source of the tenant they use
+        with self._cache.key_lock(self._directory_key, self.endpoint):
+            replica, state = self._cache.lookup(*self._cache_key(user_uuid, microsoft_token), count=False)
+            if state in (FRESH, STALE):
+                return replica
+            return self._refresh_replica(user_uuid, microsoft_token, replica)
+
+    def _new_replica(self):
+        return FolderReplica() if self._folders_enabled else ContactReplica()
+
+    def _refresh_replica(self, user_uuid, microsoft_token, replica):
+        if replica is None and self._store is not None:
+            replica, fresh = self._load_replica(user_uuid, microsoft_token)
+            if fresh:
+                return replica
+        return self._sync_replica(user_uuid, microsoft_token, replica or self._new_replica())
+
+    def _load_replica(self, user_uuid, microsoft_token):
+        # Another worker of the host may have synchronized the contacts, only their changes
+        # since its delta links are fetched
+        key = self._cache_key(user_uuid, microsoft_token)
+        stored = self._store.load(self._store_key(key))
+        if stored is None:
+            return None, False
+
+        cursors, contacts, age = stored
+        replica = restore_replica(self._new_replica(), cursors, contacts, self._make_contact)
+        if age >= self._cache_ttl:
+            return replica, False
+
+        self._cache.set(*key, value=replica, size=estimate_size(replica.contacts))
+        return replica, True
+
+    def _sync_replica(self, user_uuid, microsoft_token, replica):
+        version = replica.version
+        try:
+            self._synchronizer.sync(replica, microsoft_token, self.endpoint)
+        except UnexpectedEndpointException as e:
+            self._forget_refused_token(user_uuid, e)
+            raise
+
+        key = self._cache_key(user_uuid, microsoft_token)
+        size = estimate_size(replica.contacts)
+        self._cache.set(*key, value=replica, size=size)
+        REPLICA_CONTACTS.observe(len(replica), self.name)
+        if self._store is not None:
+            self._store.save(self._store_key(key), replica, changed=replica.version != version)
+        return replica
+
+    def _schedule_sync(self, user_uuid, microsoft_token, replica=None):
+        owner = self._cache_key(user_uuid, microsoft_token)[0]
+        with self._syncing_lock:
+            if owner in self._syncing:
+                return
+            self._syncing.add(owner)
+
+        try:
+            self._executor.submit(self._background_sync, user_uuid, microsoft_token, replica)
+        except RuntimeError:
+            self._syncing.discard(owner)
+            logger.debug('%s is unloaded, not synchronizing user %s', self.name, user_uuid)
+
+    def _background_sync(self, user_uuid, microsoft_token, replica):
+        try:
+            self._refresh_replica(user_uuid, microsoft_token, replica)
+        except Exception as e:
+            logger.info('Unable to synchronize the contacts of user %s: %s', user_uuid, e)
+        finally:
+            with self._syncing_lock:
+                self._syncing.discard(self._cache_key(user_uuid, microsoft_token)[0])
+
+    def _get_snapshot_path(self, directory, source_uuid):
+        # Each source has its own snapshot, named after its uuid
+        try:
+            source_uuid = uuid.UUID(str(source_uuid))
+        except ValueError:
+            logger.warning('%s has no uuid, its contacts are not kept across restarts', self.name)
+            return None
+        return os.path.join(directory, '{}.snapshot'.format(source_uuid))
+
+    def _snapshot_header(self):
+        return {'endpoint': self.endpoint, 'select': list(self._select)}
+
+    def _load_snapshot(self):
+        restored = 0
+        for owner, cursors, contacts in load_snapshot(self._snapshot_path, self._snapshot_header()):
+            replica = restore_replica(self._new_replica(), cursors, contacts, self._make_contact)
+            # Served as stale contacts, they are synchronized again on their first lookup
+            restored += self._cache.restore(freeze(owner), self.endpoint, replica, estimate_size(replica.contacts))
+        logger.info('%s contact replicas of %s restored from %s', restored, self.name, self._snapshot_path)
+
+    def _save_snapshots(self, interval):
+        while not self._snapshot_stop.wait(interval):
+            self._save_snapshot()
+
+    def _save_snapshot(self):
+        entries = []
+        for owner, endpoint, replica in self._cache.entries():
+            if endpoint != self.endpoint or not replica.synced:
+                continue
+            if self._directory_enabled and owner != self._directory_key:
+                continue
+            cursors, contacts = dump_replica(replica)
+            entries.append([owner, cursors, contacts])
+
+        try:
+            size = save_snapshot(self._snapshot_path, self._snapshot_header(), entries, self._snapshot_max_age)
+        except OSError as e:
+            logger.info('Unable to save the snapshot of %s: %s', self.name, e)
+            return
+        logger.debug('%s contact replicas of %s saved, %s bytes', len(entries), self.name, size)
+
+    def _get_contacts_by_ids(self, user_uuid, microsoft_token, unique_ids):
+        batch_size = self.office365.BATCH_SIZE
+        chunks = [unique_ids[i:i + batch_size] for i in range(0, len(unique_ids), batch_size)]
+        try:
+            results = self._gather(*(
+                self._async_office365.get_contacts_by_ids(microsoft_token, self.endpoint, chunk, self._select)
+                for chunk in chunks
+            ))
+        except UnexpectedEndpointException as e:
+            # The requests of a batch are refused one by one
+            self._forget_refused_token(user_uuid, e)
+            raise
+        return [self._make_contact(contact) for contacts in results for contact in contacts]
+
+    def _gather(self, *coroutines):
+        # Runs independent graph requests of a lookup concurrently
+        return self._bridge.run(self._async_office365.gather(*coroutines))
+
+    def _forget_refused_token(self, user_uuid, error):
+        if error.details.get('error_code') == 401:
+            logger.info('microsoft token of user %s was refused, forgetting it', user_uuid)
+            services.invalidate_microsoft_access_token(user_uuid, **self.auth)
 
     def _get_microsoft_token(self, xivo_user_uuid, token=None, **ignored):
         if not token:
             logger.debug('Unable to search through Office365 without a token.')
             raise MicrosoftTokenNotFoundException()
 
-        return services.get_microsoft_access_token(xivo_user_uuid, token, **self.auth)
+        if xivo_user_uuid in self._missing_tokens:
+            logger.debug('user %s has no microsoft token, skipping wazo-auth', xivo_user_uuid)
+            raise MicrosoftAccountNotLinkedException(xivo_user_uuid)
+
+        try:
+            return services.get_microsoft_access_token(xivo_user_uuid, token, **self.auth)
+        except MicrosoftAccountNotLinkedException:
+            self._missing_tokens.add(xivo_user_uuid)
+            raise
+
+    def cache_stats(self):
+        return dict(self._cache.stats)
+
+    def _collect_metrics(self):
+        for state, count in self.cache_stats().items():
+            CACHE_LOOKUPS.set(count, self.name, state)
+        CACHE_BYTES.set(self._cache.size, self.name)
+        CACHE_ENTRIES.set(len(self._cache), self.name)
+        for host, stats in self.office365.pool_stats().items():
+            POOL_CONNECTIONS.set(stats['connections'], self.name, host)
+            POOL_REQUESTS.set(stats['requests'], self.name, host)
+            POOL_IDLE.set(stats['idle'], self.name, host)
+            POOL_MAXSIZE.set(stats['maxsize'], self.name, host)
+
+    def _make_contact(self, change, previous=None):
+        if previous is not None and previous.unchanged_by(change):
+            # Same version in microsoft graph, the indexes do not need to be rebuilt
+            return previous
 
-    @staticmethod
-    def _update_contact_fields(contacts):
-        for contact in contacts:
-            contact.setdefault('givenName', '')
-            contact['email'] = services.get_first_email(contact)
-        return contacts
+        contact = dict(previous or {})
+        contact.update(change)
+        contact.setdefault('givenName', '')
+        # The users of the directory have a single mail
+        contact['email'] = services.get_first_email(contact) or contact.get('mail')
+        return self._ContactRecord(contact)
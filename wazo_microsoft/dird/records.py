@@ -0,0 +1,87 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import keyword
+import logging
+import sys
+
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+
+def compact(value):
+    if isinstance(value, str):
+        # Names, companies and domains repeat across the contacts of a tenant
+        return sys.intern(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(compact(item) for item in value)
+    if isinstance(value, dict):
+        return {compact(key): compact(item) for key, item in value.items()}
+    return value
+
+
+class ContactRecord(Mapping):
+
+    # A read-only contact keeping only the fields of its class, used as a mapping by the
+    # result classes and the indexes. Missing fields are left unset. The computed attributes
+    # are not part of the mapping, they are derived from the fields once, when the record is made.
+    # The etag is the version of the contact in microsoft graph.
+
+    __slots__ = ('etag',)
+    fields = ()
+    computed = {}
+    _field_set = frozenset()
+
+    def __init__(self, contact):
+        object.__setattr__(self, 'etag', contact.get('@odata.etag'))
+        for field in self.fields:
+            value = contact.get(field, self)
+            if value is not self:
+                object.__setattr__(self, field, compact(value))
+        for name, compute in self.computed.items():
+            object.__setattr__(self, name, compute(self))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('{} is read-only'.format(type(self).__name__))
+
+    def __getitem__(self, field):
+        if field not in self._field_set:
+            raise KeyError(field)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __iter__(self):
+        return (field for field in self.fields if hasattr(self, field))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+    def unchanged_by(self, change):
+        return self.etag is not None and self.etag == change.get('@odata.etag')
+
+
+def record_class(fields, computed=None, name='ContactRecord'):
+    computed = dict(computed or {})
+    unique_fields = []
+    for field in fields:
+        if field in unique_fields:
+            continue
+        if not field.isidentifier() or keyword.iskeyword(field) or hasattr(ContactRecord, field) or field in computed:
+            logger.warning('contact field %r cannot be kept, ignoring it', field)
+            continue
+        unique_fields.append(field)
+
+    fields = tuple(unique_fields)
+    namespace = {
+        '__slots__': fields + tuple(computed),
+        'fields': fields,
+        'computed': computed,
+        '_field_set': frozenset(fields),
+    }
+    return type(name, (ContactRecord,), namespace)
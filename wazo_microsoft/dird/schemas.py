@@ -2,11 +2,84 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 
-from xivo.mallow_helpers import ListSchema as _ListSchema
+from xivo.mallow_helpers import ListSchema as _ListSchema, Schema as BaseSchema
 from wazo_dird.schemas import BaseSourceSchema
 from xivo.mallow import fields
 
-from xivo.mallow.validate import Length
+from xivo.mallow.validate import Length, Range
+
+
+class CacheSchema(BaseSchema):
+
+    ttl = fields.Integer(validate=Range(min=0))
+    stale_ttl = fields.Integer(validate=Range(min=0))
+    refresh_workers = fields.Integer(validate=Range(min=1, max=64))
+    max_entries = fields.Integer(validate=Range(min=1))
+    max_bytes = fields.Integer(validate=Range(min=1))
+
+
+class MissingTokenCacheSchema(BaseSchema):
+
+    ttl = fields.Integer(validate=Range(min=0))
+    max_entries = fields.Integer(validate=Range(min=1))
+
+
+class PagingSchema(BaseSchema):
+
+    page_size = fields.Integer(validate=Range(min=1, max=1000))
+    max_pages = fields.Integer(validate=Range(min=1), allow_none=True)
+    max_bytes = fields.Integer(validate=Range(min=1), allow_none=True)
+
+
+class HTTPSchema(BaseSchema):
+
+    pool_connections = fields.Integer(validate=Range(min=1))
+    pool_maxsize = fields.Integer(validate=Range(min=1))
+    keep_alive = fields.Boolean()
+    connect_timeout = fields.Float(validate=Range(min=0))
+    read_timeout = fields.Float(validate=Range(min=0))
+    response_cache_max_bytes = fields.Integer(validate=Range(min=0))
+
+
+class ThrottlingSchema(BaseSchema):
+
+    rate = fields.Float(validate=Range(min=0), allow_none=True)
+    burst = fields.Integer(validate=Range(min=1))
+    max_retries = fields.Integer(validate=Range(min=0, max=10))
+    backoff_base = fields.Float(validate=Range(min=0))
+    backoff_max = fields.Float(validate=Range(min=0))
+    failure_threshold = fields.Integer(validate=Range(min=1))
+    reset_timeout = fields.Float(validate=Range(min=0))
+
+
+class ContactFoldersSchema(BaseSchema):
+
+    enabled = fields.Boolean()
+    recursive = fields.Boolean()
+
+
+class DirectorySchema(BaseSchema):
+
+    enabled = fields.Boolean()
+    endpoint = fields.String(validate=Length(min=1, max=255))
+
+
+class SnapshotSchema(BaseSchema):
+
+    enabled = fields.Boolean()
+    interval = fields.Integer(validate=Range(min=1))
+
+
+class StoreSchema(BaseSchema):
+
+    enabled = fields.Boolean()
+    max_bytes = fields.Integer(validate=Range(min=1))
+
+
+class PhoneIndexSchema(BaseSchema):
+
+    country_code = fields.String(validate=Length(min=1, max=4), allow_none=True)
+    national_prefix = fields.String(validate=Length(max=4))
 
 
 class SourceSchema(BaseSourceSchema):
@@ -19,6 +92,19 @@ class SourceSchema(BaseSourceSchema):
         missing='https://graph.microsoft.com/v1.0/me/contacts',
         validate=Length(min=1, max=255),
     )
+    cache = fields.Nested(CacheSchema, missing=dict)
+    contact_folders = fields.Nested(ContactFoldersSchema, missing=dict)
+    directory = fields.Nested(DirectorySchema, missing=dict)
+    missing_token_cache = fields.Nested(MissingTokenCacheSchema, missing=dict)
+    paging = fields.Nested(PagingSchema, missing=dict)
+    phone_index = fields.Nested(PhoneIndexSchema, missing=dict)
+    http = fields.Nested(HTTPSchema, missing=dict)
+    snapshot = fields.Nested(SnapshotSchema, missing=dict)
+    store = fields.Nested(StoreSchema, missing=dict)
+    throttling = fields.Nested(ThrottlingSchema, missing=dict)
+    max_concurrency = fields.Integer(validate=Range(min=1, max=64))
+    max_results = fields.Integer(validate=Range(min=1), allow_none=True)
+    select = fields.List(fields.String(validate=Length(min=1, max=128)), allow_none=True)
 
 
 class ListSchema(_ListSchema):
@@ -30,6 +116,22 @@ class ListSchema(_ListSchema):
     recurse = fields.Boolean(missing=False)
 
 
+class ContactListSchema(_ListSchema):
+
+    searchable_columns = [
+        'displayName',
+        'givenName',
+        'surname',
+        'companyName',
+        'mobilePhone',
+        'businessPhones',
+        'homePhones',
+    ]
+    sort_columns = ['displayName', 'givenName', 'surname', 'companyName']
+    default_sort_column = 'displayName'
+
+
 source_schema = SourceSchema()
 source_list_schema = SourceSchema(many=True)
 list_schema = ListSchema()
+contact_list_schema = ContactListSchema()
@@ -2,73 +2,467 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import logging
+import re
+import threading
+import time
 import uuid
 
+from urllib.parse import quote, urlencode
+
 import requests
 
+from requests.adapters import HTTPAdapter
+
 from wazo_auth_client import Client as Auth
 
-from .exceptions import MicrosoftTokenNotFoundException, UnexpectedEndpointException
+from .. import metrics
+from .exceptions import (
+    MicrosoftAccountNotLinkedException,
+    MicrosoftTokenNotFoundException,
+    SyncStateNotFoundException,
+    UnexpectedEndpointException,
+)
+from .cache import ContactCache
+from .jsonstream import GraphPage
+from .singleflight import SingleFlight
+from .throttling import CircuitOpenException, ThrottledException
 
 
 logger = logging.getLogger(__name__)
 
+GRAPH_URL_RE = re.compile(r'^(?P<root>https?://[^/]+/(?:v1\.0|beta))(?P<path>/[^?]*)')
+
+GRAPH_REQUEST_DURATION = metrics.histogram(
+    'office365_graph_request_duration_seconds',
+    'Duration of the microsoft graph requests until their response headers, by status',
+    ['method', 'status'],
+)
+GRAPH_RESPONSE_BYTES = metrics.counter(
+    'office365_graph_response_bytes_total',
+    'Bytes of the pages received from microsoft graph',
+)
+TOKEN_FETCH_DURATION = metrics.histogram(
+    'office365_token_fetch_duration_seconds',
+    'Duration of the microsoft token requests to wazo-auth',
+    ['result'],
+)
+TOKEN_LOOKUPS = metrics.counter(
+    'office365_token_lookups_total',
+    'Microsoft tokens of the lookups, cached or fetched from wazo-auth',
+    ['result'],
+)
+
+
+def batch_endpoint(url):
+    match = GRAPH_URL_RE.match(url)
+    if not match:
+        return None, None
+    return '{}/$batch'.format(match.group('root')), match.group('path').rstrip('/')
+
 
 class Office365Service:
 
     USER_AGENT = 'wazo_ua/1.0'
+    BATCH_SIZE = 20
+    CHUNK_SIZE = 64 * 1024
 
-    def get_contacts_with_term(self, microsoft_token, term, url):
-        headers = self.headers(microsoft_token)
-        query_params = {
-            "search": term
-        }
+    def __init__(
+        self,
+        page_size=100,
+        max_pages=None,
+        max_bytes=None,
+        pool_connections=10,
+        pool_maxsize=10,
+        keep_alive=True,
+        connect_timeout=5,
+        read_timeout=10,
+        response_cache_max_bytes=8 * 1024 * 1024,
+        throttler=None,
+    ):
+        self._page_size = page_size
+        self._max_pages = max_pages
+        self._max_bytes = max_bytes
+        self._keep_alive = keep_alive
+        self._timeout = (connect_timeout, read_timeout)
+        self._throttler = throttler
+        # Last known pages and their ETag, revalidated with If-None-Match. They never expire,
+        # they are only evicted to stay within the size limit.
+        self._responses = ContactCache(ttl=0, max_entries=1000, max_bytes=response_cache_max_bytes)
+
+        # Sessions are not thread safe but the connection pools of an adapter are
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self._local = threading.local()
+        self._in_flight = SingleFlight()
+
+    def close(self):
+        self._adapter.close()
+
+    def pool_stats(self):
+        stats = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['{}://{}:{}'.format(pool.scheme, pool.host, pool.port)] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool else 0,
+                'maxsize': pool.pool.maxsize if pool.pool else 0,
+            }
+        return stats
+
+    def get_contacts_with_term(self, microsoft_token, term, url, select=None):
         try:
-            response = requests.get(url, headers=headers, params=query_params)
-            if response.status_code == 200:
-                logger.debug('Sucessfully fetched contacts from microsoft.')
-                return response.json().get('value', [])
-            else:
-                return []
-        except requests.exceptions.RequestException as e:
-            logger.error('Unable to get contacts from this endpoint: %s, error : %s', url, e)
+            contacts = self._fetch_contacts(microsoft_token, url, self._query(select, search=term))
+            logger.debug('Sucessfully fetched contacts from microsoft.')
+            return contacts
+        except UnexpectedEndpointException as e:
+            logger.error('Unable to get contacts from this endpoint: %s, error : %s', url, e.details)
             return []
 
-    def get_contacts(self, microsoft_token, url):
+    def get_contacts(self, microsoft_token, url, select=None):
+        contacts = self._fetch_contacts(microsoft_token, url, self._query(select))
+        logger.debug('Successfully fetched contacts from microsoft.')
+        return contacts
+
+    def _fetch_contacts(self, microsoft_token, url, query_params=None):
+        # Concurrent identical requests share a single call and its result, which must not be modified
+        key = ('contacts', microsoft_token, url, tuple(sorted((query_params or {}).items())))
+        return self._in_flight.do(key, self._list_contacts, microsoft_token, url, query_params)
+
+    def _list_contacts(self, microsoft_token, url, query_params):
+        return list(self.iter_contacts(microsoft_token, url, query_params))
+
+    def find_contacts_with_term(self, microsoft_token, term, url, find, select=None, find_key=None):
+        # The contacts are given to find as they are received. Concurrent identical searches share
+        # a single call and the contacts it found, which must not be modified.
+        query_params = self._query(select, search=term)
+        key = ('contacts', microsoft_token, url, tuple(sorted(query_params.items())), find_key)
+        return self._in_flight.do(key, self._find_contacts, microsoft_token, url, query_params, find)
+
+    def _find_contacts(self, microsoft_token, url, query_params, find):
+        return find(self.iter_contacts(microsoft_token, url, query_params))
+
+    def iter_contacts(self, microsoft_token, url, query_params=None):
+        headers = self.headers(microsoft_token)
+        query_params = dict(query_params or {})
+        if self._page_size:
+            query_params['$top'] = self._page_size
+
+        pages = 0
+        received_bytes = 0
+        while url:
+            if self._max_pages and pages >= self._max_pages:
+                logger.warning('Stopped fetching contacts from %s after %s pages', url, pages)
+                return
+
+            page = self._get_page(url, headers, query_params, conditional=True)
+            pages += 1
+            yield from page
+            received_bytes += page.size
+
+            if self._max_bytes and received_bytes >= self._max_bytes:
+                logger.warning('Stopped fetching contacts from %s after %s bytes', url, received_bytes)
+                return
+
+            # The next link already contains the query string of the original request
+            url = page.properties.get('@odata.nextLink')
+            query_params = None
+
+    def get_contact_folders(self, microsoft_token, url, recursive=False):
+        folder_ids = []
+        urls = [url]
+        while urls:
+            parent_url = urls.pop(0)
+            for folder in self.iter_contacts(microsoft_token, parent_url, {'$select': 'id'}):
+                folder_ids.append(folder['id'])
+                if recursive:
+                    urls.append('{}/{}/childFolders'.format(url, quote(folder['id'], safe='')))
+        return folder_ids
+
+    def get_contact_folder_id(self, microsoft_token, url):
+        # The folder of the contacts of an endpoint, known from any of its contacts
+        page = self._get_page(url, self.headers(microsoft_token), {'$top': 1, '$select': 'parentFolderId'})
+        contacts = list(page)
+        return contacts[0].get('parentFolderId') if contacts else None
+
+    def get_contacts_by_ids(self, microsoft_token, url, contact_ids, select=None):
+        batch_url, path = batch_endpoint(url)
+        if batch_url is None:
+            raise UnexpectedEndpointException(endpoint=url, error='no $batch endpoint')
+
+        query = '?{}'.format(urlencode(self._query(select), safe='$,')) if select else ''
+        contacts = []
+        for start in range(0, len(contact_ids), self.BATCH_SIZE):
+            chunk = contact_ids[start:start + self.BATCH_SIZE]
+            body = {
+                'requests': [
+                    {'id': str(i), 'method': 'GET', 'url': '{}/{}{}'.format(path, quote(contact_id, safe=''), query)}
+                    for i, contact_id in enumerate(chunk)
+                ]
+            }
+            responses = self._post(batch_url, self.headers(microsoft_token), body).get('responses', [])
+            for response in sorted(responses, key=lambda response: int(response.get('id', 0))):
+                status = response.get('status')
+                if status == 200:
+                    contacts.append(response['body'])
+                elif status == 404:
+                    logger.debug('contact %s no longer exists', chunk[int(response['id'])])
+                else:
+                    raise UnexpectedEndpointException(endpoint=batch_url, error_code=status)
+        return contacts
+
+    def get_delta(self, microsoft_token, url, select=None):
+        key = ('delta', microsoft_token, url, tuple(select or ()))
+        return self._in_flight.do(key, self._get_delta, microsoft_token, url, self._query(select))
+
+    def _get_delta(self, microsoft_token, url, query_params):
         headers = self.headers(microsoft_token)
+        if self._page_size:
+            headers['Prefer'] = 'odata.maxpagesize={}'.format(self._page_size)
+
+        changes = []
+        while url:
+            try:
+                page = self._get_page(url, headers, query_params or None)
+            except UnexpectedEndpointException as e:
+                if e.details.get('error_code') == 410:
+                    raise SyncStateNotFoundException(url)
+                raise
+
+            changes.extend(page)
+            if '@odata.deltaLink' in page.properties:
+                return changes, page.properties['@odata.deltaLink']
+            url = page.properties.get('@odata.nextLink')
+            query_params = None
+
+        return changes, None
+
+    @staticmethod
+    def _query(select, **query_params):
+        if select:
+            query_params['$select'] = ','.join(select)
+        return query_params
+
+    def _post(self, url, headers, body):
+        try:
+            response = self._send(
+                url, self._get_session().post, url, headers=headers, json=body, timeout=self._timeout,
+            )
+        except requests.exceptions.RequestException:
+            raise UnexpectedEndpointException(endpoint=url)
+
+        if response.status_code != 200:
+            logger.error('An error occured while posting to microsoft endpoint')
+            raise UnexpectedEndpointException(endpoint=url, error_code=response.status_code)
+
+        return response.json()
+
+    def _get_page(self, url, headers, query_params, conditional=False):
+        cache_key = (url, tuple(sorted((query_params or {}).items())))
+        cached = None
+        if conditional:
+            cached, _ = self._responses.lookup(headers['Authorization'], cache_key, headers['Authorization'])
+            if cached:
+                headers = dict(headers, **{'If-None-Match': cached[0]})
+
+        try:
+            response = self._send(
+                url,
+                self._get_session().get,
+                url,
+                headers=headers,
+                params=query_params,
+                timeout=self._timeout,
+                stream=True,
+            )
+        except requests.exceptions.RequestException:
+            raise UnexpectedEndpointException(endpoint=url)
+
+        if response.status_code == 304 and cached:
+            response.close()
+            logger.debug('%s is unchanged, using the last known response', url)
+            return GraphPage(cached[1])
+
+        if response.status_code != 200:
+            response.close()
+            logger.error('An error occured while fetching information from microsoft endpoint')
+            raise UnexpectedEndpointException(endpoint=url, error_code=response.status_code)
+
+        # The contacts are parsed as they are received instead of loading the whole page
+        chunks = self._read(url, response)
+        etag = response.headers.get('ETag')
+        if conditional and etag:
+            chunks = self._keep_response(headers['Authorization'], cache_key, etag, chunks)
+        return GraphPage(chunks)
+
+    def _keep_response(self, authorization, cache_key, etag, chunks):
+        received = []
+        for chunk in chunks:
+            received.append(chunk)
+            yield chunk
+        # Only complete responses are kept
+        received = tuple(received)
+        size = sum(len(chunk) for chunk in received)
+        self._responses.set(authorization, cache_key, authorization, (etag, received), size=size)
+
+    def _read(self, url, response):
         try:
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                logger.debug('Successfully fetched contacts from microsoft.')
-                return response.json().get('value', [])
-            else:
-                logger.error('An error occured while fetching information from microsoft endpoint')
-                raise UnexpectedEndpointException(endpoint=url, error_code=response.status_code)
+            for chunk in response.iter_content(self.CHUNK_SIZE):
+                GRAPH_RESPONSE_BYTES.inc(amount=len(chunk))
+                yield chunk
         except requests.exceptions.RequestException:
             raise UnexpectedEndpointException(endpoint=url)
+        finally:
+            response.close()
+
+    def _send(self, url, method, *args, **kwargs):
+        method_name = getattr(method, '__name__', 'request').upper()
+
+        def send():
+            # Every attempt is measured, the retries of the throttler included
+            start = time.monotonic()
+            status = 'error'
+            try:
+                response = method(*args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                GRAPH_REQUEST_DURATION.observe(time.monotonic() - start, method_name, status)
+
+        if self._throttler is None:
+            return send()
+
+        try:
+            return self._throttler.call(send)
+        except ThrottledException:
+            logger.info('Skipped request to %s, microsoft graph asked the tenant to wait', url)
+            raise UnexpectedEndpointException(endpoint=url, error='throttled')
+        except CircuitOpenException:
+            logger.info('Skipped request to %s, microsoft graph is unhealthy', url)
+            raise UnexpectedEndpointException(endpoint=url, error='circuit open')
+
+    def _get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+        return session
 
     def headers(self, microsoft_token):
         return {
             'User-Agent': self.USER_AGENT,
             'Authorization': 'Bearer {0}'.format(microsoft_token),
             'Accept': 'application/json',
+            'Connection': 'keep-alive' if self._keep_alive else 'close',
             'client-request-id': str(uuid.uuid4),
             'return-client-request-id': 'true'
         }
 
 
+class Office365ServiceRegistry:
+
+    def __init__(self):
+        self._services = {}
+        self._lock = threading.Lock()
+
+    def get(self, source_uuid, **config):
+        with self._lock:
+            known_config, service = self._services.get(source_uuid, (None, None))
+            if service is None or known_config != config:
+                if service is not None:
+                    service.close()
+                service = Office365Service(**config)
+                self._services[source_uuid] = (config, service)
+            return service
+
+
+class MicrosoftTokenCache:
+
+    # Tokens are refreshed by wazo-auth 30 seconds before they expire
+    EXPIRATION_MARGIN = 60
+
+    def __init__(self):
+        self._tokens = {}
+        self._local = threading.local()
+
+    def get(self, user_uuid, wazo_token, **auth_config):
+        key = self._key(user_uuid, auth_config)
+        cached = self._tokens.get(key)
+        if cached and cached[1] - self.EXPIRATION_MARGIN > time.time():
+            TOKEN_LOOKUPS.inc('cached')
+            return cached[0]
+
+        TOKEN_LOOKUPS.inc('fetched')
+        start = time.monotonic()
+        data = None
+        try:
+            data = self._fetch(user_uuid, wazo_token, auth_config)
+        finally:
+            TOKEN_FETCH_DURATION.observe(time.monotonic() - start, 'success' if data is not None else 'error')
+        if data is None:
+            return None
+
+        access_token = data.get('access_token')
+        expiration = data.get('token_expiration')
+        if access_token and expiration:
+            self._tokens[key] = (access_token, expiration)
+        return access_token
+
+    def invalidate(self, user_uuid, **auth_config):
+        self._tokens.pop(self._key(user_uuid, auth_config), None)
+
+    def clear(self):
+        self._tokens.clear()
+
+    def _fetch(self, user_uuid, wazo_token, auth_config):
+        try:
+            auth = self._get_client(auth_config)
+            auth.set_token(wazo_token)
+            return auth.external.get('microsoft', user_uuid)
+        except requests.HTTPError as e:
+            logger.error('Microsoft token could not be fetched from wazo-auth, error %s', e)
+            if e.response is not None and e.response.status_code == 404:
+                raise MicrosoftAccountNotLinkedException(user_uuid)
+            raise MicrosoftTokenNotFoundException(user_uuid)
+        except requests.exceptions.ConnectionError as e:
+            logger.error('Unable to connect auth-client for the given parameters: %s, error :%s.', auth_config, e)
+            raise MicrosoftTokenNotFoundException(user_uuid)
+        except requests.exceptions.RequestException as e:
+            logger.error('Error occured while connecting to wazo-auth, error :%s', e)
+
+    def _get_client(self, auth_config):
+        # Clients hold the token of their caller, they are kept per thread
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+
+        key = self._freeze(auth_config)
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = Auth(**auth_config)
+        return client
+
+    @classmethod
+    def _key(cls, user_uuid, auth_config):
+        return str(user_uuid), cls._freeze(auth_config)
+
+    @staticmethod
+    def _freeze(auth_config):
+        return tuple(sorted(auth_config.items()))
+
+
+_token_cache = MicrosoftTokenCache()
+
+
 def get_microsoft_access_token(user_uuid, wazo_token, **auth_config):
-    try:
-        auth = Auth(token=wazo_token, **auth_config)
-        return auth.external.get('microsoft', user_uuid).get('access_token')
-    except requests.HTTPError as e:
-        logger.error('Microsoft token could not be fetched from wazo-auth, error %s', e)
-        raise MicrosoftTokenNotFoundException(user_uuid)
-    except requests.exceptions.ConnectionError as e:
-        logger.error('Unable to connect auth-client for the given parameters: %s, error :%s.', auth_config, e)
-        raise MicrosoftTokenNotFoundException(user_uuid)
-    except requests.exceptions.RequestException as e:
-        logger.error('Error occured while connecting to wazo-auth, error :%s', e)
+    return _token_cache.get(user_uuid, wazo_token, **auth_config)
+
+
+def invalidate_microsoft_access_token(user_uuid, **auth_config):
+    _token_cache.invalidate(user_uuid, **auth_config)
 
 
 def get_first_email(contact_information):
@@ -0,0 +1,291 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+from .sync import FolderReplica
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+SNAPSHOT_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS replicas (
+    key TEXT PRIMARY KEY,
+    cursors TEXT NOT NULL,
+    contacts BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS replicas_updated ON replicas (updated);
+'''
+
+
+def dump_replica(replica, contacts=True):
+    # The delta links and the contacts of each folder, a ContactReplica is a single folder
+    if isinstance(replica, FolderReplica):
+        folders = list(replica.replicas.items())
+    else:
+        folders = [(None, replica)]
+
+    cursors = [[endpoint, folder.delta_link] for endpoint, folder in folders]
+    if not contacts:
+        return cursors, None
+    return cursors, [[endpoint, [dump_contact(c) for c in folder.contacts]] for endpoint, folder in folders]
+
+
+def dump_contact(contact):
+    values = dict(contact)
+    etag = getattr(contact, 'etag', None)
+    if etag is not None:
+        values['@odata.etag'] = etag
+    return values
+
+
+def restore_replica(replica, cursors, contacts, make_contact=None):
+    delta_links = dict((endpoint, delta_link) for endpoint, delta_link in cursors)
+    if isinstance(replica, FolderReplica):
+        replica.set_endpoints([endpoint for endpoint, _ in contacts])
+        folders = replica.replicas
+    else:
+        folders = {None: replica}
+
+    for endpoint, folder_contacts in contacts:
+        folder = folders.get(endpoint)
+        if folder is None:
+            continue
+        folder.apply(folder_contacts, make_contact)
+        folder.delta_link = delta_links.get(endpoint)
+    return replica
+
+
+def save_snapshot(path, header, entries, max_age=None):
+    # Every worker of the host saves the replicas it holds in the same snapshot, one at a time.
+    # The entries of the other workers are kept until none of them saved them for max_age.
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    now = time.time()
+    with open('{}.lock'.format(path), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        saved = [[owner, cursors, contacts, now] for owner, cursors, contacts in entries]
+        owners = set(json.dumps(owner) for owner, _, _, _ in saved)
+        for entry in _read_snapshot(path, header):
+            owner, _, _, saved_at = entry
+            if json.dumps(owner) in owners or (max_age is not None and now - saved_at > max_age):
+                continue
+            saved.append(entry)
+
+        snapshot = {'version': SNAPSHOT_VERSION, 'header': header, 'entries': saved}
+        data = zlib.compress(json.dumps(snapshot, separators=(',', ':')).encode('utf-8'))
+        _write_file(path, data)
+    return len(data)
+
+
+def _write_file(path, data):
+    # Written to a file of its own then renamed, a snapshot is never read half written
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def load_snapshot(path, header):
+    # The entries of a snapshot written by the same version with the same header, or nothing
+    return [[owner, cursors, contacts] for owner, cursors, contacts, _ in _read_snapshot(path, header)]
+
+
+def _read_snapshot(path, header):
+    try:
+        with open(path, 'rb') as f:
+            snapshot = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+    except FileNotFoundError:
+        return []
+    except (OSError, zlib.error, ValueError) as e:
+        logger.info('ignoring the unreadable snapshot %s: %s', path, e)
+        return []
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('header') != header:
+        logger.info('ignoring the snapshot %s of another configuration', path)
+        return []
+    return snapshot.get('entries', [])
+
+
+@contextmanager
+def transaction(connection):
+    # The write lock of the database is taken at the start of the transaction
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+        connection.execute('COMMIT')
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        raise
+
+
+def freeze(value):
+    # Keys of the cache stored as json lists
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class ContactStore:
+
+    # Replicas and delta links shared by the dird workers of a host, in a sqlite database in
+    # WAL mode: every worker reads while another one writes the contacts it synchronized. It is
+    # a cache, a database of another schema version is emptied and the least recently
+    # synchronized replicas are removed past max_bytes.
+
+    def __init__(self, path, max_bytes, busy_timeout=5):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._busy_timeout = busy_timeout
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def load(self, key):
+        # Returns the delta links, the contacts and the age of the replica, or None
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT cursors, contacts, updated FROM replicas WHERE key = ?',
+                    (self._key(key),),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.info('unable to read the contact store %s: %s', self._path, e)
+            return None
+
+        if row is None:
+            return None
+
+        cursors, contacts, updated = row
+        try:
+            contacts = json.loads(zlib.decompress(contacts).decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            logger.info('ignoring corrupted contacts in the contact store %s: %s', self._path, e)
+            return None
+        return json.loads(cursors), contacts, max(time.time() - updated, 0)
+
+    def save(self, key, replica, changed=True):
+        # Only the delta links are written when the contacts did not change, unless the replica
+        # is not in the store, e.g. it was removed past max_bytes or restored from a snapshot
+        key = self._key(key)
+        now = time.time()
+        try:
+            with self._lock:
+                connection = self._connect()
+                with transaction(connection):
+                    if not changed:
+                        cursors, _ = dump_replica(replica, contacts=False)
+                        updated = connection.execute(
+                            'UPDATE replicas SET cursors = ?, updated = ? WHERE key = ?',
+                            (json.dumps(cursors), now, key),
+                        ).rowcount
+                        if updated:
+                            return
+
+                    self._write(connection, key, replica, now)
+        except sqlite3.Error as e:
+            logger.info('unable to write the contact store %s: %s', self._path, e)
+
+    def _write(self, connection, key, replica, now):
+        cursors, contacts = dump_replica(replica)
+        cursors = json.dumps(cursors)
+        blob = zlib.compress(json.dumps(contacts, separators=(',', ':')).encode('utf-8'))
+        size = len(blob) + len(cursors)
+        if size > self._max_bytes:
+            logger.info('contacts of %s exceed the contact store size limit', key)
+            connection.execute('DELETE FROM replicas WHERE key = ?', (key,))
+            return
+
+        connection.execute(
+            'INSERT OR REPLACE INTO replicas (key, cursors, contacts, size, updated) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, cursors, blob, size, now),
+        )
+        self._evict(connection)
+
+    def size(self):
+        with self._lock:
+            return self._connect().execute('SELECT COALESCE(SUM(size), 0) FROM replicas').fetchone()[0]
+
+    def _evict(self, connection):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM replicas').fetchone()[0]
+        if total <= self._max_bytes:
+            return
+
+        rows = connection.execute('SELECT key, size FROM replicas ORDER BY updated').fetchall()
+        for key, size in rows:
+            if total <= self._max_bytes:
+                break
+            connection.execute('DELETE FROM replicas WHERE key = ?', (key,))
+            total -= size
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The transactions are explicit, sqlite3 would otherwise commit before the schema changes
+        connection = sqlite3.connect(
+            self._path, timeout=self._busy_timeout, check_same_thread=False, isolation_level=None,
+        )
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            # The workers starting together create the schema one at a time
+            with transaction(connection):
+                version = connection.execute('PRAGMA user_version').fetchone()[0]
+                if version != SCHEMA_VERSION:
+                    if version:
+                        logger.info('contact store %s has schema version %s, emptying it', self._path, version)
+                    connection.execute('DROP TABLE IF EXISTS replicas')
+                    for statement in SCHEMA.split(';'):
+                        if statement.strip():
+                            connection.execute(statement)
+                    connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        except sqlite3.Error:
+            connection.close()
+            raise
+        self._connection = connection
+        return connection
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key, separators=(',', ':'))
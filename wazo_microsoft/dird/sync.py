@@ -0,0 +1,301 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import threading
+
+from collections import OrderedDict
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from .exceptions import (
+    DeltaNotSupportedException,
+    SyncStateNotFoundException,
+    UnexpectedEndpointException,
+)
+
+logger = logging.getLogger(__name__)
+
+# Delta link of the replicas of an endpoint without delta queries, each synchronization fetches
+# every contact of the endpoint
+NO_DELTA_LINK = ''
+
+DELTA_NOT_SUPPORTED_STATUS = (400, 404, 405, 501)
+# Client errors of a stored delta link that the same request would get again, e.g. the account
+# was linked to another microsoft user or the default contacts folder changed
+TRANSIENT_CLIENT_ERROR_STATUS = (401, 408, 429)
+
+
+def delta_url(endpoint):
+    scheme, netloc, path, query, fragment = urlsplit(endpoint)
+    return urlunsplit((scheme, netloc, '{}/delta'.format(path.rstrip('/')), query, fragment))
+
+
+def is_default_folder(endpoint):
+    # /me/contacts and /users/{id}/contacts, microsoft graph only supports delta queries on
+    # the contacts of a contact folder
+    segments = urlsplit(endpoint).path.rstrip('/').split('/')
+    return segments[-1] == 'contacts' and 'contactFolders' not in segments
+
+
+class ContactReplica:
+
+    def __init__(self):
+        self.delta_link = None
+        self.version = 0
+        self.lock = threading.Lock()
+        self._contacts = {}
+        self._snapshot = ()
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    @property
+    def contacts(self):
+        # An immutable snapshot that can be read without holding the lock
+        return self._snapshot
+
+    @property
+    def synced(self):
+        return self.delta_link is not None
+
+    def get(self, contact_id):
+        return self._contacts.get(contact_id)
+
+    def get_index(self, name, build):
+        # The version is read before the contacts to never tag an index with a newer version
+        version = self.version
+        indexed_version, index = self._indexes.get(name, (None, None))
+        if indexed_version != version:
+            index = build(self.contacts)
+            self._indexes[name] = (version, index)
+        return index
+
+    def apply(self, changes, make_contact=None):
+        changed = False
+        for change in changes:
+            contact_id = change.get('id')
+            if contact_id is None:
+                continue
+
+            if '@removed' in change:
+                changed |= self._contacts.pop(contact_id, None) is not None
+                continue
+
+            # Contacts are replaced, never modified, snapshots can still be using them
+            previous = self._contacts.get(contact_id)
+            if make_contact:
+                contact = make_contact(change, previous)
+            else:
+                contact = dict(previous or {})
+                contact.update(change)
+            if contact is previous:
+                continue
+            self._contacts[contact_id] = contact
+            changed = True
+
+        if changed:
+            self._snapshot = tuple(self._contacts.values())
+            self.version += 1
+        return changed
+
+    def reset(self):
+        if not self._contacts and self.delta_link is None:
+            return
+        self.delta_link = None
+        self._contacts = {}
+        self._snapshot = ()
+        self.version += 1
+
+
+class FolderReplica:
+
+    # The contacts of several contact folders, each synchronized in its own replica, merged
+    # and de-duplicated by id. It is used by the lookups like a single ContactReplica.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.replicas = OrderedDict()
+        self._generation = 0
+        self._merged_version = None
+        self._snapshot = ()
+        self._contacts = {}
+        self._indexes = {}
+
+    def __len__(self):
+        return len(self.contacts)
+
+    @property
+    def version(self):
+        # Replica versions only increase, the generation counts the added and removed folders
+        return self._generation + sum(replica.version for replica in list(self.replicas.values()))
+
+    @property
+    def synced(self):
+        return bool(self.replicas) and all(replica.synced for replica in self.replicas.values())
+
+    @property
+    def contacts(self):
+        self._merge()
+        return self._snapshot
+
+    def get(self, contact_id):
+        self._merge()
+        return self._contacts.get(contact_id)
+
+    def get_index(self, name, build):
+        version = self.version
+        indexed_version, index = self._indexes.get(name, (None, None))
+        if indexed_version != version:
+            index = build(self.contacts)
+            self._indexes[name] = (version, index)
+        return index
+
+    def set_endpoints(self, endpoints):
+        for endpoint in list(self.replicas):
+            if endpoint not in endpoints:
+                logger.debug('contact folder %s was removed', endpoint)
+                # The version must keep increasing without the versions of the removed folder
+                self._generation += self.replicas.pop(endpoint).version + 1
+
+        for endpoint in endpoints:
+            if endpoint not in self.replicas:
+                self.replicas[endpoint] = ContactReplica()
+                self._generation += 1
+
+    def _merge(self):
+        version = self.version
+        if self._merged_version == version:
+            return
+
+        contacts = {}
+        for replica in list(self.replicas.values()):
+            for contact in replica.contacts:
+                # The first folder wins, the default contacts folder is the first one
+                contacts.setdefault(contact['id'], contact)
+        self._contacts = contacts
+        self._snapshot = tuple(contacts.values())
+        self._merged_version = version
+
+
+class DeltaSynchronizer:
+
+    def __init__(self, office365, make_contact=None, select=None):
+        self._office365 = office365
+        self._make_contact = make_contact
+        self._select = select
+
+    def sync(self, replica, microsoft_token, endpoint):
+        with replica.lock:
+            if not replica.synced:
+                replica.reset()
+
+            if replica.delta_link == NO_DELTA_LINK:
+                return self._sync_all(replica, microsoft_token, endpoint)
+
+            try:
+                try:
+                    changes, delta_link = self._get_delta(replica, microsoft_token, endpoint)
+                except SyncStateNotFoundException:
+                    logger.info('delta link of %s is no longer valid, synchronizing every contact again', endpoint)
+                    replica.reset()
+                    changes, delta_link = self._get_delta(replica, microsoft_token, endpoint)
+            except DeltaNotSupportedException as e:
+                logger.info('%s does not support delta queries, fetching every contact instead', e.url)
+                return self._sync_all(replica, microsoft_token, endpoint)
+
+            changed = replica.apply(changes, self._make_contact)
+            replica.delta_link = delta_link
+            logger.debug('%s changes applied from %s', len(changes), endpoint)
+            return changed
+
+    def _get_delta(self, replica, microsoft_token, endpoint):
+        if replica.delta_link:
+            # The delta link keeps the query of the first request
+            try:
+                return self._office365.get_delta(microsoft_token, replica.delta_link)
+            except UnexpectedEndpointException as e:
+                error_code = e.details.get('error_code')
+                if error_code and 400 <= error_code < 500 and error_code not in TRANSIENT_CLIENT_ERROR_STATUS:
+                    raise SyncStateNotFoundException(replica.delta_link)
+                raise
+
+        url = self._delta_url(microsoft_token, endpoint)
+        if url is None:
+            # The default contacts folder is empty, it is looked up again on the next sync
+            logger.debug('%s has no contacts, no contact folder to synchronize', endpoint)
+            return [], None
+
+        try:
+            return self._office365.get_delta(microsoft_token, url, select=self._select)
+        except UnexpectedEndpointException as e:
+            if e.details.get('error_code') in DELTA_NOT_SUPPORTED_STATUS:
+                raise DeltaNotSupportedException(url)
+            raise
+
+    def _delta_url(self, microsoft_token, endpoint):
+        if not is_default_folder(endpoint):
+            return delta_url(endpoint)
+
+        # The default contacts folder is only known by the folder of its contacts
+        folder_id = self._office365.get_contact_folder_id(microsoft_token, endpoint)
+        if folder_id is None:
+            return None
+        return delta_url(folder_contacts_url(endpoint, folder_id))
+
+    def _sync_all(self, replica, microsoft_token, endpoint):
+        contacts = self._office365.get_contacts(microsoft_token, endpoint, select=self._select)
+        contact_ids = set(contact.get('id') for contact in contacts)
+        removed = [
+            {'id': contact['id'], '@removed': {}} for contact in replica.contacts if contact['id'] not in contact_ids
+        ]
+        changed = replica.apply(list(contacts) + removed, self._make_contact)
+        replica.delta_link = NO_DELTA_LINK
+        logger.debug('%s contacts fetched from %s', len(contacts), endpoint)
+        return changed
+
+
+class FolderSynchronizer:
+
+    def __init__(self, office365, synchronizer, async_office365, bridge, recursive=False):
+        self._office365 = office365
+        self._synchronizer = synchronizer
+        self._async_office365 = async_office365
+        self._bridge = bridge
+        self._recursive = recursive
+
+    def sync(self, replica, microsoft_token, endpoint):
+        with replica.lock:
+            folders_url = contact_folders_url(endpoint)
+            folder_ids = self._office365.get_contact_folders(microsoft_token, folders_url, self._recursive)
+            endpoints = [endpoint] + [folder_contacts_url(endpoint, folder_id) for folder_id in folder_ids]
+            replica.set_endpoints(endpoints)
+
+            # Every folder is synchronized concurrently, the first error is raised once they are done
+            results = self._bridge.run(self._async_office365.gather(
+                *(
+                    self._async_office365.sync(self._synchronizer, folder_replica, microsoft_token, folder_endpoint)
+                    for folder_endpoint, folder_replica in replica.replicas.items()
+                ),
+                return_exceptions=True
+            ))
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            logger.debug('%s contact folders synchronized from %s', len(endpoints), endpoint)
+            return any(results)
+
+
+def contact_folders_url(endpoint):
+    # The folders are next to the default contacts folder, e.g. /me/contacts and /me/contactFolders
+    scheme, netloc, path, _, _ = urlsplit(endpoint)
+    base, _, _ = path.rstrip('/').rpartition('/')
+    return urlunsplit((scheme, netloc, '{}/contactFolders'.format(base), '', ''))
+
+
+def folder_contacts_url(endpoint, folder_id):
+    # The contacts of a folder are queried like the contacts of the endpoint
+    scheme, netloc, _, query, _ = urlsplit(endpoint)
+    folders_url = urlsplit(contact_folders_url(endpoint))
+    path = '{}/{}/contacts'.format(folders_url.path, quote(folder_id, safe=''))
+    return urlunsplit((scheme, netloc, path, query, ''))
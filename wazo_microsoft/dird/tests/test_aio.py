@@ -0,0 +1,85 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import threading
+
+from unittest import TestCase
+from mock import Mock
+
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    equal_to,
+    raises,
+)
+
+from ..aio import AsyncBridge, AsyncOffice365Service
+
+
+class TestAsyncOffice365Service(TestCase):
+
+    def setUp(self):
+        self.office365 = Mock()
+        self.bridge = AsyncBridge()
+        self.addCleanup(self.bridge.stop)
+
+    def test_that_calls_are_forwarded(self):
+        self.office365.get_contacts_by_ids.return_value = [{'id': 'mario'}]
+        service = AsyncOffice365Service(self.office365)
+
+        result = self.bridge.run(service.get_contacts_by_ids('token', 'url', ['mario']), timeout=5)
+
+        assert_that(result, contains({'id': 'mario'}))
+        self.office365.get_contacts_by_ids.assert_called_once_with('token', 'url', ['mario'], select=None)
+
+    def test_that_gathered_calls_overlap(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def get_contacts_by_ids(token, url, contact_ids, select=None):
+            barrier.wait()
+            return contact_ids
+
+        self.office365.get_contacts_by_ids.side_effect = get_contacts_by_ids
+        service = AsyncOffice365Service(self.office365, max_concurrency=3)
+
+        results = self.bridge.run(service.gather(
+            service.get_contacts_by_ids('token', 'url', ['a']),
+            service.get_contacts_by_ids('token', 'url', ['b']),
+            service.get_contacts_by_ids('token', 'url', ['c']),
+        ), timeout=5)
+
+        assert_that(results, equal_to([['a'], ['b'], ['c']]))
+
+    def test_that_synchronizations_run_on_the_service(self):
+        synchronizer = Mock()
+        synchronizer.sync.return_value = True
+        service = AsyncOffice365Service(self.office365)
+
+        result = self.bridge.run(service.sync(synchronizer, 'replica', 'token', 'url'), timeout=5)
+
+        assert_that(result, equal_to(True))
+        synchronizer.sync.assert_called_once_with('replica', 'token', 'url')
+
+    def test_that_errors_are_raised_to_the_caller(self):
+        self.office365.get_contacts_by_ids.side_effect = ValueError()
+        service = AsyncOffice365Service(self.office365)
+
+        assert_that(
+            calling(self.bridge.run).with_args(service.get_contacts_by_ids('token', 'url', ['a']), timeout=5),
+            raises(ValueError),
+        )
+
+
+class TestAsyncBridge(TestCase):
+
+    def test_that_the_bridge_can_be_restarted(self):
+        bridge = AsyncBridge()
+
+        async def answer():
+            return 42
+
+        assert_that(bridge.run(answer(), timeout=5), equal_to(42))
+        bridge.stop()
+        assert_that(bridge.run(answer(), timeout=5), equal_to(42))
+        bridge.stop()
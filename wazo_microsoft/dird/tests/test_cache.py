@@ -0,0 +1,190 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+from mock import patch
+
+from hamcrest import (
+    assert_that,
+    equal_to,
+    has_entries,
+    none,
+    not_,
+    same_instance,
+)
+
+from ..cache import (
+    EXPIRED,
+    FRESH,
+    MISS,
+    STALE,
+    ContactCache,
+    ExpiringSet,
+    estimate_size,
+)
+
+
+class TestContactCache(TestCase):
+
+    def setUp(self):
+        self.cache = ContactCache(ttl=10, max_entries=2, max_bytes=1024 * 1024)
+
+    def test_get_unknown(self):
+        assert_that(self.cache.get('user', 'endpoint', 'token'), none())
+
+    def test_set_then_get(self):
+        contacts = [{'id': 'mario'}]
+
+        self.cache.set('user', 'endpoint', 'token', contacts)
+
+        assert_that(self.cache.get('user', 'endpoint', 'token'), equal_to(contacts))
+        assert_that(self.cache.get('user', 'other-endpoint', 'token'), none())
+
+    def test_that_a_new_token_invalidates_the_entry(self):
+        self.cache.set('user', 'endpoint', 'token', [{'id': 'mario'}])
+
+        assert_that(self.cache.get('user', 'endpoint', 'new-token'), none())
+        assert_that(self.cache.get('user', 'endpoint', 'token'), none())
+
+    def test_that_uncounted_lookups_are_not_in_the_stats(self):
+        self.cache.set('user', 'endpoint', None, [{'id': 'mario'}])
+
+        self.cache.lookup('user', 'endpoint', None, count=False)
+        self.cache.lookup('other-user', 'endpoint', None, count=False)
+
+        assert_that(self.cache.stats, equal_to({}))
+
+    def test_that_restored_entries_are_stale_until_set(self):
+        cache = ContactCache(ttl=10, stale_ttl=20, max_entries=2, max_bytes=1024 * 1024)
+        cache.restore('user', 'endpoint', [{'id': 'mario'}])
+
+        assert_that(cache.restore('user', 'endpoint', []), equal_to(False))
+        assert_that(cache.lookup('user', 'endpoint', None), equal_to(([{'id': 'mario'}], STALE)))
+        assert_that(cache.entries(), equal_to([('user', 'endpoint', [{'id': 'mario'}])]))
+
+        cache.set('user', 'endpoint', None, [{'id': 'luigi'}])
+        assert_that(cache.lookup('user', 'endpoint', None), equal_to(([{'id': 'luigi'}], FRESH)))
+
+    def test_that_entries_without_token_are_returned_for_any_token(self):
+        self.cache.set('mario', 'endpoint', None, [{'id': 'luigi'}])
+
+        assert_that(self.cache.get('mario', 'endpoint', 'token'), equal_to([{'id': 'luigi'}]))
+
+    @patch('wazo_microsoft.dird.cache.time')
+    def test_that_entries_expire(self, time):
+        time.monotonic.return_value = 100
+        self.cache.set('user', 'endpoint', 'token', [{'id': 'mario'}])
+
+        time.monotonic.return_value = 109
+        assert_that(self.cache.get('user', 'endpoint', 'token'), equal_to([{'id': 'mario'}]))
+
+        time.monotonic.return_value = 110
+        assert_that(self.cache.get('user', 'endpoint', 'token'), none())
+        assert_that(
+            self.cache.lookup('user', 'endpoint', 'token'),
+            equal_to(([{'id': 'mario'}], EXPIRED)),
+        )
+
+    @patch('wazo_microsoft.dird.cache.time')
+    def test_that_entries_are_stale_before_expiring(self, time):
+        cache = ContactCache(ttl=10, stale_ttl=20, max_entries=2, max_bytes=1024 * 1024)
+        time.monotonic.return_value = 100
+        cache.set('user', 'endpoint', 'token', [])
+
+        time.monotonic.return_value = 105
+        assert_that(cache.lookup('user', 'endpoint', 'token'), equal_to(([], FRESH)))
+        time.monotonic.return_value = 129
+        assert_that(cache.lookup('user', 'endpoint', 'token'), equal_to(([], STALE)))
+        time.monotonic.return_value = 130
+        assert_that(cache.lookup('user', 'endpoint', 'token'), equal_to(([], EXPIRED)))
+        assert_that(cache.lookup('other', 'endpoint', 'token'), equal_to((None, MISS)))
+
+        assert_that(cache.stats, has_entries({FRESH: 1, STALE: 1, EXPIRED: 1, MISS: 1}))
+
+    def test_that_the_least_recently_used_entry_is_evicted(self):
+        self.cache.set('mario', 'endpoint', 'token', [])
+        self.cache.set('luigi', 'endpoint', 'token', [])
+        self.cache.get('mario', 'endpoint', 'token')
+
+        self.cache.set('peach', 'endpoint', 'token', [])
+
+        assert_that(self.cache.get('luigi', 'endpoint', 'token'), none())
+        assert_that(self.cache.get('mario', 'endpoint', 'token'), equal_to([]))
+        assert_that(self.cache.get('peach', 'endpoint', 'token'), equal_to([]))
+
+    def test_that_the_memory_ceiling_is_respected(self):
+        contacts = [{'id': str(i), 'displayName': 'Contact {}'.format(i)} for i in range(10)]
+        size = estimate_size(contacts)
+        cache = ContactCache(ttl=10, max_entries=10, max_bytes=size * 2)
+
+        cache.set('mario', 'endpoint', 'token', contacts)
+        cache.set('luigi', 'endpoint', 'token', list(contacts))
+        cache.set('peach', 'endpoint', 'token', list(contacts))
+
+        assert_that(len(cache), equal_to(2))
+        assert_that(cache.get('mario', 'endpoint', 'token'), none())
+        assert_that(cache.size <= size * 2, equal_to(True))
+
+    def test_that_oversized_values_are_not_cached(self):
+        cache = ContactCache(ttl=10, max_entries=10, max_bytes=10)
+
+        cache.set('mario', 'endpoint', 'token', [{'id': 'mario'}])
+
+        assert_that(cache.get('mario', 'endpoint', 'token'), none())
+        assert_that(cache.size, equal_to(0))
+
+    def test_invalidate(self):
+        self.cache.set('mario', 'endpoint', 'token', [])
+        self.cache.set('mario', 'other', 'token', [])
+
+        self.cache.invalidate('mario')
+
+        assert_that(self.cache.get('mario', 'endpoint', 'token'), none())
+        assert_that(self.cache.get('mario', 'other', 'token'), none())
+
+    def test_that_the_sources_sharing_an_entry_share_its_lock(self):
+        lock = self.cache.key_lock('bros-tenant', 'endpoint')
+
+        assert_that(self.cache.key_lock('bros-tenant', 'endpoint'), same_instance(lock))
+        assert_that(self.cache.key_lock('bros-tenant', 'other'), not_(same_instance(lock)))
+
+
+class TestExpiringSet(TestCase):
+
+    @patch('wazo_microsoft.dird.cache.time')
+    def test_that_items_expire(self, time):
+        items = ExpiringSet(ttl=10, max_entries=10)
+        time.monotonic.return_value = 100
+        items.add('mario')
+
+        time.monotonic.return_value = 109
+        assert_that('mario' in items, equal_to(True))
+
+        time.monotonic.return_value = 110
+        assert_that('mario' in items, equal_to(False))
+        assert_that(len(items), equal_to(0))
+
+    def test_that_the_oldest_items_are_evicted(self):
+        items = ExpiringSet(ttl=10, max_entries=2)
+
+        items.add('mario')
+        items.add('luigi')
+        items.add('peach')
+
+        assert_that('mario' in items, equal_to(False))
+        assert_that('peach' in items, equal_to(True))
+
+    def test_discard(self):
+        items = ExpiringSet(ttl=10, max_entries=2)
+        items.add('mario')
+
+        items.discard('mario')
+
+        assert_that('mario' in items, equal_to(False))
+
+    def test_that_a_null_ttl_disables_the_set(self):
+        items = ExpiringSet(ttl=0, max_entries=2)
+
+        items.add('mario')
+
+        assert_that('mario' in items, equal_to(False))
@@ -0,0 +1,42 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+
+from hamcrest import (
+    assert_that,
+    equal_to,
+    not_,
+)
+from werkzeug.datastructures import MultiDict
+
+from ..http import contacts_etag, page_etag
+
+
+class TestContactsETag(TestCase):
+
+    CONTACTS = (
+        {'id': 'mario', '@odata.etag': 'W/"1"', 'givenName': 'Mario'},
+        {'id': 'luigi', 'givenName': 'Luigi'},
+    )
+
+    def test_that_the_etag_changes_with_the_contacts(self):
+        etag = contacts_etag(self.CONTACTS)
+
+        assert_that(contacts_etag(self.CONTACTS), equal_to(etag))
+        assert_that(contacts_etag(self.CONTACTS[:1]), not_(equal_to(etag)))
+        assert_that(
+            contacts_etag(({'id': 'mario', '@odata.etag': 'W/"2"'}, self.CONTACTS[1])),
+            not_(equal_to(etag)),
+        )
+        assert_that(
+            contacts_etag((self.CONTACTS[0], {'id': 'luigi', 'givenName': 'Luigi Bros'})),
+            not_(equal_to(etag)),
+        )
+
+    def test_that_each_page_has_its_own_etag(self):
+        first_page = page_etag('etag', MultiDict([('limit', '10'), ('offset', '0')]))
+
+        assert_that(page_etag('etag', MultiDict([('offset', '0'), ('limit', '10')])), equal_to(first_page))
+        assert_that(page_etag('etag', MultiDict([('limit', '10'), ('offset', '10')])), not_(equal_to(first_page)))
+        assert_that(page_etag('other', MultiDict([('limit', '10'), ('offset', '0')])), not_(equal_to(first_page)))
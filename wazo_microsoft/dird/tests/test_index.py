@@ -0,0 +1,219 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+
+from hamcrest import (
+    assert_that,
+    contains,
+    empty,
+    equal_to,
+    has_entries,
+    none,
+)
+
+from ..index import (
+    PhoneNumberNormalizer,
+    SearchIndex,
+    build_phone_index,
+    compile_texts,
+    compile_values,
+    normalize_text,
+    paginate_contacts,
+    search_contacts,
+)
+
+
+class TestPhoneNumberNormalizer(TestCase):
+
+    def test_that_only_digits_are_kept(self):
+        normalize = PhoneNumberNormalizer()
+
+        assert_that(normalize('(555) 555-1234'), equal_to('5555551234'))
+        assert_that(normalize('+1 555.555.1234'), equal_to('15555551234'))
+        assert_that(normalize('1234'), equal_to('1234'))
+
+    def test_that_non_numbers_are_ignored(self):
+        normalize = PhoneNumberNormalizer()
+
+        assert_that(normalize('mario@bros.com'), none())
+        assert_that(normalize('555 CALL-MARIO'), none())
+        assert_that(normalize(''), none())
+        assert_that(normalize(None), none())
+
+    def test_country_prefix_folding(self):
+        normalize = PhoneNumberNormalizer(country_code='33', national_prefix='0')
+
+        assert_that(normalize('+33 1 23 45 67 89'), equal_to('0123456789'))
+        assert_that(normalize('0033 1 23 45 67 89'), equal_to('0123456789'))
+        assert_that(normalize('01 23 45 67 89'), equal_to('0123456789'))
+        assert_that(normalize('+1 555 555 1234'), equal_to('15555551234'))
+
+
+class TestBuildPhoneIndex(TestCase):
+
+    def test_that_every_column_is_indexed(self):
+        mario = {'id': 'mario', 'mobilePhone': '555-555-1234', 'businessPhones': []}
+        luigi = {'id': 'luigi', 'mobilePhone': None, 'businessPhones': ['5555554321', '555 555 0000']}
+        peach = {'id': 'peach', 'mobilePhone': '5555551234'}
+
+        index = build_phone_index(
+            [mario, luigi, peach],
+            ['mobilePhone', 'businessPhones'],
+            PhoneNumberNormalizer(),
+        )
+
+        assert_that(index, has_entries({
+            '5555551234': mario,
+            '5555554321': luigi,
+            '5555550000': luigi,
+        }))
+        assert_that(len(index), equal_to(3))
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        self.eric = {'id': 'eric', 'givenName': 'Éric', 'surname': 'Bros', 'businessPhones': ['5555551234']}
+        self.mario = {'id': 'mario', 'givenName': 'Mario', 'surname': 'Bros', 'businessPhones': []}
+        self.luigi = {'id': 'luigi', 'givenName': 'Luigi', 'surname': None}
+        self.index = SearchIndex(
+            [self.eric, self.mario, self.luigi],
+            ['givenName', 'surname', 'businessPhones'],
+        )
+
+    def test_that_substrings_are_matched(self):
+        assert_that(self.index.search('bro'), contains(self.eric, self.mario))
+        assert_that(self.index.search('ari'), contains(self.mario))
+        assert_that(self.index.search('551234'), contains(self.eric))
+        assert_that(self.index.search('unknown'), empty())
+
+    def test_that_case_and_accents_are_ignored(self):
+        assert_that(self.index.search('ERIC'), contains(self.eric))
+        assert_that(self.index.search('éri'), contains(self.eric))
+
+    def test_short_terms(self):
+        assert_that(self.index.search('lu'), contains(self.luigi))
+        assert_that(self.index.search('i'), contains(self.eric, self.mario, self.luigi))
+        assert_that(self.index.search(''), contains(self.eric, self.mario, self.luigi))
+
+    def test_that_nothing_matches_without_columns(self):
+        index = SearchIndex([self.mario], [])
+
+        assert_that(index.search('mario'), empty())
+
+    def test_that_exact_and_prefix_matches_come_first(self):
+        mariol = {'id': 'mariol', 'givenName': 'Mariol'}
+        amario = {'id': 'amario', 'givenName': 'Amario'}
+        index = SearchIndex([amario, mariol, self.mario], ['givenName'])
+
+        assert_that(index.search('mario'), contains(self.mario, mariol, amario))
+
+    def test_that_the_best_results_are_limited(self):
+        contacts = [{'id': name, 'givenName': name} for name in ('Brosa', 'Bros', 'Ambros', 'Brosb')]
+        index = SearchIndex(contacts, ['givenName'])
+
+        results = index.search('bros', limit=2, key=lambda contact: contact['givenName'])
+
+        assert_that([c['id'] for c in results], contains('Bros', 'Brosa'))
+
+
+class TestSearchContacts(TestCase):
+
+    def test_that_contacts_are_not_read_once_enough_exact_matches_are_found(self):
+        read = []
+
+        def contacts():
+            for name in ('Ambros', 'Bros', 'Brosa', 'bros', 'Brosb'):
+                read.append(name)
+                yield {'id': name, 'givenName': name}
+
+        results = search_contacts(contacts(), ['givenName'], 'bros', limit=2)
+
+        assert_that([c['id'] for c in results], contains('Bros', 'bros'))
+        assert_that(read, contains('Ambros', 'Bros', 'Brosa', 'bros'))
+
+    def test_that_an_exact_match_received_last_is_found(self):
+        contacts = [{'id': name, 'givenName': name} for name in ('Brosz', 'Brosy', 'Bros', 'Brosa')]
+
+        results = search_contacts(iter(contacts), ['givenName'], 'bros', limit=2, key=lambda c: c['givenName'])
+
+        assert_that([c['id'] for c in results], contains('Bros', 'Brosa'))
+        assert_that(
+            [c['id'] for c in SearchIndex(contacts, ['givenName']).search('bros', limit=2, key=lambda c: c['givenName'])],
+            contains('Bros', 'Brosa'),
+        )
+
+    def test_that_nothing_matches_without_columns(self):
+        assert_that(search_contacts([{'givenName': 'Mario'}], [], 'mario'), empty())
+
+
+class TestCompiledMatchers(TestCase):
+
+    CONTACT = {
+        'givenName': 'Éric',
+        'surname': None,
+        'mobilePhone': '',
+        'businessPhones': ['555-555-1234', 'EXT'],
+    }
+
+    def test_compile_texts(self):
+        texts = compile_texts(['givenName', 'surname', 'businessPhones'])
+
+        assert_that(texts(self.CONTACT), contains('eric', '555-555-1234', 'ext'))
+
+    def test_compile_values(self):
+        values = compile_values(['mobilePhone', 'businessPhones'])
+
+        assert_that(values(self.CONTACT), equal_to(frozenset(['555-555-1234', 'ext'])))
+
+    def test_that_the_search_index_uses_the_given_texts(self):
+        index = SearchIndex([self.CONTACT], ['givenName'], texts=lambda contact: ('precomputed',))
+
+        assert_that(index.search('compute'), contains(self.CONTACT))
+
+
+class TestPaginateContacts(TestCase):
+
+    CONTACTS = [
+        {'id': 'peach', 'displayName': 'Peach', 'companyName': 'Castle'},
+        {'id': 'mario', 'displayName': 'Mario Bros', 'companyName': 'Plumbers'},
+        {'id': 'luigi', 'displayName': 'Luigi Bros', 'companyName': 'Plumbers'},
+        {'id': 'toad', 'displayName': None},
+    ]
+
+    def test_that_everything_is_returned_by_default(self):
+        filtered, items = paginate_contacts(self.CONTACTS, ['displayName'])
+
+        assert_that(filtered, equal_to(4))
+        assert_that(items, equal_to(self.CONTACTS))
+
+    def test_search(self):
+        filtered, items = paginate_contacts(self.CONTACTS, ['displayName', 'companyName'], search='plumb')
+
+        assert_that(filtered, equal_to(2))
+        assert_that([c['id'] for c in items], contains('mario', 'luigi'))
+
+    def test_order_and_direction(self):
+        _, items = paginate_contacts(self.CONTACTS, [], order='displayName')
+        assert_that([c['id'] for c in items], contains('toad', 'luigi', 'mario', 'peach'))
+
+        _, items = paginate_contacts(self.CONTACTS, [], order='displayName', direction='desc')
+        assert_that([c['id'] for c in items], contains('peach', 'mario', 'luigi', 'toad'))
+
+    def test_limit_and_offset(self):
+        filtered, items = paginate_contacts(self.CONTACTS, [], order='displayName', limit=2, offset=1)
+        assert_that(filtered, equal_to(4))
+        assert_that([c['id'] for c in items], contains('luigi', 'mario'))
+
+        _, items = paginate_contacts(self.CONTACTS, [], order='displayName', direction='desc', limit=1, offset=1)
+        assert_that([c['id'] for c in items], contains('mario'))
+
+        _, items = paginate_contacts(self.CONTACTS, [], limit=0)
+        assert_that(items, empty())
+
+
+class TestNormalizeText(TestCase):
+
+    def test_normalize_text(self):
+        assert_that(normalize_text('Ça Éléphant STRASSE Straße'), equal_to('ca elephant strasse strasse'))
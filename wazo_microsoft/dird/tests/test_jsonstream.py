@@ -0,0 +1,69 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import json
+
+from unittest import TestCase
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    raises,
+)
+
+from ..jsonstream import GraphPage
+
+
+def chunked(body, size):
+    raw = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+class TestGraphPage(TestCase):
+
+    BODY = {
+        '@odata.context': 'https://graph.microsoft.com/v1.0/$metadata#users(contacts)',
+        '@odata.nextLink': 'https://graph.microsoft.com/v1.0/me/contacts?$skip=3',
+        'value': [
+            {'id': '1', 'givenName': 'Élodie', 'businessPhones': ['5555551234'], 'age': 12345},
+            {'id': '2', 'givenName': '雅美', 'mobilePhone': None, 'vip': True, 'score': -1.5e3},
+            {'id': '3', 'givenName': 'Mario', 'emailAddresses': [{'address': 'mario@bros.com'}]},
+        ],
+    }
+
+    def test_that_items_and_properties_are_read_from_any_chunk_size(self):
+        for size in (1, 2, 5, 64, 64 * 1024):
+            page = GraphPage(chunked(self.BODY, size))
+
+            items = list(page)
+
+            assert_that(items, equal_to(self.BODY['value']), size)
+            assert_that(page.properties, equal_to({
+                '@odata.context': self.BODY['@odata.context'],
+                '@odata.nextLink': self.BODY['@odata.nextLink'],
+            }))
+            assert_that(page.size, equal_to(sum(len(chunk) for chunk in chunked(self.BODY, size))))
+
+    def test_that_items_are_yielded_before_the_end_of_the_response(self):
+        chunks = iter(chunked(self.BODY, 16))
+        page = iter(GraphPage(chunks))
+
+        next(page)
+
+        assert_that(next(chunks, None) is not None, equal_to(True))
+
+    def test_that_properties_after_the_items_are_read(self):
+        body = {'value': [{'id': '1'}], '@odata.deltaLink': 'delta-link'}
+        page = GraphPage(chunked(body, 3))
+
+        assert_that(page.read(), equal_to(body))
+
+    def test_empty_pages(self):
+        assert_that(GraphPage([b'{}']).read(), equal_to({'value': []}))
+        assert_that(GraphPage([b' { "value" : [ ] } ']).read(), equal_to({'value': []}))
+
+    def test_that_truncated_responses_raise(self):
+        chunks = chunked(self.BODY, 64)[:-1]
+
+        assert_that(calling(GraphPage(chunks).read), raises(ValueError))
@@ -0,0 +1,78 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+from mock import Mock
+
+from hamcrest import (
+    assert_that,
+    contains,
+    equal_to,
+    has_item,
+    same_instance,
+)
+
+from ...metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def render(self):
+        return self.registry.render().splitlines()
+
+    def test_counter(self):
+        counter = self.registry.register(Counter('requests_total', 'Requests', ['status']))
+        counter.inc(200)
+        counter.inc(200)
+        counter.inc(429, amount=3)
+
+        assert_that(self.render(), contains(
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{status="200"} 2',
+            'requests_total{status="429"} 3',
+        ))
+
+    def test_histogram(self):
+        histogram = self.registry.register(Histogram('duration_seconds', 'Duration', buckets=(0.1, 1)))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        assert_that(self.render(), contains(
+            '# HELP duration_seconds Duration',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{le="0.1"} 2',
+            'duration_seconds_bucket{le="1"} 3',
+            'duration_seconds_bucket{le="+Inf"} 4',
+            'duration_seconds_sum 2.65',
+            'duration_seconds_count 4',
+        ))
+        assert_that(histogram.get(), equal_to(4))
+
+    def test_that_label_values_are_escaped(self):
+        gauge = self.registry.register(Gauge('contacts', 'Contacts', ['source']))
+        gauge.set(42, 'the "bros"\\')
+
+        assert_that(self.render(), has_item('contacts{source="the \\"bros\\"\\\\"} 42'))
+
+    def test_that_collectors_set_the_values_before_rendering(self):
+        gauge = self.registry.register(Gauge('entries', 'Entries'))
+        collect = Mock(side_effect=lambda: gauge.set(3))
+        self.registry.add_collector(collect)
+
+        assert_that(self.render(), has_item('entries 3'))
+
+        self.registry.remove_collector(collect)
+        gauge.set(4)
+        self.render()
+        assert_that(collect.call_count, equal_to(1))
+
+    def test_that_a_metric_is_registered_once(self):
+        counter = self.registry.register(Counter('requests_total', 'Requests'))
+
+        assert_that(self.registry.register(Counter('requests_total', 'Requests')), same_instance(counter))
@@ -1,17 +1,45 @@
 # Copyright 2019 The Wazo Authors  (see the AUTHORS file)
 # SPDX-License-Identifier: GPL-3.0+
 
+import os
+import shutil
+import tempfile
+import threading
+
 from unittest import TestCase
+from mock import ANY, Mock, patch
 
 from hamcrest import (
     assert_that,
     calling,
+    contains,
+    contains_inanyorder,
+    empty,
     equal_to,
+    has_entries,
+    has_item,
+    has_items,
+    none,
     not_,
     raises,
 )
 
-from ..plugin import Office365Plugin
+from ..cache import ContactCache
+from ..exceptions import (
+    MicrosoftAccountNotLinkedException,
+    MicrosoftTokenNotFoundException,
+    UnexpectedEndpointException,
+)
+from ... import metrics
+from ..plugin import (
+    DIRECTORY_COMPUTED_FIELDS,
+    LOOKUP_DURATION,
+    REPLICA_CONTACTS,
+    USER_PROPERTIES,
+    Office365Plugin,
+    graph_fields,
+)
+from ..sync import ContactReplica
 
 
 class TestOffice365Plugin(TestCase):
@@ -25,6 +53,7 @@ class TestOffice365Plugin(TestCase):
             'name': 'office365',
             'user_agent': 'luigi',
             'first_matched_columns': ['mobilePhone', 'businessPhones'],
+            'searched_columns': ['givenName'],
             'format_columns': {
                 'display_name': "{firstname} {lastname}",
                 'name': "{firstname} {lastname}",
@@ -33,6 +62,7 @@ class TestOffice365Plugin(TestCase):
             },
         },
     }
+    ARGS = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
 
     def setUp(self):
         self.source = Office365Plugin()
@@ -43,28 +73,513 @@ class TestOffice365Plugin(TestCase):
             not_(raises(Exception))
         )
 
-    def test_first_match_predicate(self):
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_first_match(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        mario = {'id': 'mario', 'mobilePhone': None, 'businessPhones': []}
+        luigi = {'id': 'luigi', 'mobilePhone': None, 'businessPhones': ['5555551234']}
+        peach = {'id': 'peach', 'mobilePhone': '5555554321', 'businessPhones': ['4185553212']}
+        self.source.office365.get_delta.return_value = ([mario, luigi, peach], 'delta-link')
+
+        assert_that(self.source.first_match('5555551234', self.ARGS).fields['id'], equal_to('luigi'))
+        assert_that(self.source.first_match('4185553212', self.ARGS).fields['id'], equal_to('peach'))
+        assert_that(self.source.first_match('555555123', self.ARGS), none())
+
+    def test_that_the_match_values_are_the_first_matched_columns(self):
+        self.source.load(self.DEPENDENCIES)
+
+        mario = self.source._make_contact({'id': 'mario', 'mobilePhone': None, 'businessPhones': []})
+        peach = self.source._make_contact(
+            {'id': 'peach', 'mobilePhone': '5555554321', 'businessPhones': ['4185553212']}
+        )
+
+        assert_that(mario.match_values, empty())
+        assert_that(peach.match_values, contains_inanyorder('5555554321', '4185553212'))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_lookups_are_served_from_the_replica(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [
+                {'id': 'luigi', 'givenName': 'Luigi', 'mobilePhone': '5555551234'},
+                {'id': 'mario', 'givenName': 'Mario', 'mobilePhone': '5555554321'},
+            ],
+            'delta-link',
+        )
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        results = self.source.list(['luigi'], args)
+        assert_that([r.fields['id'] for r in results], contains('luigi'))
+
+        result = self.source.first_match('5555554321', args)
+        assert_that(result.fields['id'], equal_to('mario'))
+
+        results = self.source.search('mar', args)
+        assert_that([r.fields['id'] for r in results], contains('mario'))
+
+        self.source.office365.get_delta.assert_called_once_with(
+            'microsoft-token',
+            'www.bros.com/delta',
+            select=['businessPhones', 'givenName', 'id', 'mobilePhone'],
+        )
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_first_match_uses_the_phone_index(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.side_effect = [
+            ([{'id': 'luigi', 'businessPhones': ['+1 (555) 555-1234']}], 'delta-link'),
+            ([{'id': 'luigi', 'businessPhones': ['555-555-4321']}], 'delta-link'),
+        ]
+        self.source._cache = ContactCache(ttl=0, max_entries=10, max_bytes=1024 * 1024)
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        result = self.source.first_match('15555551234', args)
+        assert_that(result.fields['id'], equal_to('luigi'))
+
+        result = self.source.first_match('15555551234', args)
+        assert_that(result, equal_to(None))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_the_replica_is_kept_when_the_token_is_refreshed(self, get_token):
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.side_effect = [
+            ([{'id': 'luigi', 'mobilePhone': '5555551234'}], 'delta-link-1'),
+            ([], 'delta-link-2'),
+        ]
+        self.source._cache = ContactCache(ttl=0, max_entries=10, max_bytes=1024 * 1024)
+
+        get_token.return_value = 'microsoft-token-1'
+        self.source.first_match('5555551234', self.ARGS)
+        get_token.return_value = 'microsoft-token-2'
+        result = self.source.first_match('5555551234', self.ARGS)
+
+        assert_that(result.fields['id'], equal_to('luigi'))
+        self.source.office365.get_delta.assert_called_with('microsoft-token-2', 'delta-link-1')
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_first_match_compares_casefolded_values(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [{'id': 'luigi', 'mobilePhone': 'Luigi-Mobile'}],
+            'delta-link',
+        )
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        result = self.source.first_match('LUIGI-MOBILE', args)
+
+        assert_that(result.fields['id'], equal_to('luigi'))
+        assert_that(self.source.first_match('luigi', args), equal_to(None))
+
+    @patch('wazo_microsoft.dird.plugin.services.invalidate_microsoft_access_token')
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_refused_tokens_are_invalidated(self, get_token, invalidate_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.side_effect = UnexpectedEndpointException(error_code=401)
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        assert_that(
+            calling(self.source.first_match).with_args('5555551234', args),
+            raises(UnexpectedEndpointException),
+        )
+
+        invalidate_token.assert_called_once_with('user-uuid', host='9497')
+
+    @patch('wazo_microsoft.dird.cache.time')
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_users_without_token_are_remembered(self, get_token, time):
+        time.monotonic.return_value = 1000
+        get_token.side_effect = MicrosoftAccountNotLinkedException('user-uuid')
+        self.source.load(self.DEPENDENCIES)
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        assert_that(self.source.search('mar', args), empty())
+        assert_that(self.source.first_match('5555551234', args), equal_to(None))
+        get_token.assert_called_once_with('user-uuid', 'wazo-token', host='9497')
+
+        time.monotonic.return_value = 1000 + 60
+        self.source.search('mar', args)
+        assert_that(get_token.call_count, equal_to(2))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_unreachable_auth_is_not_remembered(self, get_token):
+        get_token.side_effect = MicrosoftTokenNotFoundException('user-uuid')
+        self.source.load(self.DEPENDENCIES)
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        self.source.search('mar', args)
+        self.source.search('mar', args)
+
+        assert_that(get_token.call_count, equal_to(2))
+
+    def test_that_the_selected_fields_can_be_configured(self):
+        config = dict(self.DEPENDENCIES['config'], select=['id', 'displayName'])
+
+        self.source.load({'config': config})
+
+        assert_that(self.source._select, equal_to(['id', 'displayName']))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_a_cold_search_uses_microsoft_graph(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.addCleanup(self.source.unload)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.find_contacts_with_term.side_effect = lambda token, term, url, find, **kwargs: find(
+            iter([{'id': 'mario', 'givenName': 'Mario'}, {'id': 'peach', 'givenName': 'Peach'}])
+        )
+        self.source.office365.get_delta.return_value = ([{'id': 'marion', 'givenName': 'Marion'}], 'delta-link')
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+        results = self.source.search('mar', args)
+        assert_that([r.fields['id'] for r in results], contains('mario'))
+
+        self.source._executor.shutdown(wait=True)
+        results = self.source.search('MÂR', args)
+        assert_that([r.fields['id'] for r in results], contains('marion'))
+        self.source.office365.find_contacts_with_term.assert_called_once_with(
+            'microsoft-token', 'mar', 'www.bros.com', ANY, select=self.source._select, find_key=None,
+        )
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_search_results_are_limited(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(dict(self.DEPENDENCIES, config=dict(self.DEPENDENCIES['config'], max_results=2)))
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [
+                {'id': 'amario', 'givenName': 'Amario'},
+                {'id': 'marion', 'givenName': 'Marion'},
+                {'id': 'mario', 'givenName': 'Mario'},
+            ],
+            'delta-link',
+        )
+        self.source.first_match('5555551234', self.ARGS)
+
+        results = self.source.search('mario', self.ARGS)
+        assert_that([r.fields['id'] for r in results], contains('mario', 'marion'))
+
+        results = self.source.search('mario', dict(self.ARGS, limit=1))
+        assert_that([r.fields['id'] for r in results], contains('mario'))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_contact_folders_are_searched(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        config = dict(
+            self.DEPENDENCIES['config'],
+            endpoint='https://graph.microsoft.com/v1.0/me/contacts',
+            contact_folders={'enabled': True},
+        )
+        self.source.load({'config': config})
+        self.addCleanup(self.source.unload)
+        office365 = self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source._synchronizer._synchronizer._office365 = office365
+        office365.get_contact_folder_id.return_value = 'default-folder'
+        office365.get_contact_folders.return_value = ['family']
+        deltas = {
+            'https://graph.microsoft.com/v1.0/me/contactFolders/default-folder/contacts/delta': (
+                [{'id': 'mario', 'givenName': 'Mario'}],
+                'delta-link-1',
+            ),
+            'https://graph.microsoft.com/v1.0/me/contactFolders/family/contacts/delta': (
+                [{'id': 'mario', 'givenName': 'Mario'}, {'id': 'marie', 'givenName': 'Marie'}],
+                'delta-link-2',
+            ),
+        }
+        office365.get_delta.side_effect = lambda token, url, select=None: deltas[url]
+
+        results = self.source.search('mar', self.ARGS)
+
+        assert_that([r.fields['id'] for r in results], contains('marie', 'mario'))
+        office365.find_contacts_with_term.assert_not_called()
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_stale_contacts_are_served_while_refreshed(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        refreshing = threading.Event()
+        responses = iter([
+            ([{'id': 'luigi', 'businessPhones': ['5555551234']}], 'delta-link'),
+            ([{'id': 'luigi', 'businessPhones': ['5555554321']}], 'delta-link'),
+        ])
+
+        def get_delta(token, url, select=None):
+            if url == 'delta-link':
+                refreshing.wait(5)
+            return next(responses)
+
+        self.source.office365.get_delta.side_effect = get_delta
+        self.source._cache = ContactCache(ttl=0, stale_ttl=60, max_entries=10, max_bytes=1024 * 1024)
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+        self.source.first_match('5555551234', args)
+
+        result = self.source.first_match('5555551234', args)
+        assert_that(result.fields['id'], equal_to('luigi'))
+
+        refreshing.set()
+        self.source._executor.shutdown(wait=True)
+        result = self.source.first_match('5555554321', args)
+        assert_that(result.fields['id'], equal_to('luigi'))
+        assert_that(self.source.office365.get_delta.call_count, equal_to(2))
+        assert_that(self.source.cache_stats(), has_entries(miss=1, stale=2))
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_each_lookup_is_counted_once(self, get_token):
+        get_token.return_value = 'microsoft-token'
         self.source.load(self.DEPENDENCIES)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [{'id': 'luigi', 'givenName': 'Luigi', 'businessPhones': ['5555551234']}],
+            'delta-link',
+        )
+        args = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+        self.source.first_match('5555551234', args)
+
+        self.source.search('lui', args)
+        self.source.list(['luigi'], args)
+        self.source.first_match('5555551234', args)
+
+        assert_that(self.source.cache_stats(), equal_to({'miss': 1, 'fresh': 3}))
 
-        term = '5555551234'
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_the_directory_is_shared_by_the_users_of_the_tenant(self, get_token):
+        get_token.side_effect = lambda user_uuid, token, **auth: 'microsoft-token-{}'.format(user_uuid)
+        config = dict(self.DEPENDENCIES['config'], tenant_uuid='bros-tenant', directory={'enabled': True})
+        self.source.load({'config': config})
+        self.addCleanup(self.source._cache.invalidate, self.source._directory_key)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [{'id': 'luigi', 'givenName': 'Luigi', 'mail': 'luigi@bros.com', 'businessPhones': ['5555551234']}],
+            'delta-link',
+        )
+
+        mario = self.source.first_match('5555551234', {'xivo_user_uuid': 'mario', 'token': 'wazo-token'})
+        peach = self.source.search('lui', {'xivo_user_uuid': 'peach', 'token': 'wazo-token'})
+
+        assert_that(mario.fields, has_entries(id='luigi', email='luigi@bros.com'))
+        assert_that([r.fields['id'] for r in peach], contains('luigi'))
+        self.source.office365.get_delta.assert_called_once_with(
+            'microsoft-token-mario',
+            'https://graph.microsoft.com/v1.0/users/delta',
+            select=self.source._select,
+        )
+        self.source.office365.find_contacts_with_term.assert_not_called()
+        assert_that(self.source._select, not_(contains('emailAddresses')))
 
-        mario = {
-            'name': 'Mario Bros',
-            'mobilePhone': None,
-            'businessPhones': [],
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_the_workers_share_the_stored_contacts(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = dict(self.DEPENDENCIES['config'], store={'enabled': True})
+        main_config = {'office365': {'store_path': os.path.join(directory, 'contacts.sqlite')}}
+        workers = [Office365Plugin(), Office365Plugin(), Office365Plugin()]
+        for worker, ttl in zip(workers, [60, 60, 0]):
+            worker.load({'config': dict(config, cache={'ttl': ttl}), 'main_config': main_config})
+            self.addCleanup(worker.unload)
+            worker.office365 = worker._synchronizer._office365 = Mock()
+            worker.office365.get_delta.return_value = (
+                [{'id': 'luigi', 'businessPhones': ['5555551234']}],
+                'delta-link',
+            )
+
+        results = [worker.first_match('5555551234', self.ARGS) for worker in workers]
+
+        assert_that([r.fields['id'] for r in results], contains('luigi', 'luigi', 'luigi'))
+        workers[0].office365.get_delta.assert_called_once_with(
+            'microsoft-token', 'www.bros.com/delta', select=workers[0]._select,
+        )
+        workers[1].office365.get_delta.assert_not_called()
+        # Past the ttl, only the changes since the stored delta link are fetched
+        workers[2].office365.get_delta.assert_called_once_with('microsoft-token', 'delta-link')
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_the_contacts_are_restored_from_the_snapshot(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        dependencies = {
+            'config': dict(
+                self.DEPENDENCIES['config'],
+                uuid='4f2ea3a4-a1b9-4e58-9c4c-7d4c9b5a6b8e',
+                snapshot={'enabled': True},
+            ),
+            'main_config': {'office365': {'snapshot_directory': directory}},
         }
-        luigi = {
-            'name': 'Luigi Bros',
-            'mobilePhone': None,
-            'businessPhones': ['5555551234'],
+        self.source.load(dependencies)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = (
+            [{'id': 'luigi', 'businessPhones': ['5555551234']}],
+            'delta-link',
+        )
+        self.source.first_match('5555551234', self.ARGS)
+        self.source.unload()
+
+        restarted = Office365Plugin()
+        restarted.load(dependencies)
+        self.addCleanup(restarted.unload)
+        restarted.office365 = restarted._synchronizer._office365 = Mock()
+        restarted.office365.get_delta.return_value = ([], 'delta-link-2')
+        restarted._executor.shutdown(wait=True)
+
+        result = restarted.first_match('5555551234', self.ARGS)
+
+        assert_that(result.fields['id'], equal_to('luigi'))
+        assert_that(restarted.cache_stats(), has_entries(stale=1))
+        restarted.office365.get_delta.assert_not_called()
+        assert_that(os.listdir(directory), has_item('4f2ea3a4-a1b9-4e58-9c4c-7d4c9b5a6b8e.snapshot'))
+
+    def test_that_sources_without_uuid_have_no_snapshot(self):
+        self.source.load({'config': dict(self.DEPENDENCIES['config'], name='../bros', snapshot={'enabled': True})})
+        self.addCleanup(self.source.unload)
+
+        assert_that(self.source._snapshot_path, none())
+
+    @patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+    def test_that_the_lookups_are_measured(self, get_token):
+        get_token.return_value = 'microsoft-token'
+        self.source.load(dict(self.DEPENDENCIES, config=dict(self.DEPENDENCIES['config'], name='measured')))
+        self.addCleanup(self.source.unload)
+        self.source.office365 = self.source._synchronizer._office365 = Mock()
+        self.source.office365.get_delta.return_value = ([{'id': 'luigi', 'businessPhones': ['5555551234']}], None)
+
+        self.source.office365.pool_stats.return_value = {
+            'https://graph.microsoft.com:443': {'connections': 1, 'requests': 2, 'idle': 1, 'maxsize': 10},
         }
-        peach = {
-            'name': 'Peach',
-            'mobilePhone': '5555551234',
-            'businessPhones': ['4185553212'],
+
+        self.source.first_match('5555551234', self.ARGS)
+
+        assert_that(LOOKUP_DURATION.get('measured', 'first_match'), equal_to(1))
+        assert_that(REPLICA_CONTACTS.get('measured'), equal_to(1))
+        assert_that(metrics.render().splitlines(), has_items(
+            'office365_cache_lookups_total{source="measured",state="miss"} 1',
+            'office365_cache_entries{source="measured"} 1',
+            'office365_http_pool_connections_total{source="measured",host="https://graph.microsoft.com:443"} 1',
+            'office365_http_pool_requests_total{source="measured",host="https://graph.microsoft.com:443"} 2',
+            'office365_http_pool_idle_connections{source="measured",host="https://graph.microsoft.com:443"} 1',
+            'office365_http_pool_maxsize{source="measured",host="https://graph.microsoft.com:443"} 10',
+        ))
+
+
+class TestGraphFields(TestCase):
+
+    def test_that_fields_are_extracted_from_the_configuration(self):
+        format_columns = {
+            'name': '{givenName} {surname}',
+            'number': '{businessPhones[0]}',
+            'email': '{email}',
+            'address': '{homeAddress.city}',
+            'static': 'office365',
+            'display_name': '{firstname} {lastname}',
+            'phone_mobile': '{mobile}',
         }
 
-        assert_that(self.source._first_match_predicate(term, mario), equal_to(False))
-        assert_that(self.source._first_match_predicate(term, luigi), equal_to(True))
-        assert_that(self.source._first_match_predicate(term, peach), equal_to(True))
-        assert_that(self.source._first_match_predicate(term[:-1], peach), equal_to(False))
+        fields = graph_fields(format_columns, ['displayName'], ['mobilePhone', 'businessPhones'])
+
+        assert_that(fields, contains(
+            'businessPhones',
+            'displayName',
+            'emailAddresses',
+            'givenName',
+            'homeAddress',
+            'id',
+            'mobilePhone',
+            'surname',
+        ))
+
+    def test_that_the_email_of_the_users_is_their_mail(self):
+        fields = graph_fields(
+            {'email': '{email}', 'title': '{jobTitle}', 'notes': '{personalNotes}'},
+            computed=DIRECTORY_COMPUTED_FIELDS,
+            properties=USER_PROPERTIES,
+        )
+
+        assert_that(fields, contains('givenName', 'id', 'jobTitle', 'mail'))
+
+    def test_that_the_columns_are_selected_when_they_are_graph_properties(self):
+        fields = graph_fields({}, ['surname', 'name', 'email'], ['homePhones[0]', 'mobile'])
+
+        assert_that(fields, contains('emailAddresses', 'givenName', 'homePhones', 'id', 'surname'))
+
+
+class TestOffice365PluginFavorites(TestCase):
+
+    CONFIG = dict(
+        TestOffice365Plugin.DEPENDENCIES['config'],
+        endpoint='https://graph.microsoft.com/v1.0/me/contacts',
+        select=['id', 'givenName'],
+    )
+    ARGS = {'xivo_user_uuid': 'user-uuid', 'token': 'wazo-token'}
+
+    def setUp(self):
+        patcher = patch('wazo_microsoft.dird.plugin.services.get_microsoft_access_token')
+        patcher.start().return_value = 'microsoft-token'
+        self.addCleanup(patcher.stop)
+        self.source = Office365Plugin()
+        self.source.load({'config': self.CONFIG})
+        self.addCleanup(self.source.unload)
+        self.office365 = self.source.office365 = self.source._async_office365._office365 = Mock()
+        self.source._synchronizer._office365 = self.office365
+        self.office365.BATCH_SIZE = 2
+        self.office365.get_contact_folder_id.return_value = 'default-folder'
+        self.office365.get_delta.return_value = ([{'id': 'mario', 'givenName': 'Mario'}], 'delta-link')
+
+    def test_that_favorites_are_fetched_by_id_without_replica(self):
+        self.office365.get_contacts_by_ids.side_effect = [
+            [{'id': 'mario'}, {'id': 'luigi'}],
+            [{'id': 'peach'}],
+        ]
+
+        results = self.source.list(['mario', 'luigi', 'peach'], self.ARGS)
+
+        assert_that([r.fields['id'] for r in results], contains('mario', 'luigi', 'peach'))
+        self.office365.get_contacts_by_ids.assert_any_call(
+            'microsoft-token', self.CONFIG['endpoint'], ['mario', 'luigi'], select=['id', 'givenName'],
+        )
+        self.office365.get_contacts_by_ids.assert_any_call(
+            'microsoft-token', self.CONFIG['endpoint'], ['peach'], select=['id', 'givenName'],
+        )
+
+    def test_that_the_replica_is_synchronized_after_fetching_favorites(self):
+        self.office365.get_contacts_by_ids.return_value = [{'id': 'mario'}]
+
+        self.source.list(['mario'], self.ARGS)
+        self.source._executor.shutdown(wait=True)
+        results = self.source.list(['mario'], self.ARGS)
+
+        assert_that([r.fields['givenName'] for r in results], contains('Mario'))
+        self.office365.get_contacts_by_ids.assert_called_once()
+        self.office365.get_delta.assert_called_once()
+
+    @patch('wazo_microsoft.dird.plugin.services.invalidate_microsoft_access_token')
+    def test_that_tokens_refused_in_a_batch_are_invalidated(self, invalidate_token):
+        self.office365.get_contacts_by_ids.side_effect = UnexpectedEndpointException(error_code=401)
+
+        assert_that(
+            calling(self.source.list).with_args(['mario'], self.ARGS),
+            raises(UnexpectedEndpointException),
+        )
+
+        invalidate_token.assert_called_once_with('user-uuid', host='9497')
+
+    def test_that_favorites_are_read_from_the_replica_when_available(self):
+        replica = ContactReplica()
+        replica.apply([{'id': 'mario', 'givenName': 'Mario'}])
+        replica.delta_link = 'delta-link'
+        self.source._cache.set('user-uuid', self.CONFIG['endpoint'], None, replica)
+
+        results = self.source.list(['mario'], self.ARGS)
+
+        assert_that([r.fields['id'] for r in results], contains('mario'))
+        self.office365.get_contacts_by_ids.assert_not_called()
@@ -0,0 +1,72 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    not_,
+    has_key,
+    raises,
+    same_instance,
+)
+
+from ..records import record_class
+
+
+class TestContactRecord(TestCase):
+
+    def setUp(self):
+        self.Record = record_class(['id', 'givenName', 'businessPhones', 'emailAddresses'])
+
+    def test_that_only_the_fields_of_the_class_are_kept(self):
+        record = self.Record({
+            '@odata.etag': 'W/"an-odata-etag"',
+            'id': 'mario',
+            'givenName': 'Mario',
+            'businessPhones': ['5555551234'],
+            'personalNotes': 'a' * 1000,
+        })
+
+        assert_that(dict(record), equal_to({
+            'id': 'mario',
+            'givenName': 'Mario',
+            'businessPhones': ('5555551234',),
+        }))
+        assert_that(record, not_(has_key('emailAddresses')))
+        assert_that(record.get('emailAddresses'), equal_to(None))
+        assert_that(calling(record.__getitem__).with_args('personalNotes'), raises(KeyError))
+
+    def test_that_records_are_read_only(self):
+        record = self.Record({'id': 'mario'})
+
+        assert_that(calling(setattr).with_args(record, 'id', 'luigi'), raises(AttributeError))
+
+    def test_that_strings_are_interned(self):
+        first = self.Record({'id': ''.join(['mar', 'io']), 'givenName': ''.join(['Mar', 'io'])})
+        second = self.Record({'id': ''.join(['lui', 'gi']), 'givenName': ''.join(['Mar', 'io'])})
+
+        assert_that(first['givenName'], same_instance(second['givenName']))
+
+    def test_that_invalid_fields_are_ignored(self):
+        Record = record_class(['id', 'id', '@odata.etag', 'class', 'keys'])
+
+        assert_that(Record.fields, equal_to(('id',)))
+
+    def test_that_computed_attributes_are_not_fields(self):
+        Record = record_class(['id', 'givenName'], computed={'initial': lambda record: record['givenName'][0]})
+
+        record = Record({'id': 'mario', 'givenName': 'Mario'})
+
+        assert_that(record.initial, equal_to('M'))
+        assert_that(dict(record), equal_to({'id': 'mario', 'givenName': 'Mario'}))
+
+    def test_that_the_etag_is_kept(self):
+        record = self.Record({'@odata.etag': 'W/"1"', 'id': 'mario'})
+
+        assert_that(record.etag, equal_to('W/"1"'))
+        assert_that(record.unchanged_by({'@odata.etag': 'W/"1"'}), equal_to(True))
+        assert_that(record.unchanged_by({'@odata.etag': 'W/"2"'}), equal_to(False))
+        assert_that(self.Record({'id': 'mario'}).unchanged_by({}), equal_to(False))
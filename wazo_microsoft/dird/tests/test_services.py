@@ -0,0 +1,479 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import json
+import threading
+import time
+
+import requests
+
+from unittest import TestCase
+from mock import ANY, Mock, patch
+
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    empty,
+    equal_to,
+    has_entries,
+    none,
+    not_,
+    raises,
+    same_instance,
+)
+
+from ..exceptions import (
+    MicrosoftAccountNotLinkedException,
+    MicrosoftTokenNotFoundException,
+    SyncStateNotFoundException,
+    UnexpectedEndpointException,
+)
+from ..services import (
+    MicrosoftTokenCache,
+    Office365Service,
+    Office365ServiceRegistry,
+    batch_endpoint,
+)
+from ..throttling import Throttler
+
+URL = 'https://graph.microsoft.com/v1.0/me/contacts'
+
+
+def page(contacts, next_link=None, status_code=200, delta_link=None):
+    body = {'value': contacts}
+    if next_link:
+        body['@odata.nextLink'] = next_link
+    if delta_link:
+        body['@odata.deltaLink'] = delta_link
+    response = Mock(status_code=status_code, headers={})
+    response.iter_content.return_value = [json.dumps(body).encode('utf-8').ljust(100)]
+    return response
+
+
+class BaseServiceTestCase(TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+        patcher = patch.object(Office365Service, '_get_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestOffice365ServicePaging(BaseServiceTestCase):
+
+    def test_that_every_page_is_followed(self):
+        self.session.get.side_effect = [
+            page([{'id': '1'}], next_link='{}?$skip=1'.format(URL)),
+            page([{'id': '2'}]),
+        ]
+        service = Office365Service(page_size=1)
+
+        contacts = service.get_contacts('token', URL)
+
+        assert_that([c['id'] for c in contacts], contains('1', '2'))
+        first_call, second_call = self.session.get.call_args_list
+        assert_that(first_call[1]['params'], equal_to({'$top': 1}))
+        assert_that(second_call[0][0], equal_to('{}?$skip=1'.format(URL)))
+        assert_that(second_call[1]['params'], equal_to(None))
+
+    def test_that_pages_are_fetched_lazily(self):
+        self.session.get.side_effect = [
+            page([{'id': '1'}], next_link='next'),
+            page([{'id': '2'}]),
+        ]
+        service = Office365Service()
+
+        contacts = service.iter_contacts('token', URL)
+
+        assert_that(next(contacts), equal_to({'id': '1'}))
+        assert_that(self.session.get.call_count, equal_to(1))
+
+    def test_that_identical_searches_share_the_contacts_found(self):
+        self.session.get.return_value = page([{'id': 'mario'}, {'id': 'peach'}])
+        service = Office365Service()
+        searching = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def find(contacts):
+            searching.set()
+            release.wait(5)
+            return [c for c in contacts if c['id'] == 'mario']
+
+        def search():
+            results.append(service.find_contacts_with_term('token', 'mar', URL, find, find_key=10))
+
+        threads = [threading.Thread(target=search) for _ in range(2)]
+        threads[0].start()
+        searching.wait(5)
+        threads[1].start()
+        while not list(service._in_flight._calls.values())[0].waiters:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert_that(results, contains([{'id': 'mario'}], [{'id': 'mario'}]))
+        assert_that(results[0], same_instance(results[1]))
+        self.session.get.assert_called_once_with(
+            URL, headers=ANY, params={'search': 'mar', '$top': 100}, timeout=ANY, stream=True,
+        )
+
+    def test_that_the_page_cap_is_respected(self):
+        self.session.get.side_effect = [
+            page([{'id': '1'}], next_link='next'),
+            page([{'id': '2'}], next_link='next'),
+        ]
+        service = Office365Service(max_pages=1)
+
+        contacts = service.get_contacts('token', URL)
+
+        assert_that([c['id'] for c in contacts], contains('1'))
+
+    def test_that_the_byte_budget_is_respected(self):
+        self.session.get.side_effect = [
+            page([{'id': '1'}], next_link='next'),
+            page([{'id': '2'}], next_link='next'),
+            page([{'id': '3'}]),
+        ]
+        service = Office365Service(max_bytes=150)
+
+        contacts = service.get_contacts('token', URL)
+
+        assert_that([c['id'] for c in contacts], contains('1', '2'))
+
+    def test_get_contacts_with_an_error(self):
+        self.session.get.return_value = page([], status_code=404)
+        service = Office365Service()
+
+        assert_that(
+            calling(service.get_contacts).with_args('token', URL),
+            raises(UnexpectedEndpointException),
+        )
+        assert_that(service.get_contacts_with_term('token', 'term', URL), empty())
+
+
+class TestOffice365ServiceDelta(BaseServiceTestCase):
+
+    def test_that_pages_are_followed_up_to_the_delta_link(self):
+        last_page = page([{'id': '2', '@removed': {'reason': 'deleted'}}], delta_link='delta-link')
+        self.session.get.side_effect = [page([{'id': '1'}], next_link='next'), last_page]
+        service = Office365Service(page_size=50)
+
+        changes, delta_link = service.get_delta('token', URL + '/delta')
+
+        assert_that([c['id'] for c in changes], contains('1', '2'))
+        assert_that(delta_link, equal_to('delta-link'))
+        headers = self.session.get.call_args[1]['headers']
+        assert_that(headers['Prefer'], equal_to('odata.maxpagesize=50'))
+
+    def test_that_an_expired_delta_link_is_reported(self):
+        self.session.get.return_value = page([], status_code=410)
+        service = Office365Service()
+
+        assert_that(
+            calling(service.get_delta).with_args('token', 'delta-link'),
+            raises(SyncStateNotFoundException),
+        )
+
+
+class TestOffice365ServiceConnectionPool(BaseServiceTestCase):
+
+    def test_that_timeouts_are_used(self):
+        self.session.get.return_value = page([])
+        service = Office365Service(connect_timeout=1, read_timeout=2)
+
+        service.get_contacts('token', URL)
+
+        assert_that(self.session.get.call_args[1]['timeout'], equal_to((1, 2)))
+
+    def test_that_keep_alive_can_be_disabled(self):
+        self.session.get.return_value = page([])
+        service = Office365Service(keep_alive=False)
+
+        service.get_contacts('token', URL)
+
+        headers = self.session.get.call_args[1]['headers']
+        assert_that(headers['Connection'], equal_to('close'))
+
+
+class TestOffice365ServiceContactFolders(BaseServiceTestCase):
+
+    FOLDERS_URL = 'https://graph.microsoft.com/v1.0/me/contactFolders'
+
+    def test_that_child_folders_are_listed_recursively(self):
+        pages = {
+            self.FOLDERS_URL: page([{'id': 'family'}, {'id': 'work'}]),
+            self.FOLDERS_URL + '/family/childFolders': page([{'id': 'cousins'}]),
+            self.FOLDERS_URL + '/work/childFolders': page([]),
+            self.FOLDERS_URL + '/cousins/childFolders': page([]),
+        }
+        self.session.get.side_effect = lambda url, **kwargs: pages[url]
+        service = Office365Service()
+
+        folder_ids = service.get_contact_folders('token', self.FOLDERS_URL, recursive=True)
+
+        assert_that(folder_ids, contains('family', 'work', 'cousins'))
+
+    def test_that_only_the_first_level_is_listed_by_default(self):
+        self.session.get.return_value = page([{'id': 'family'}])
+        service = Office365Service()
+
+        folder_ids = service.get_contact_folders('token', self.FOLDERS_URL)
+
+        assert_that(folder_ids, contains('family'))
+        assert_that(self.session.get.call_count, equal_to(1))
+
+    def test_that_the_folder_of_the_contacts_is_found(self):
+        self.session.get.return_value = page([{'parentFolderId': 'default-folder'}])
+        service = Office365Service()
+
+        folder_id = service.get_contact_folder_id('token', URL)
+
+        assert_that(folder_id, equal_to('default-folder'))
+        self.session.get.assert_called_once_with(
+            URL, headers=ANY, params={'$top': 1, '$select': 'parentFolderId'}, timeout=ANY, stream=True,
+        )
+
+    def test_that_an_empty_folder_is_not_found(self):
+        self.session.get.return_value = page([])
+        service = Office365Service()
+
+        assert_that(service.get_contact_folder_id('token', URL), none())
+
+
+class TestOffice365ServiceConditionalRequests(BaseServiceTestCase):
+
+    def test_that_unchanged_pages_are_not_downloaded_again(self):
+        first = page([{'id': '1'}])
+        first.headers = {'ETag': '"v1"'}
+        self.session.get.side_effect = [first, Mock(status_code=304, headers={})]
+        service = Office365Service()
+
+        service.get_contacts('token', URL)
+        contacts = service.get_contacts('token', URL)
+
+        assert_that([c['id'] for c in contacts], contains('1'))
+        headers = self.session.get.call_args[1]['headers']
+        assert_that(headers['If-None-Match'], equal_to('"v1"'))
+
+    def test_that_partially_read_pages_are_not_kept(self):
+        first = page([{'id': '1'}, {'id': '2'}])
+        first.headers = {'ETag': '"v1"'}
+        self.session.get.side_effect = [first, page([{'id': '1'}])]
+        service = Office365Service()
+
+        next(service.iter_contacts('token', URL))
+        service.get_contacts('token', URL)
+
+        assert_that(self.session.get.call_args[1]['headers'], not_(has_entries({'If-None-Match': '"v1"'})))
+
+
+class TestOffice365ServiceThrottling(BaseServiceTestCase):
+
+    def test_that_throttled_requests_are_retried(self):
+        throttled = page([], status_code=429)
+        throttled.headers = {'Retry-After': '0'}
+        self.session.get.side_effect = [throttled, page([{'id': '1'}])]
+        service = Office365Service(throttler=Throttler())
+
+        contacts = service.get_contacts('token', URL)
+
+        assert_that([c['id'] for c in contacts], contains('1'))
+
+    def test_that_requests_are_refused_while_the_circuit_is_open(self):
+        self.session.get.return_value = page([], status_code=503)
+        service = Office365Service(throttler=Throttler(max_retries=0, failure_threshold=1))
+        with self.assertRaises(UnexpectedEndpointException) as context:
+            service.get_contacts('token', URL)
+        assert_that(context.exception.details, has_entries(error_code=503))
+
+        with self.assertRaises(UnexpectedEndpointException) as context:
+            service.get_contacts('token', URL)
+        assert_that(context.exception.details, has_entries(error='circuit open'))
+        assert_that(self.session.get.call_count, equal_to(1))
+
+
+class TestOffice365ServiceSessions(TestCase):
+
+    def test_that_sessions_share_the_connection_pool(self):
+        service = Office365Service(pool_maxsize=3)
+        sessions = []
+
+        thread = threading.Thread(target=lambda: sessions.append(service._get_session()))
+        thread.start()
+        thread.join()
+        sessions.append(service._get_session())
+
+        first, second = sessions
+        assert_that(first, not_(same_instance(second)))
+        assert_that(first.get_adapter(URL), same_instance(second.get_adapter(URL)))
+        assert_that(service._get_session(), same_instance(second))
+
+    def test_pool_stats(self):
+        service = Office365Service(pool_maxsize=3)
+        service._adapter.poolmanager.connection_from_url(URL)
+
+        assert_that(service.pool_stats(), has_entries({
+            'https://graph.microsoft.com:443': has_entries(connections=0, requests=0, idle=3, maxsize=3),
+        }))
+
+
+class TestOffice365ServiceRegistry(TestCase):
+
+    def test_that_services_are_reused_per_source(self):
+        registry = Office365ServiceRegistry()
+
+        service = registry.get('source-uuid', page_size=10)
+
+        assert_that(registry.get('source-uuid', page_size=10), same_instance(service))
+        assert_that(registry.get('other-uuid', page_size=10), not_(same_instance(service)))
+        assert_that(registry.get('source-uuid', page_size=20), not_(same_instance(service)))
+
+
+@patch('wazo_microsoft.dird.services.Auth')
+class TestMicrosoftTokenCache(TestCase):
+
+    AUTH_CONFIG = {'host': 'localhost', 'port': 9497}
+
+    def setUp(self):
+        self.cache = MicrosoftTokenCache()
+
+    def test_that_tokens_are_reused_until_they_expire(self, Auth):
+        external = Auth.return_value.external
+        external.get.return_value = {'access_token': 'first', 'token_expiration': time.time() + 3600}
+
+        assert_that(self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG), equal_to('first'))
+        assert_that(self.cache.get('user-uuid', 'other-token', **self.AUTH_CONFIG), equal_to('first'))
+
+        external.get.assert_called_once_with('microsoft', 'user-uuid')
+        Auth.assert_called_once_with(**self.AUTH_CONFIG)
+
+    def test_that_tokens_close_to_their_expiration_are_fetched_again(self, Auth):
+        external = Auth.return_value.external
+        external.get.side_effect = [
+            {'access_token': 'first', 'token_expiration': time.time() + 30},
+            {'access_token': 'second', 'token_expiration': time.time() + 3600},
+        ]
+
+        self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG)
+
+        assert_that(self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG), equal_to('second'))
+        Auth.return_value.set_token.assert_called_with('wazo-token')
+
+    def test_that_invalidated_tokens_are_fetched_again(self, Auth):
+        external = Auth.return_value.external
+        external.get.return_value = {'access_token': 'first', 'token_expiration': time.time() + 3600}
+        self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG)
+
+        self.cache.invalidate('user-uuid', **self.AUTH_CONFIG)
+        self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG)
+
+        assert_that(external.get.call_count, equal_to(2))
+
+    def test_that_tokens_are_kept_per_auth_config(self, Auth):
+        external = Auth.return_value.external
+        external.get.return_value = {'access_token': 'first', 'token_expiration': time.time() + 3600}
+        self.cache.get('user-uuid', 'wazo-token', **self.AUTH_CONFIG)
+
+        self.cache.get('user-uuid', 'wazo-token', host='other-host')
+
+        assert_that(external.get.call_count, equal_to(2))
+
+    def test_that_missing_tokens_raise(self, Auth):
+        Auth.return_value.external.get.side_effect = requests.HTTPError()
+
+        assert_that(
+            calling(self.cache.get).with_args('user-uuid', 'wazo-token', **self.AUTH_CONFIG),
+            raises(MicrosoftTokenNotFoundException),
+        )
+
+    def test_that_unlinked_accounts_are_reported(self, Auth):
+        Auth.return_value.external.get.side_effect = requests.HTTPError(response=Mock(status_code=404))
+
+        assert_that(
+            calling(self.cache.get).with_args('user-uuid', 'wazo-token', **self.AUTH_CONFIG),
+            raises(MicrosoftAccountNotLinkedException),
+        )
+
+
+class TestOffice365ServiceSelect(BaseServiceTestCase):
+
+    def test_that_fields_are_selected(self):
+        self.session.get.return_value = page([])
+        service = Office365Service(page_size=None)
+
+        service.get_contacts('token', URL, select=['id', 'givenName'])
+
+        assert_that(self.session.get.call_args[1]['params'], equal_to({'$select': 'id,givenName'}))
+
+    def test_that_delta_fields_are_only_selected_on_the_first_page(self):
+        first_page = page([], next_link='next')
+        last_page = page([], delta_link='delta-link')
+        self.session.get.side_effect = [first_page, last_page]
+        service = Office365Service()
+
+        service.get_delta('token', URL + '/delta', select=['id'])
+
+        first_call, second_call = self.session.get.call_args_list
+        assert_that(first_call[1]['params'], equal_to({'$select': 'id'}))
+        assert_that(second_call[1]['params'], equal_to(None))
+
+
+class TestOffice365ServiceBatch(BaseServiceTestCase):
+
+    def _batch(self, *responses):
+        response = Mock(status_code=200)
+        response.json.return_value = {'responses': list(responses)}
+        return response
+
+    def test_that_contacts_are_fetched_in_batches(self):
+        ids = ['id-{}'.format(i) for i in range(25)]
+        self.session.post.side_effect = [
+            self._batch(*[{'id': str(i), 'status': 200, 'body': {'id': id_}} for i, id_ in enumerate(ids[:20])]),
+            self._batch(*[{'id': str(i), 'status': 200, 'body': {'id': id_}} for i, id_ in enumerate(ids[20:])]),
+        ]
+        service = Office365Service()
+
+        contacts = service.get_contacts_by_ids('token', URL, ids, select=['id', 'givenName'])
+
+        assert_that([c['id'] for c in contacts], equal_to(ids))
+        first_call, _ = self.session.post.call_args_list
+        assert_that(first_call[0][0], equal_to('https://graph.microsoft.com/v1.0/$batch'))
+        assert_that(first_call[1]['json']['requests'][0], equal_to({
+            'id': '0',
+            'method': 'GET',
+            'url': '/me/contacts/id-0?$select=id,givenName',
+        }))
+
+    def test_that_deleted_contacts_are_ignored(self):
+        self.session.post.return_value = self._batch(
+            {'id': '1', 'status': 200, 'body': {'id': 'luigi'}},
+            {'id': '0', 'status': 404, 'body': {'error': {}}},
+        )
+        service = Office365Service()
+
+        contacts = service.get_contacts_by_ids('token', URL, ['mario', 'luigi'])
+
+        assert_that(contacts, contains({'id': 'luigi'}))
+
+    def test_that_other_errors_are_raised(self):
+        self.session.post.return_value = self._batch({'id': '0', 'status': 429, 'body': {}})
+        service = Office365Service()
+
+        assert_that(
+            calling(service.get_contacts_by_ids).with_args('token', URL, ['mario']),
+            raises(UnexpectedEndpointException),
+        )
+
+
+class TestBatchEndpoint(TestCase):
+
+    def test_batch_endpoint(self):
+        assert_that(batch_endpoint(URL), equal_to(('https://graph.microsoft.com/v1.0/$batch', '/me/contacts')))
+        assert_that(
+            batch_endpoint('https://graph.microsoft.com/beta/me/contactFolders/abc/contacts/'),
+            equal_to(('https://graph.microsoft.com/beta/$batch', '/me/contactFolders/abc/contacts')),
+        )
+        assert_that(batch_endpoint('http://localhost:8080/me/contacts'), equal_to((None, None)))
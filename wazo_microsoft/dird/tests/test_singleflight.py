@@ -0,0 +1,86 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import threading
+import time
+
+from unittest import TestCase
+
+from hamcrest import (
+    assert_that,
+    calling,
+    equal_to,
+    raises,
+)
+
+from ..singleflight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def _slow_call(self, result):
+        self.calls.append(result)
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _run_concurrently(self, key, result, waiters=3):
+        results = []
+
+        def call():
+            try:
+                results.append(self.single_flight.do(key, self._slow_call, result))
+            except Exception as e:
+                results.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        self.started.wait(5)
+        threads = [threading.Thread(target=call) for _ in range(waiters)]
+        for thread in threads:
+            thread.start()
+        while self.single_flight._calls[key].waiters < waiters:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in [leader] + threads:
+            thread.join(5)
+        return results
+
+    def test_that_concurrent_calls_are_shared(self):
+        results = self._run_concurrently('key', 'result')
+
+        assert_that(results, equal_to(['result'] * 4))
+        assert_that(len(self.calls), equal_to(1))
+
+    def test_that_errors_are_propagated_to_every_caller(self):
+        error = ValueError('boom')
+
+        results = self._run_concurrently('key', error)
+
+        assert_that(results, equal_to([error] * 4))
+        assert_that(len(self.calls), equal_to(1))
+
+    def test_that_sequential_calls_are_not_shared(self):
+        self.release.set()
+
+        self.single_flight.do('key', self._slow_call, 'first')
+        self.single_flight.do('key', self._slow_call, 'second')
+
+        assert_that(self.calls, equal_to(['first', 'second']))
+
+    def test_that_errors_are_not_kept(self):
+        self.release.set()
+
+        assert_that(
+            calling(self.single_flight.do).with_args('key', self._slow_call, ValueError()),
+            raises(ValueError),
+        )
+        assert_that(self.single_flight.do('key', self._slow_call, 'ok'), equal_to('ok'))
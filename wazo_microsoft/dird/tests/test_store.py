@@ -0,0 +1,193 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from unittest import TestCase
+from mock import patch
+
+from hamcrest import (
+    assert_that,
+    close_to,
+    contains,
+    contains_inanyorder,
+    equal_to,
+    has_entries,
+    none,
+)
+
+from ..records import record_class
+from ..store import ContactStore, dump_replica, load_snapshot, restore_replica, save_snapshot
+from ..sync import ContactReplica, FolderReplica
+
+
+class TestContactStore(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'office365', 'contacts.sqlite')
+        self.store = ContactStore(self.path, max_bytes=1024 * 1024)
+        self.addCleanup(self.store.close)
+
+    def replica(self, contacts, delta_link='delta-link'):
+        replica = ContactReplica()
+        replica.apply(contacts)
+        replica.delta_link = delta_link
+        return replica
+
+    def test_that_replicas_are_read_by_other_workers(self):
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'mario', 'givenName': 'Mario'}]))
+
+        other_worker = ContactStore(self.path, max_bytes=1024 * 1024)
+        self.addCleanup(other_worker.close)
+        cursors, stored_contacts, age = other_worker.load(['user-uuid', 'endpoint'])
+
+        assert_that(cursors, equal_to([[None, 'delta-link']]))
+        assert_that(stored_contacts, equal_to([[None, [{'id': 'mario', 'givenName': 'Mario'}]]]))
+        assert_that(age, close_to(0, 5))
+        assert_that(other_worker.load(['other-user-uuid', 'endpoint']), none())
+
+    def test_that_only_the_delta_links_are_updated_without_changes(self):
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'mario'}], 'delta-link-1'))
+
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'luigi'}], 'delta-link-2'), changed=False)
+
+        cursors, stored_contacts, _ = self.store.load(['user-uuid', 'endpoint'])
+        assert_that(cursors, equal_to([[None, 'delta-link-2']]))
+        assert_that(stored_contacts, equal_to([[None, [{'id': 'mario'}]]]))
+
+    def test_that_unchanged_replicas_missing_from_the_store_are_written(self):
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'mario'}]), changed=False)
+
+        cursors, stored_contacts, _ = self.store.load(['user-uuid', 'endpoint'])
+        assert_that(cursors, equal_to([[None, 'delta-link']]))
+        assert_that(stored_contacts, equal_to([[None, [{'id': 'mario'}]]]))
+
+    def test_that_the_least_recently_synchronized_replicas_are_removed(self):
+        replica = self.replica([{'id': str(i), 'givenName': os.urandom(8).hex()} for i in range(20)])
+        self.store.save(['mario', 'endpoint'], replica)
+        max_bytes = self.store.size() * 2
+        store = ContactStore(self.path, max_bytes=max_bytes)
+        self.addCleanup(store.close)
+
+        for user_uuid in ('luigi', 'peach'):
+            store.save([user_uuid, 'endpoint'], replica)
+
+        contacts = dump_replica(replica)[1]
+        assert_that(store.load(['mario', 'endpoint']), none())
+        assert_that(store.load(['luigi', 'endpoint'])[1], equal_to(contacts))
+        assert_that(store.load(['peach', 'endpoint'])[1], equal_to(contacts))
+        assert_that(store.size() <= max_bytes, equal_to(True))
+
+    def test_that_another_schema_version_is_emptied(self):
+        self.store.save(['user-uuid', 'endpoint'], self.replica([]))
+        self.store.close()
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA user_version = 42')
+        connection.close()
+
+        assert_that(self.store.load(['user-uuid', 'endpoint']), none())
+
+    def test_that_the_transactions_are_explicit(self):
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'mario'}]))
+        self.store.save(['user-uuid', 'endpoint'], self.replica([{'id': 'mario'}]), changed=False)
+
+        connection = self.store._connect()
+        assert_that(connection.isolation_level, none())
+        assert_that(connection.in_transaction, equal_to(False))
+
+    def test_that_the_database_is_in_wal_mode(self):
+        self.store.load(['user-uuid', 'endpoint'])
+
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        assert_that(connection.execute('PRAGMA journal_mode').fetchone()[0], equal_to('wal'))
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'office365', 'source.snapshot')
+
+    def test_that_the_entries_are_loaded_with_the_same_header(self):
+        entries = [['user-uuid', [[None, 'delta-link']], [[None, [{'id': 'mario'}]]]]]
+
+        save_snapshot(self.path, {'select': ['id']}, entries)
+
+        assert_that(load_snapshot(self.path, {'select': ['id']}), equal_to(entries))
+        assert_that(load_snapshot(self.path, {'select': ['id', 'givenName']}), equal_to([]))
+        assert_that(os.listdir(os.path.dirname(self.path)), contains_inanyorder(
+            'source.snapshot', 'source.snapshot.lock',
+        ))
+
+    def test_that_the_entries_of_the_other_workers_are_kept(self):
+        save_snapshot(self.path, {}, [['mario', [], []], ['luigi', [[None, 'delta-link-1']], []]])
+
+        save_snapshot(self.path, {}, [['luigi', [[None, 'delta-link-2']], []], ['peach', [], []]])
+
+        assert_that(load_snapshot(self.path, {}), contains_inanyorder(
+            ['mario', [], []],
+            ['luigi', [[None, 'delta-link-2']], []],
+            ['peach', [], []],
+        ))
+
+    @patch('wazo_microsoft.dird.store.time.time')
+    def test_that_the_entries_saved_by_no_worker_are_removed(self, time):
+        time.return_value = 1000
+        save_snapshot(self.path, {}, [['mario', [], []]])
+
+        time.return_value = 1000 + 61
+        save_snapshot(self.path, {}, [['luigi', [], []]], max_age=60)
+
+        assert_that(load_snapshot(self.path, {}), contains(['luigi', [], []]))
+
+    def test_that_missing_or_corrupted_snapshots_are_ignored(self):
+        assert_that(load_snapshot(self.path, {}), equal_to([]))
+
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+
+        assert_that(load_snapshot(self.path, {}), equal_to([]))
+
+
+class TestDumpReplica(TestCase):
+
+    def setUp(self):
+        self.Record = record_class(['id', 'givenName'])
+
+    def make_contact(self, change, previous=None):
+        return self.Record(change)
+
+    def test_contact_replica(self):
+        replica = ContactReplica()
+        replica.apply([{'@odata.etag': 'W/"1"', 'id': 'mario', 'givenName': 'Mario'}], self.make_contact)
+        replica.delta_link = 'delta-link'
+
+        cursors, contacts = dump_replica(replica)
+        restored = restore_replica(ContactReplica(), cursors, contacts, self.make_contact)
+
+        assert_that(restored.delta_link, equal_to('delta-link'))
+        assert_that(restored.get('mario'), has_entries(id='mario', givenName='Mario'))
+        assert_that(restored.get('mario').etag, equal_to('W/"1"'))
+        assert_that(dump_replica(replica, contacts=False), equal_to((cursors, None)))
+
+    def test_folder_replica(self):
+        replica = FolderReplica()
+        replica.set_endpoints(['contacts', 'family'])
+        replica.replicas['contacts'].apply([{'id': 'mario'}], self.make_contact)
+        replica.replicas['family'].apply([{'id': 'luigi'}], self.make_contact)
+        for folder in replica.replicas.values():
+            folder.delta_link = 'delta-link'
+
+        restored = restore_replica(FolderReplica(), *dump_replica(replica), make_contact=self.make_contact)
+
+        assert_that(list(restored.replicas), contains('contacts', 'family'))
+        assert_that([c['id'] for c in restored.contacts], contains_inanyorder('mario', 'luigi'))
+        assert_that(restored.synced, equal_to(True))
@@ -0,0 +1,336 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+from unittest import TestCase
+from mock import Mock
+
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    contains_inanyorder,
+    empty,
+    equal_to,
+    has_entries,
+    raises,
+)
+
+from ..aio import AsyncBridge, AsyncOffice365Service
+from ..exceptions import SyncStateNotFoundException, UnexpectedEndpointException
+from ..sync import (
+    NO_DELTA_LINK,
+    ContactReplica,
+    DeltaSynchronizer,
+    FolderReplica,
+    FolderSynchronizer,
+    contact_folders_url,
+    delta_url,
+    folder_contacts_url,
+)
+
+ENDPOINT = 'https://graph.microsoft.com/v1.0/me/contacts'
+DELTA_URL = 'https://graph.microsoft.com/v1.0/me/contactFolders/default-folder/contacts/delta'
+
+
+class TestContactReplica(TestCase):
+
+    def setUp(self):
+        self.replica = ContactReplica()
+
+    def test_apply(self):
+        self.replica.apply([
+            {'id': 'mario', 'givenName': 'Mario'},
+            {'id': 'luigi', 'givenName': 'Luigi'},
+        ])
+
+        self.replica.apply([
+            {'id': 'mario', 'surname': 'Bros'},
+            {'id': 'luigi', '@removed': {'reason': 'deleted'}},
+            {'id': 'peach', 'givenName': 'Peach'},
+        ])
+
+        assert_that(self.replica.contacts, contains_inanyorder(
+            {'id': 'mario', 'givenName': 'Mario', 'surname': 'Bros'},
+            {'id': 'peach', 'givenName': 'Peach'},
+        ))
+        assert_that(self.replica.version, equal_to(2))
+
+    def test_that_the_version_is_unchanged_without_changes(self):
+        self.replica.apply([{'id': 'unknown', '@removed': {'reason': 'deleted'}}])
+
+        assert_that(self.replica.version, equal_to(0))
+
+    def test_that_contacts_are_made_from_the_change_and_the_previous_contact(self):
+        def make_contact(change, previous):
+            return dict(previous or {'givenName': ''}, **change)
+
+        self.replica.apply([{'id': 'mario'}], make_contact)
+        self.replica.apply([{'id': 'mario', 'surname': 'Bros'}], make_contact)
+
+        assert_that(self.replica.get('mario'), has_entries(givenName='', surname='Bros'))
+
+    def test_that_unchanged_contacts_do_not_change_the_version(self):
+        def make_contact(change, previous):
+            return previous if previous is not None else dict(change)
+
+        self.replica.apply([{'id': 'mario'}], make_contact)
+        self.replica.apply([{'id': 'mario'}], make_contact)
+
+        assert_that(self.replica.version, equal_to(1))
+
+    def test_that_snapshots_are_not_modified_by_later_changes(self):
+        self.replica.apply([{'id': 'mario', 'givenName': 'Mario'}])
+        snapshot = self.replica.contacts
+
+        self.replica.apply([{'id': 'mario', 'givenName': 'Super Mario'}])
+
+        assert_that(snapshot, contains_inanyorder({'id': 'mario', 'givenName': 'Mario'}))
+
+
+class TestDeltaSynchronizer(TestCase):
+
+    def setUp(self):
+        self.office365 = Mock()
+        self.office365.get_contact_folder_id.return_value = 'default-folder'
+        self.synchronizer = DeltaSynchronizer(self.office365)
+        self.replica = ContactReplica()
+
+    def test_that_the_delta_link_is_followed(self):
+        self.office365.get_delta.side_effect = [
+            ([{'id': 'mario'}], 'delta-link-1'),
+            ([{'id': 'luigi'}], 'delta-link-2'),
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_any_call('token', DELTA_URL, select=None)
+        self.office365.get_delta.assert_called_with('token', 'delta-link-1')
+        assert_that(self.replica.delta_link, equal_to('delta-link-2'))
+        assert_that(self.replica.contacts, contains_inanyorder({'id': 'mario'}, {'id': 'luigi'}))
+
+    def test_that_an_expired_delta_link_triggers_a_full_sync(self):
+        self.replica.apply([{'id': 'mario'}])
+        self.replica.delta_link = 'expired'
+        self.office365.get_delta.side_effect = [
+            SyncStateNotFoundException('expired'),
+            ([{'id': 'luigi'}], 'delta-link'),
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_called_with('token', DELTA_URL, select=None)
+        assert_that(self.replica.contacts, contains_inanyorder({'id': 'luigi'}))
+
+    def test_that_a_refused_delta_link_triggers_a_full_sync(self):
+        self.replica.apply([{'id': 'mario'}])
+        self.replica.delta_link = 'refused'
+        self.office365.get_delta.side_effect = [
+            UnexpectedEndpointException(error_code=404),
+            ([{'id': 'luigi'}], 'delta-link'),
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_called_with('token', DELTA_URL, select=None)
+        assert_that(self.replica.contacts, contains_inanyorder({'id': 'luigi'}))
+        assert_that(self.replica.delta_link, equal_to('delta-link'))
+
+    def test_that_transient_delta_link_errors_keep_the_replica(self):
+        self.replica.apply([{'id': 'mario'}])
+        self.replica.delta_link = 'delta-link'
+        self.office365.get_delta.side_effect = UnexpectedEndpointException(error_code=429)
+
+        assert_that(
+            calling(self.synchronizer.sync).with_args(self.replica, 'token', ENDPOINT),
+            raises(UnexpectedEndpointException),
+        )
+        assert_that(self.replica.contacts, contains({'id': 'mario'}))
+        assert_that(self.replica.delta_link, equal_to('delta-link'))
+
+    def test_that_delta_queries_refused_after_a_reset_fetch_every_contact(self):
+        self.replica.delta_link = 'refused'
+        self.office365.get_delta.side_effect = [
+            UnexpectedEndpointException(error_code=403),
+            UnexpectedEndpointException(error_code=400),
+        ]
+        self.office365.get_contacts.return_value = [{'id': 'luigi'}]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        assert_that(self.replica.contacts, contains({'id': 'luigi'}))
+        assert_that(self.replica.delta_link, equal_to(NO_DELTA_LINK))
+
+    def test_that_an_incomplete_sync_is_restarted(self):
+        self.office365.get_delta.side_effect = [
+            ([{'id': 'mario'}], None),
+            ([], 'delta-link'),
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_called_with('token', DELTA_URL, select=None)
+        assert_that(self.replica.contacts, empty())
+
+    def test_that_the_fields_are_selected_on_the_first_request(self):
+        synchronizer = DeltaSynchronizer(self.office365, select=['id', 'givenName'])
+        self.office365.get_delta.side_effect = [
+            ([{'id': 'mario'}], 'delta-link-1'),
+            ([], 'delta-link-2'),
+        ]
+
+        synchronizer.sync(self.replica, 'token', ENDPOINT)
+        synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_any_call('token', DELTA_URL, select=['id', 'givenName'])
+        self.office365.get_delta.assert_called_with('token', 'delta-link-1')
+
+    def test_that_the_default_folder_is_resolved_once(self):
+        self.office365.get_delta.side_effect = [
+            ([{'id': 'mario'}], 'delta-link-1'),
+            ([], 'delta-link-2'),
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_contact_folder_id.assert_called_once_with('token', ENDPOINT)
+
+    def test_that_an_empty_default_folder_is_resolved_again(self):
+        self.office365.get_contact_folder_id.return_value = None
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        self.office365.get_delta.assert_not_called()
+        assert_that(self.office365.get_contact_folder_id.call_count, equal_to(2))
+        assert_that(self.replica.contacts, empty())
+
+    def test_that_other_endpoints_are_synchronized_without_a_folder(self):
+        self.office365.get_delta.return_value = ([{'id': 'mario'}], 'delta-link')
+
+        self.synchronizer.sync(self.replica, 'token', 'https://graph.microsoft.com/v1.0/users')
+
+        self.office365.get_contact_folder_id.assert_not_called()
+        self.office365.get_delta.assert_called_once_with(
+            'token', 'https://graph.microsoft.com/v1.0/users/delta', select=None,
+        )
+
+    def test_that_every_contact_is_fetched_without_delta_queries(self):
+        self.office365.get_delta.side_effect = UnexpectedEndpointException(error_code=400)
+        self.office365.get_contacts.side_effect = [
+            [{'id': 'mario'}, {'id': 'luigi'}],
+            [{'id': 'luigi', 'givenName': 'Luigi'}],
+        ]
+
+        self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+        changed = self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        assert_that(changed, equal_to(True))
+        assert_that(self.replica.contacts, contains({'id': 'luigi', 'givenName': 'Luigi'}))
+        assert_that(self.replica.delta_link, equal_to(NO_DELTA_LINK))
+        assert_that(self.replica.synced, equal_to(True))
+        self.office365.get_delta.assert_called_once_with('token', DELTA_URL, select=None)
+        self.office365.get_contacts.assert_called_with('token', ENDPOINT, select=None)
+
+    def test_that_other_delta_errors_are_raised(self):
+        self.office365.get_delta.side_effect = UnexpectedEndpointException(error_code=503)
+
+        assert_that(
+            calling(self.synchronizer.sync).with_args(self.replica, 'token', ENDPOINT),
+            raises(UnexpectedEndpointException),
+        )
+        self.office365.get_contacts.assert_not_called()
+
+
+class TestFolderReplica(TestCase):
+
+    def setUp(self):
+        self.replica = FolderReplica()
+        self.replica.set_endpoints(['contacts', 'folder-1'])
+
+    def test_that_contacts_are_merged_by_id(self):
+        self.replica.replicas['contacts'].apply([{'id': 'mario', 'givenName': 'Mario'}])
+        self.replica.replicas['folder-1'].apply([
+            {'id': 'mario', 'givenName': 'Mario (copy)'},
+            {'id': 'luigi', 'givenName': 'Luigi'},
+        ])
+
+        assert_that(self.replica.contacts, contains(
+            {'id': 'mario', 'givenName': 'Mario'},
+            {'id': 'luigi', 'givenName': 'Luigi'},
+        ))
+        assert_that(self.replica.get('luigi'), has_entries(givenName='Luigi'))
+
+    def test_that_the_indexes_follow_the_folders(self):
+        build = Mock(side_effect=lambda contacts: len(contacts))
+        self.replica.replicas['folder-1'].apply([{'id': 'luigi'}])
+        assert_that(self.replica.get_index('count', build), equal_to(1))
+        assert_that(self.replica.get_index('count', build), equal_to(1))
+
+        self.replica.set_endpoints(['contacts'])
+
+        assert_that(self.replica.get_index('count', build), equal_to(0))
+        assert_that(build.call_count, equal_to(2))
+
+
+class TestFolderSynchronizer(TestCase):
+
+    def setUp(self):
+        self.office365 = Mock()
+        self.office365.get_contact_folder_id.return_value = 'default-folder'
+        self.office365.get_contact_folders.return_value = ['folder-1']
+        async_office365 = AsyncOffice365Service(self.office365)
+        self.addCleanup(async_office365.close)
+        bridge = AsyncBridge()
+        self.addCleanup(bridge.stop)
+        self.synchronizer = FolderSynchronizer(
+            self.office365, DeltaSynchronizer(self.office365), async_office365, bridge, recursive=True,
+        )
+        self.replica = FolderReplica()
+
+    def test_that_every_folder_is_synchronized(self):
+        deltas = {
+            DELTA_URL: ([{'id': 'mario'}], 'delta-link-1'),
+            DELTA_URL.replace('default-folder', 'folder-1'): ([{'id': 'luigi'}], 'delta-link-2'),
+        }
+        self.office365.get_delta.side_effect = lambda token, url, select=None: deltas[url]
+
+        changed = self.synchronizer.sync(self.replica, 'token', ENDPOINT)
+
+        assert_that(changed, equal_to(True))
+        assert_that(self.replica.synced, equal_to(True))
+        assert_that(self.replica.contacts, contains_inanyorder({'id': 'mario'}, {'id': 'luigi'}))
+        self.office365.get_contact_folders.assert_called_once_with(
+            'token', 'https://graph.microsoft.com/v1.0/me/contactFolders', True,
+        )
+
+    def test_that_folder_errors_are_raised(self):
+        self.office365.get_delta.side_effect = RuntimeError('graph is down')
+
+        assert_that(
+            calling(self.synchronizer.sync).with_args(self.replica, 'token', ENDPOINT),
+            raises(RuntimeError),
+        )
+
+
+class TestURLs(TestCase):
+
+    def test_contact_folders_url(self):
+        assert_that(
+            contact_folders_url('https://graph.microsoft.com/v1.0/me/contacts/?$filter=x'),
+            equal_to('https://graph.microsoft.com/v1.0/me/contactFolders'),
+        )
+
+    def test_folder_contacts_url(self):
+        assert_that(
+            folder_contacts_url('https://graph.microsoft.com/v1.0/me/contacts?$orderby=givenName', 'a/b'),
+            equal_to('https://graph.microsoft.com/v1.0/me/contactFolders/a%2Fb/contacts?$orderby=givenName'),
+        )
+
+    def test_that_the_query_follows_the_delta_path(self):
+        assert_that(
+            delta_url('https://graph.microsoft.com/v1.0/users/?$filter=accountEnabled eq true'),
+            equal_to('https://graph.microsoft.com/v1.0/users/delta?$filter=accountEnabled eq true'),
+        )
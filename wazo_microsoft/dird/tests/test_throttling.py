@@ -0,0 +1,243 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0+
+
+import requests
+
+from unittest import TestCase
+from mock import Mock, patch
+
+from hamcrest import (
+    assert_that,
+    calling,
+    contains,
+    equal_to,
+    has_entries,
+    raises,
+    same_instance,
+)
+
+from ..throttling import (
+    CircuitBreaker,
+    CircuitOpenException,
+    ThrottledException,
+    Throttler,
+    TokenBucket,
+    get_tenant_throttler,
+)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def response(status_code, retry_after=None):
+    headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+    return Mock(status_code=status_code, headers=headers)
+
+
+class ClockTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch('wazo_microsoft.dird.throttling.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestTokenBucket(ClockTestCase):
+
+    def test_that_requests_above_the_rate_wait(self):
+        bucket = TokenBucket(rate=2, burst=2)
+
+        for _ in range(4):
+            bucket.acquire()
+
+        assert_that(self.clock.sleeps, contains(0.5, 0.5))
+
+    def test_that_a_pause_delays_the_next_request(self):
+        bucket = TokenBucket(rate=10, burst=10)
+
+        bucket.pause(3)
+        bucket.acquire()
+
+        assert_that(self.clock.sleeps, contains(3))
+
+    def test_that_no_rate_never_waits(self):
+        bucket = TokenBucket(rate=None, burst=1)
+
+        for _ in range(10):
+            bucket.acquire()
+
+        assert_that(self.clock.sleeps, equal_to([]))
+
+    def test_that_a_pause_is_honored_without_a_rate(self):
+        bucket = TokenBucket(rate=None, burst=1)
+
+        bucket.pause(5)
+        bucket.acquire()
+        bucket.acquire()
+
+        assert_that(self.clock.sleeps, contains(5))
+
+    def test_that_a_pause_longer_than_the_max_wait_fails_right_away(self):
+        bucket = TokenBucket(rate=None, burst=1)
+
+        bucket.pause(300)
+
+        assert_that(calling(bucket.acquire).with_args(max_wait=10), raises(ThrottledException))
+        assert_that(self.clock.sleeps, equal_to([]))
+
+    def test_that_the_rate_wait_is_capped(self):
+        bucket = TokenBucket(rate=0.01, burst=1)
+        bucket.acquire()
+
+        assert_that(calling(bucket.acquire).with_args(max_wait=10), raises(ThrottledException))
+        assert_that(self.clock.sleeps, equal_to([]))
+
+
+class TestCircuitBreaker(ClockTestCase):
+
+    def test_that_the_circuit_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        breaker.record_failure()
+        assert_that(breaker.state, equal_to(CircuitBreaker.CLOSED))
+        breaker.record_failure()
+
+        assert_that(breaker.state, equal_to(CircuitBreaker.OPEN))
+        assert_that(breaker.allow(), equal_to(False))
+
+    def test_that_a_single_trial_is_allowed_after_the_reset_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+
+        self.clock.now += 30
+
+        assert_that(breaker.allow(), equal_to(True))
+        assert_that(breaker.allow(), equal_to(False))
+
+        breaker.record_success()
+        assert_that(breaker.state, equal_to(CircuitBreaker.CLOSED))
+
+    def test_that_a_failed_trial_opens_the_circuit_again(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+        self.clock.now += 30
+        breaker.allow()
+
+        breaker.record_failure()
+
+        assert_that(breaker.state, equal_to(CircuitBreaker.OPEN))
+
+
+class TestThrottler(ClockTestCase):
+
+    def test_that_retry_after_is_honored(self):
+        throttler = Throttler(rate=10)
+        send = Mock(side_effect=[response(429, retry_after=2), response(200)])
+
+        result = throttler.call(send)
+
+        assert_that(result.status_code, equal_to(200))
+        assert_that(self.clock.sleeps, contains(2))
+        assert_that(throttler.stats, has_entries(throttled=1, retries=1))
+
+    def test_that_long_retry_after_are_not_retried(self):
+        throttler = Throttler(backoff_max=10)
+        send = Mock(return_value=response(429, retry_after=60))
+
+        result = throttler.call(send)
+
+        assert_that(result.status_code, equal_to(429))
+        assert_that(send.call_count, equal_to(1))
+
+    def test_that_requests_fail_fast_during_a_long_retry_after(self):
+        throttler = Throttler(backoff_max=10, failure_threshold=10)
+        throttler.call(Mock(return_value=response(429, retry_after=300)))
+        send = Mock(return_value=response(200))
+
+        assert_that(calling(throttler.call).with_args(send), raises(CircuitOpenException))
+        send.assert_not_called()
+        assert_that(self.clock.sleeps, equal_to([]))
+        assert_that(throttler.stats, has_entries(paused=1))
+
+    @patch('wazo_microsoft.dird.throttling.random.uniform', side_effect=lambda low, high: high)
+    def test_that_failures_are_retried_with_exponential_backoff(self, _):
+        throttler = Throttler(max_retries=3, backoff_base=1, failure_threshold=10)
+        send = Mock(return_value=response(503))
+
+        result = throttler.call(send)
+
+        assert_that(result.status_code, equal_to(503))
+        assert_that(self.clock.sleeps, contains(1, 2, 4))
+
+    def test_that_connection_errors_are_raised_after_the_retries(self):
+        throttler = Throttler(max_retries=1, failure_threshold=10)
+        send = Mock(side_effect=requests.exceptions.ConnectionError())
+
+        assert_that(
+            calling(throttler.call).with_args(send),
+            raises(requests.exceptions.ConnectionError),
+        )
+        assert_that(send.call_count, equal_to(2))
+
+    def test_that_calls_are_short_circuited_while_the_circuit_is_open(self):
+        throttler = Throttler(max_retries=0, failure_threshold=1)
+        send = Mock(return_value=response(500))
+        throttler.call(send)
+
+        assert_that(calling(throttler.call).with_args(send), raises(CircuitOpenException))
+        assert_that(send.call_count, equal_to(1))
+        assert_that(throttler.stats, has_entries(short_circuited=1))
+
+    def test_that_other_request_errors_end_the_trial(self):
+        throttler = Throttler(max_retries=0, failure_threshold=1, reset_timeout=30)
+        throttler.call(Mock(return_value=response(500)))
+        self.clock.now += 30
+        send = Mock(side_effect=requests.exceptions.ChunkedEncodingError())
+
+        assert_that(
+            calling(throttler.call).with_args(send),
+            raises(requests.exceptions.ChunkedEncodingError),
+        )
+        assert_that(send.call_count, equal_to(1))
+
+        self.clock.now += 30
+        assert_that(throttler.call(Mock(return_value=response(200))).status_code, equal_to(200))
+        assert_that(throttler.state, equal_to(CircuitBreaker.CLOSED))
+
+    def test_that_unexpected_errors_end_the_trial(self):
+        throttler = Throttler(max_retries=0, failure_threshold=1, reset_timeout=30)
+        throttler.call(Mock(return_value=response(500)))
+        self.clock.now += 30
+
+        assert_that(calling(throttler.call).with_args(Mock(side_effect=ValueError())), raises(ValueError))
+
+        assert_that(throttler.call(Mock(return_value=response(200))).status_code, equal_to(200))
+
+    def test_that_client_errors_are_not_retried(self):
+        throttler = Throttler()
+        send = Mock(return_value=response(404))
+
+        throttler.call(send)
+
+        assert_that(send.call_count, equal_to(1))
+
+
+class TestGetTenantThrottler(TestCase):
+
+    def test_that_the_sources_of_a_tenant_share_a_throttler(self):
+        throttler = get_tenant_throttler('tenant-uuid', rate=5)
+
+        assert_that(get_tenant_throttler('tenant-uuid', rate=5), same_instance(throttler))
+        assert_that(get_tenant_throttler('other-tenant-uuid', rate=5) is throttler, equal_to(False))
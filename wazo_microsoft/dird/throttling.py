@@ -0,0 +1,237 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from collections import Counter
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+THROTTLING_EVENTS = metrics.counter(
+    'office365_graph_throttling_events_total',
+    'Microsoft graph requests throttled (429), retried, or skipped while paused or while the circuit is open',
+    ['event'],
+)
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class ThrottledException(CircuitOpenException):
+    pass
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self, max_wait=None):
+        # A pause is honored even without a rate, it is the Retry-After of the tenant. A request
+        # that would wait longer than max_wait fails right away, the lookups answer without it.
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if deadline is not None and self._paused_until > deadline:
+                    raise ThrottledException()
+                if not self._rate:
+                    if now >= self._paused_until:
+                        return
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+                    self._updated_at = now
+                    if now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = max(self._paused_until - now, (1 - self._tokens) / self._rate)
+                if deadline is not None and now + wait > deadline:
+                    raise ThrottledException()
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._trial_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self._reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                self._trial_thread = threading.get_ident()
+                return True
+            return False
+
+    def end_trial(self):
+        # A trial that ended without a result must not keep the circuit closed to everyone
+        with self._lock:
+            if self._trial_running and self._trial_thread == threading.get_ident():
+                self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self._failure_threshold:
+                if self._opened_at is None:
+                    logger.warning('microsoft graph is unhealthy, lookups are suspended')
+                self._opened_at = time.monotonic()
+
+
+class Throttler:
+
+    def __init__(
+        self,
+        rate=None,
+        burst=10,
+        max_retries=3,
+        backoff_base=0.5,
+        backoff_max=10,
+        failure_threshold=5,
+        reset_timeout=30,
+    ):
+        self._bucket = TokenBucket(rate, burst)
+        self._breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self.stats = Counter()
+
+    @property
+    def state(self):
+        return self._breaker.state
+
+    def call(self, send):
+        if not self._breaker.allow():
+            self.stats['short_circuited'] += 1
+            THROTTLING_EVENTS.inc('short_circuited')
+            raise CircuitOpenException()
+
+        try:
+            return self._call(send)
+        finally:
+            self._breaker.end_trial()
+
+    def _call(self, send):
+        attempt = 0
+        while True:
+            try:
+                self._bucket.acquire(self._backoff_max)
+            except ThrottledException:
+                self.stats['paused'] += 1
+                THROTTLING_EVENTS.inc('paused')
+                raise
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                self._breaker.record_failure()
+                if not isinstance(e, RETRYABLE_EXCEPTIONS) or not self._retry(attempt, None):
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    self._breaker.record_success()
+                    return response
+
+                if response.status_code == 429:
+                    self.stats['throttled'] += 1
+                    THROTTLING_EVENTS.inc('throttled')
+                self._breaker.record_failure()
+                if not self._retry(attempt, response):
+                    return response
+                response.close()
+            attempt += 1
+
+    def _retry(self, attempt, response):
+        retry_after = self._retry_after(response)
+        if retry_after is not None:
+            # Every request of the tenant waits, not only this one
+            self._bucket.pause(retry_after)
+
+        if attempt >= self._max_retries or not self._breaker.allow():
+            return False
+
+        if retry_after is not None and retry_after > self._backoff_max:
+            return False
+
+        delay = retry_after if retry_after is not None else self._backoff(attempt)
+        self.stats['retries'] += 1
+        THROTTLING_EVENTS.inc('retries')
+        logger.debug('retrying microsoft graph request in %.2f seconds', delay)
+        time.sleep(delay)
+        return True
+
+    def _backoff(self, attempt):
+        delay = min(self._backoff_max, self._backoff_base * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    @staticmethod
+    def _retry_after(response):
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+
+_throttlers = {}
+_throttlers_lock = threading.Lock()
+
+
+def get_tenant_throttler(tenant_uuid, **config):
+    # Microsoft graph throttles per tenant, all the sources of a tenant share a throttler
+    with _throttlers_lock:
+        key = (tenant_uuid, tuple(sorted(config.items())))
+        throttler = _throttlers.get(key)
+        if throttler is None:
+            throttler = _throttlers[key] = Throttler(**config)
+        return throttler
@@ -5,11 +5,19 @@ import logging
 
 from wazo_dird.helpers import BaseBackendView
 
-from .http import MicrosoftItem, MicrosoftList, MicrosoftContactList
+from .cache import ContactCache
+from .http import MicrosoftItem, MicrosoftList, MicrosoftContactList, MicrosoftMetrics
+from .services import Office365ServiceRegistry
 
 
 logger = logging.getLogger(__name__)
 
+CONTACT_LIST_CACHE_CONFIG = {
+    'ttl': 60,
+    'max_entries': 100,
+    'max_bytes': 64 * 1024 * 1024,
+}
+
 
 class Office365View(BaseBackendView):
 
@@ -24,10 +32,13 @@ class Office365View(BaseBackendView):
         config = dependencies['config']
         auth_config = config['auth']
         source_service = dependencies['services']['source']
-        args = (auth_config, config, source_service)
+        office365_services = Office365ServiceRegistry()
+        contact_cache = ContactCache(**CONTACT_LIST_CACHE_CONFIG)
+        args = (auth_config, config, source_service, office365_services, contact_cache)
 
         api.add_resource(
             self.contact_list_resource,
             "/backends/office365/sources/<source_uuid>/contacts",
             resource_class_args=args,
         )
+        api.add_resource(MicrosoftMetrics, "/backends/office365/metrics")
@@ -0,0 +1,186 @@
+# Copyright 2019 The Wazo Authors  (see the AUTHORS file)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import bisect
+import logging
+import threading
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        if value.is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in zip(names, values)
+    )
+    return '{{{}}}'.format(labels)
+
+
+class Metric:
+
+    # The values are kept by label values, given in the order of the label names. Updating a
+    # value is a dict update under a lock, cheap enough for the lookups of each call.
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        with self._lock:
+            values = [
+                (label_values, list(value) if isinstance(value, list) else value)
+                for label_values, value in self._values.items()
+            ]
+        values.sort(key=lambda item: [str(value) for value in item[0]])
+        for label_values, value in values:
+            lines.extend(self._render_samples(label_values, value))
+        return lines
+
+    def _render_samples(self, label_values, value):
+        yield '{}{} {}'.format(self.name, format_labels(self.labels, label_values), format_value(value))
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Counter):
+
+    type = 'gauge'
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        # Counts are kept by bucket, they are only accumulated when rendered. The last item is
+        # the sum of the observed values.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def get(self, *label_values):
+        counts = self._values.get(label_values)
+        return sum(counts[:-1]) if counts else 0
+
+    def _render_samples(self, label_values, counts):
+        labels = self.labels + ('le',)
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            yield '{}_bucket{} {}'.format(
+                self.name, format_labels(labels, label_values + (format_value(float(bound)),)), total,
+            )
+        yield '{}_sum{} {}'.format(self.name, format_labels(self.labels, label_values), format_value(counts[-1]))
+        yield '{}_count{} {}'.format(self.name, format_labels(self.labels, label_values), total)
+
+
+class Registry:
+
+    # Collectors are called before the metrics are rendered, to set the values that are
+    # already counted elsewhere, e.g. the statistics of the caches.
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        # Modules can be reloaded, the metric already registered keeps counting
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def add_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def remove_collector(self, collect):
+        with self._lock:
+            if collect in self._collectors:
+                self._collectors.remove(collect)
+
+    def render(self):
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics.values())
+
+        for collect in collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception('metrics collector %s failed', collect)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return registry.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=()):
+    return registry.register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DURATION_BUCKETS):
+    return registry.register(Histogram(name, documentation, labels, buckets))
+
+
+def render():
+    return registry.render()